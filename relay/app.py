@@ -1,12 +1,15 @@
 """FastAPI relay scaffold for StackFix (OpenAI-compatible)."""
 from __future__ import annotations
 
+import asyncio
 import hashlib
+import json
+import threading
 import time
 from typing import Any, Dict, Optional
 
-from fastapi import FastAPI, Header, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from .auth import TokenStore
 from .config import Settings, load_settings
@@ -57,6 +60,10 @@ def _reset_state_for_tests() -> None:
     _RATE_LIMITER = None
 
 
+def _dump(obj: Any) -> Any:
+    return obj.model_dump() if hasattr(obj, "model_dump") else obj
+
+
 def _hash_device(value: str) -> str:
     return hashlib.sha256(value.encode("utf-8")).hexdigest()
 
@@ -146,12 +153,234 @@ async def chat_completions(
     except Exception as exc:
         raise HTTPException(status_code=502, detail=f"Upstream error: {exc}") from exc
 
-    data = resp.model_dump() if hasattr(resp, "model_dump") else resp
     headers = {
         "X-RateLimit-Remaining": str(remaining),
         "X-RateLimit-Reset": str(reset_at),
     }
-    return JSONResponse(content=data, headers=headers)
+    if payload.get("stream"):
+        return StreamingResponse(_sse_events(resp), media_type="text/event-stream", headers=headers)
+    return JSONResponse(content=_dump(resp), headers=headers)
+
+
+def _sse_events(upstream: Any):
+    try:
+        for chunk in upstream:
+            yield f"data: {json.dumps(_dump(chunk))}\n\n"
+        yield "data: [DONE]\n\n"
+    finally:
+        close = getattr(upstream, "close", None)
+        if close is not None:
+            close()
+
+
+def _chunk_delta(chunk: Dict[str, Any]) -> tuple[str, str, Optional[str]]:
+    choices = chunk.get("choices") or []
+    if not choices:
+        return "", "", None
+    choice = choices[0] or {}
+    delta = choice.get("delta") or {}
+    return str(delta.get("content") or ""), str(delta.get("reasoning_content") or ""), choice.get("finish_reason")
+
+
+def _ws_token(websocket: WebSocket) -> Optional[str]:
+    authorization = websocket.headers.get("authorization")
+    if authorization and authorization.startswith("Bearer "):
+        return authorization.split(" ", 1)[1]
+    return None
+
+
+class _WsSession:
+    """One authenticated WebSocket connection multiplexing several requests."""
+
+    def __init__(self, websocket: WebSocket, token: str, device_id: str, settings: Settings) -> None:
+        self.websocket = websocket
+        self.token = token
+        self.device_id = device_id
+        self.settings = settings
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+        self._client = None
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        async with self._send_lock:
+            await self.websocket.send_json(message)
+
+    def client(self) -> Any:
+        if self._client is None:
+            self._client = OpenAI(
+                base_url=self.settings.upstream_base_url,
+                api_key=self.settings.upstream_api_key,
+            )
+        return self._client
+
+    def authorized(self) -> bool:
+        """Whether the handshake token is still valid; it may expire or be revoked mid-connection."""
+        return _get_token_store().verify_token(self.token) == self.device_id
+
+    async def handle_request(self, request_id: str, payload: Dict[str, Any], stream: bool) -> None:
+        try:
+            remaining, reset_at = _get_rate_limiter().check(self.device_id)
+        except HTTPException as exc:
+            await self.send({"type": "error", "id": request_id, "status": exc.status_code, "detail": exc.detail})
+            return
+        if not payload.get("model"):
+            payload["model"] = self.settings.upstream_model
+        # Streaming is chosen by the frame, not the payload; a client "stream" key would clash with it.
+        payload.pop("stream", None)
+        rate_limit = {"remaining": remaining, "reset": reset_at}
+        try:
+            if stream:
+                data = await self._stream_upstream(request_id, payload)
+            else:
+                resp = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: self.client().chat.completions.create(**payload)
+                )
+                data = _dump(resp)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await self.send({"type": "error", "id": request_id, "status": 502, "detail": f"Upstream error: {exc}"})
+            return
+        await self.send({"type": "done", "id": request_id, "response": data, "rate_limit": rate_limit})
+
+    async def _stream_upstream(self, request_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        client = self.client()
+
+        def _produce() -> None:
+            try:
+                upstream = client.chat.completions.create(**payload, stream=True)
+                try:
+                    for chunk in upstream:
+                        if cancelled.is_set():
+                            break
+                        loop.call_soon_threadsafe(queue.put_nowait, ("chunk", _dump(chunk)))
+                finally:
+                    close = getattr(upstream, "close", None)
+                    if close is not None:
+                        close()
+                loop.call_soon_threadsafe(queue.put_nowait, ("end", None))
+            except Exception as exc:
+                loop.call_soon_threadsafe(queue.put_nowait, ("error", exc))
+
+        producer = loop.run_in_executor(None, _produce)
+        parts = []
+        reasoning_parts = []
+        finish_reason = None
+        try:
+            while True:
+                kind, item = await queue.get()
+                if kind == "end":
+                    break
+                if kind == "error":
+                    raise item
+                text, reasoning, reason = _chunk_delta(item)
+                if reason:
+                    finish_reason = reason
+                if reasoning:
+                    reasoning_parts.append(reasoning)
+                if text:
+                    parts.append(text)
+                    await self.send({"type": "delta", "id": request_id, "content": text})
+        finally:
+            cancelled.set()
+        await producer
+        message: Dict[str, Any] = {"role": "assistant", "content": "".join(parts)}
+        if reasoning_parts:
+            message["reasoning_content"] = "".join(reasoning_parts)
+        return {
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": finish_reason,
+                }
+            ],
+        }
+
+    def start(self, request_id: str, payload: Dict[str, Any], stream: bool) -> None:
+        task = asyncio.create_task(self.handle_request(request_id, payload, stream))
+        self.tasks[request_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(request_id, None))
+
+    def cancel(self, request_id: str) -> bool:
+        task = self.tasks.get(request_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    def cancel_all(self) -> None:
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+
+@app.websocket("/v1/ws")
+async def chat_ws(websocket: WebSocket) -> None:
+    """Long-lived channel: authenticate at the handshake, then multiplex requests by id.
+
+    The token is checked again for every request frame, so one that expires or is
+    revoked closes the connection (4401) instead of outliving it.
+    """
+    await websocket.accept()
+    settings = _get_settings()
+    token = _ws_token(websocket)
+    if token is None:
+        try:
+            first = await websocket.receive_json()
+        except WebSocketDisconnect:
+            return
+        if isinstance(first, dict) and first.get("type") == "auth":
+            token = first.get("token")
+    device_id = _get_token_store().verify_token(token) if token else None
+    if not device_id:
+        await websocket.send_json({"type": "error", "status": 401, "detail": "Invalid or expired token"})
+        await websocket.close(code=4401)
+        return
+    if OpenAI is None:
+        await websocket.send_json(
+            {"type": "error", "status": 500, "detail": "openai SDK not installed; install relay extras"}
+        )
+        await websocket.close(code=1011)
+        return
+
+    session = _WsSession(websocket, token, device_id, settings)
+    await session.send({"type": "ready"})
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                continue
+            kind = message.get("type")
+            request_id = str(message.get("id") or "")
+            if kind == "ping":
+                await session.send({"type": "pong", "id": request_id})
+            elif kind == "request":
+                payload = message.get("payload")
+                if not request_id or not isinstance(payload, dict):
+                    await session.send({"type": "error", "id": request_id, "status": 400, "detail": "Invalid request"})
+                    continue
+                if request_id in session.tasks:
+                    await session.send({"type": "error", "id": request_id, "status": 409, "detail": "Duplicate id"})
+                    continue
+                if not session.authorized():
+                    await session.send(
+                        {"type": "error", "id": request_id, "status": 401, "detail": "Invalid or expired token"}
+                    )
+                    await websocket.close(code=4401)
+                    return
+                session.start(request_id, payload, bool(message.get("stream", True)))
+            elif kind == "cancel":
+                if session.cancel(request_id):
+                    await session.send({"type": "cancelled", "id": request_id})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        session.cancel_all()
 
 
 if __name__ == "__main__":
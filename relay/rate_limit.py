@@ -10,6 +10,16 @@ from .config import Settings
 from .redis_client import get_redis
 
 
+def _exceeded(reset_at: int, now: float) -> HTTPException:
+    """429 that tells clients when to come back instead of leaving them to guess."""
+    headers = {
+        "Retry-After": str(max(int(reset_at - now), 1)),
+        "X-RateLimit-Remaining": "0",
+        "X-RateLimit-Reset": str(reset_at),
+    }
+    return HTTPException(status_code=429, detail="Rate limit exceeded", headers=headers)
+
+
 class RateLimiter:
     def __init__(self, settings: Settings) -> None:
         self._limit = settings.rate_limit_per_day
@@ -27,10 +37,10 @@ class RateLimiter:
             if ttl <= 0:
                 self._redis.expire(key, 86400)
                 ttl = 86400
+            reset_at = int(now + ttl)
             if count > self._limit:
-                raise HTTPException(status_code=429, detail="Rate limit exceeded")
+                raise _exceeded(reset_at, now)
             remaining = max(self._limit - count, 0)
-            reset_at = int(now + ttl)
             return remaining, reset_at
         count, reset_at = self._buckets.get(device_id, (0, now + 86400))
         if now > reset_at:
@@ -38,6 +48,6 @@ class RateLimiter:
         count += 1
         self._buckets[device_id] = (count, reset_at)
         if count > self._limit:
-            raise HTTPException(status_code=429, detail="Rate limit exceeded")
+            raise _exceeded(int(reset_at), now)
         remaining = max(self._limit - count, 0)
         return remaining, int(reset_at)
@@ -1,16 +1,33 @@
+import asyncio
+import hashlib
 import json
 import os
+import queue
 import shlex
 import sys
-import requests
-from typing import Dict, Any, Optional, Tuple
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit
 
+try:
+    import websocket
+except Exception:  # pragma: no cover - optional dependency
+    websocket = None
+
+from . import cache, capabilities, discovery, hedging, retry, rules, stats, streaming, transport
+from .patching import repair_unified_diff, search_replace_to_diff
+from .streaming import StreamCallback
 from .util import env_required
 from .config import (
     get_or_create_device_fingerprint,
     get_relay_token,
     is_token_valid,
     set_relay_token,
+    token_lock,
+    token_refresh_due,
+    user_lock,
 )
 
 SYSTEM_PROMPT = (
@@ -24,6 +41,17 @@ SYSTEM_PROMPT = (
     "with ranges like @@ -1,2 +1,8 @@ (no bare @@ lines)."
 )
 
+SEARCH_REPLACE_PROMPT = (
+    "You are StackFix, an agent that proposes minimal safe edits to fix a failing command. "
+    "Return ONLY a single JSON object in the assistant message content, with keys: "
+    "summary (string), confidence (0-1 number), edits (array of objects with keys path, search, replace), "
+    "rerun_command (array of strings). "
+    "No markdown, no backticks, no extra text. "
+    "Each search string is copied exactly from the current file and includes just enough lines "
+    "to match once; it is replaced by replace. Use several edits for several places or files, "
+    "in file order. An empty search creates a new file. No diff headers or line numbers."
+)
+
 PROMPT_MODE_SYSTEM_PROMPT = (
     "You are StackFix, a helpful AI coding assistant. "
     "Answer the user's question directly and concisely. "
@@ -42,6 +70,18 @@ STRICT_DIFF_PROMPT = (
     "Example hunk header: @@ -1,2 +1,2 @@. No extra text."
 )
 
+CONTINUE_PROMPT = (
+    "Your reply was cut off by the output token limit. Continue it exactly where it stopped. "
+    "Output only the remaining text: do not repeat anything, start over or add commentary."
+)
+
+# Keys that mark a JSON object as the agent's answer rather than an example inside it.
+AGENT_RESPONSE_KEYS = frozenset({"summary", "patch_unified_diff", "edits", "rerun_command"})
+DEFAULT_MAX_CONTINUATIONS = 2
+# Shortest repeated tail of a cut-off reply that is treated as overlap rather than new text.
+MIN_CONTINUATION_OVERLAP = 16
+MAX_CONTINUATION_OVERLAP = 400
+
 _ENDPOINT_LOGGED = False
 DEFAULT_RELAY_URL = "https://api.stackfix.ai/v1"
 LOCAL_RELAY_URL = "http://localhost:8000/v1"
@@ -76,6 +116,44 @@ def _debug_log(msg: str) -> None:
         print(f"[stackfix][debug] {msg}", file=sys.stderr)
 
 
+# Context that rarely changes within a project, sent before the failure so that
+# provider prompt caches can reuse the prefix from one run to the next.
+STABLE_CONTEXT_SECTIONS = (
+    ("agent_instructions", "Project instructions (AGENTS.md)"),
+    ("manifests", "Project manifests"),
+    ("repo_summary", "Repository summary"),
+)
+
+
+def _canonical_json(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def _stable_context_messages(context: Dict[str, Any]) -> List[Dict[str, str]]:
+    messages = []
+    for key, title in STABLE_CONTEXT_SECTIONS:
+        value = context.get(key)
+        if not value:
+            continue
+        text = value if isinstance(value, str) else _canonical_json(value)
+        messages.append({"role": "user", "content": f"{title}:\n{text}"})
+    return messages
+
+
+def _edit_format() -> str:
+    """"diff" (default) or "search_replace", from STACKFIX_EDIT_FORMAT."""
+    value = os.environ.get("STACKFIX_EDIT_FORMAT", "diff").strip().lower().replace("-", "_")
+    return "search_replace" if value == "search_replace" else "diff"
+
+
+def _fix_system_prompt() -> str:
+    return SEARCH_REPLACE_PROMPT if _edit_format() == "search_replace" else SYSTEM_PROMPT
+
+
+def _model_name() -> str:
+    return os.environ.get("MODEL_NAME") or os.environ.get("STACKFIX_MODEL") or "stackfix-default"
+
+
 def _model_request_payload(context: Dict[str, Any], system_prompt: str = SYSTEM_PROMPT) -> Dict[str, Any]:
     max_tokens = int(os.environ.get("MODEL_MAX_TOKENS", "2000"))
     
@@ -83,56 +161,146 @@ def _model_request_payload(context: Dict[str, Any], system_prompt: str = SYSTEM_
     is_prompt_mode = context.get("mode") == "prompt"
     if is_prompt_mode and system_prompt == SYSTEM_PROMPT:
         system_prompt = PROMPT_MODE_SYSTEM_PROMPT
+    elif system_prompt == SYSTEM_PROMPT:
+        system_prompt = _fix_system_prompt()
     
     # Build user message - for prompt mode, just send the prompt text
     if is_prompt_mode:
-        user_content = context.get("prompt", "")
-        if context.get("agent_instructions"):
-            user_content = f"Project context:\n{context['agent_instructions']}\n\nUser question: {user_content}"
+        user_content = f"User question: {context.get('prompt', '')}"
     else:
-        user_content = json.dumps(context)
+        # Underscore keys carry request options and are never sent to the model.
+        stable = {key for key, _ in STABLE_CONTEXT_SECTIONS}
+        failure = {k: v for k, v in context.items() if not k.startswith("_") and k not in stable}
+        user_content = f"Failure:\n{_canonical_json(failure)}"
     
-    model_name = os.environ.get("MODEL_NAME") or os.environ.get("STACKFIX_MODEL") or "stackfix-default"
     payload = {
-        "model": model_name,
-        "temperature": 0.2,
+        "model": _model_name(),
+        "temperature": context.get("_temperature", 0.2),
         "max_tokens": max_tokens,
         "messages": [
             {"role": "system", "content": system_prompt},
+            *_stable_context_messages(context),
             {"role": "user", "content": user_content},
         ],
     }
+    partial = context.get("_continuation")
+    if partial:
+        # The rest of a JSON reply is not a JSON object, so response_format is left off.
+        payload["messages"] += [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": CONTINUE_PROMPT},
+        ]
     # Only request JSON format for non-prompt mode
-    if not is_prompt_mode and os.environ.get("STACKFIX_NO_RESPONSE_FORMAT") != "1":
+    elif not is_prompt_mode and os.environ.get("STACKFIX_NO_RESPONSE_FORMAT") != "1":
         payload["response_format"] = {"type": "json_object"}
     return payload
 
 
-def _call_direct(context: Dict[str, Any], system_prompt: str = SYSTEM_PROMPT) -> Dict[str, Any]:
+def _supports_cache_hints(url: str) -> bool:
+    if os.environ.get("STACKFIX_PROMPT_CACHE_HINTS") == "1":
+        return True
+    host = urlsplit(url).hostname or ""
+    return host == "api.openai.com"
+
+
+def _apply_cache_hints(payload: Dict[str, Any], url: str) -> None:
+    """Route requests sharing a stable prefix to the same cache and ask for usage on streams."""
+    if not _supports_cache_hints(url):
+        return
+    messages = payload["messages"]
+    if messages[-1]["content"] == CONTINUE_PROMPT:
+        # Keep the key of the request being continued so it lands on the same cache.
+        messages = messages[:-2]
+    prefix = _canonical_json(messages[:-1])
+    payload["prompt_cache_key"] = "stackfix-" + hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:24]
+    if payload.get("stream"):
+        payload["stream_options"] = {"include_usage": True}
+
+
+def _read_completion(resp: Any, on_delta: Optional[Callable[[str], None]]) -> Tuple[Dict[str, Any], bool]:
+    headers = getattr(resp, "headers", None) or {}
+    if on_delta is not None and "text/event-stream" in headers.get("content-type", ""):
+        return streaming.read_sse_completion(resp, on_delta), True
+    raw_text = resp.text
+    _debug_log(f"Raw response (first 500 chars): { _redact_secrets(raw_text[:500]) }")
+    return resp.json(), False
+
+
+def _finish_completion(
+    data: Dict[str, Any],
+    streamed: bool,
+    on_delta: Optional[Callable[[str], None]],
+    endpoint: Optional[capabilities.Endpoint] = None,
+) -> Dict[str, Any]:
+    content = _extract_content(data, endpoint)
+    if on_delta is not None and not streamed:
+        on_delta(content)
+    result = _parse_agent_response(content)
+    if isinstance(data, dict) and isinstance(data.get("usage"), dict):
+        result["_usage"] = data["usage"]
+    choices = data.get("choices") if isinstance(data, dict) else None
+    if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+        result["_finish_reason"] = choices[0].get("finish_reason")
+    return result
+
+
+def _finish_modal(
+    data: Dict[str, Any], streamed: bool, on_delta: Optional[Callable[[str], None]]
+) -> Dict[str, Any]:
+    if streamed:
+        return _finish_completion(data, streamed, on_delta)
+    content = data.get("content") or data.get("response") or data
+    if isinstance(content, dict):
+        if on_delta is not None:
+            on_delta(json.dumps(content))
+        return _validate_agent_json(content)
+    if on_delta is not None:
+        on_delta(str(content))
+    return _parse_agent_response(content)
+
+
+def _direct_target() -> Tuple[str, Dict[str, str]]:
     base_url = env_required("MODEL_BASE_URL").rstrip("/")
     api_key = env_required("MODEL_API_KEY")
     if base_url.endswith("/v1"):
         url = f"{base_url}/chat/completions"
     else:
         url = f"{base_url}/v1/chat/completions"
-    _log_endpoint_once(url)
-    payload = _model_request_payload(context, system_prompt=system_prompt)
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
-    resp = requests.post(url, headers=headers, json=payload, timeout=60)
+    return url, headers
+
+
+def _call_direct(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Any]:
+    url, headers = _direct_target()
+    _log_endpoint_once(url)
+    payload = _model_request_payload(context, system_prompt=system_prompt)
+    if on_delta is not None:
+        payload["stream"] = True
+    endpoint = capabilities.for_endpoint(url, headers, payload["model"])
+    endpoint.fit(payload)
+    _apply_cache_hints(payload, url)
+    resp = retry.post(url, headers=headers, json=payload, stream=bool(payload.get("stream")))
     _debug_log(f"HTTP status: {resp.status_code}")
+    if resp.status_code in capabilities.REJECTED_STATUSES:
+        endpoint.rejected()
     resp.raise_for_status()
-    raw_text = resp.text
-    _debug_log(f"Raw response (first 500 chars): { _redact_secrets(raw_text[:500]) }")
-    data = resp.json()
-    content = _extract_content(data)
-    return _parse_agent_response(content)
+    data, streamed = _read_completion(resp, on_delta)
+    return _finish_completion(data, streamed, on_delta, endpoint)
+
+
+_DISCOVERED_RELAY: Optional[str] = None
 
 
 def _relay_base_url() -> str:
-    return os.environ.get("STACKFIX_RELAY_URL", DEFAULT_RELAY_URL).rstrip("/")
+    base = os.environ.get("STACKFIX_RELAY_URL") or _DISCOVERED_RELAY or DEFAULT_RELAY_URL
+    return base.rstrip("/")
 
 
 def _relay_endpoint(path: str) -> str:
@@ -149,6 +317,26 @@ def _relay_candidates() -> list:
     return [DEFAULT_RELAY_URL, LOCAL_RELAY_URL]
 
 
+def _resolve_relay(cwd: str, force: bool = False) -> str:
+    """STACKFIX_RELAY_URL, else the fastest healthy candidate (saved in config with a TTL)."""
+    global _DISCOVERED_RELAY
+    env_url = os.environ.get("STACKFIX_RELAY_URL")
+    if env_url:
+        return env_url
+    if _DISCOVERED_RELAY is None or force:
+        _DISCOVERED_RELAY = discovery.discover_relay(cwd, _relay_candidates(), force=force)
+        _debug_log(f"Relay endpoint: {_DISCOVERED_RELAY}")
+    return _DISCOVERED_RELAY
+
+
+def _relay_failover(cwd: str) -> bool:
+    """Re-probe after a connection failure; True when a different relay was picked."""
+    if os.environ.get("STACKFIX_RELAY_URL"):
+        return False
+    before = _relay_base_url()
+    return _resolve_relay(cwd, force=True).rstrip("/") != before
+
+
 def _build_relay_url(base: str, path: str) -> str:
     base = base.rstrip("/")
     if base.endswith("/v1"):
@@ -156,24 +344,34 @@ def _build_relay_url(base: str, path: str) -> str:
     return f"{base}/v1{path}"
 
 
-def _request_relay_token(cwd: str) -> Tuple[str, int]:
+def _request_relay_token(cwd: str, stale: Optional[str] = None) -> Tuple[str, int]:
+    """Fetch a relay token, replacing stale; parallel runs wait on one request and share it."""
     device_fingerprint = get_or_create_device_fingerprint(cwd)
     last_error: Optional[Exception] = None
-    for base in _relay_candidates():
+    tried = []
+    # The saved or discovered relay first; on failure one fresh probe picks another.
+    for force in (False, True):
+        base = _resolve_relay(cwd, force=force)
+        if base in tried:
+            break
+        tried.append(base)
         url = _build_relay_url(base, "/anon-token")
         try:
-            resp = requests.post(url, json={"device_fingerprint": device_fingerprint}, timeout=30)
-            _debug_log(f"Relay token HTTP status: {resp.status_code}")
-            resp.raise_for_status()
-            data = resp.json()
-            token = data.get("token")
-            expires_at = data.get("expires_at")
-            if not token or not expires_at:
-                raise RuntimeError("Relay token response missing token or expires_at")
-            set_relay_token(cwd, token, int(expires_at))
-            if os.environ.get("STACKFIX_RELAY_URL") is None:
-                os.environ["STACKFIX_RELAY_URL"] = base
-            return token, int(expires_at)
+            # token_lock, not user_lock: the request can take up to its read timeout,
+            # and the pacer, stats and capability cache write under user_lock.
+            with token_lock():
+                cached = get_relay_token(base)
+                if cached["token"] and cached["token"] != stale and is_token_valid(cached["expires_at"]):
+                    _debug_log("Using relay token refreshed by another process")
+                    return cached["token"], int(cached["expires_at"])
+                resp = transport.post(
+                    url,
+                    json={"device_fingerprint": device_fingerprint},
+                    timeout=transport.default_timeout(read=30),
+                )
+                _debug_log(f"Relay token HTTP status: {resp.status_code}")
+                resp.raise_for_status()
+                return _save_relay_token(base, resp.json(), cached["token"], stale)
         except Exception as exc:
             last_error = exc
             _debug_log(f"Relay token failed for {url}: {exc}")
@@ -181,19 +379,256 @@ def _request_relay_token(cwd: str) -> Tuple[str, int]:
     raise RuntimeError(f"Relay token request failed: {last_error}")
 
 
+def _save_relay_token(
+    base: str, data: Dict[str, Any], seen: Optional[str] = None, stale: Optional[str] = None
+) -> Tuple[str, int]:
+    """Store the token in data unless another token replaced seen while it was requested."""
+    token = data.get("token")
+    expires_at = data.get("expires_at")
+    if not token or not expires_at:
+        raise RuntimeError("Relay token response missing token or expires_at")
+    with user_lock():
+        current = get_relay_token(base)
+        if current["token"] not in (seen, stale) and is_token_valid(current["expires_at"]):
+            _debug_log("Keeping relay token stored by another process")
+            return current["token"], int(current["expires_at"])
+        set_relay_token(base, token, int(expires_at))
+    return token, int(expires_at)
+
+
+_TOKEN_REFRESHES: Dict[str, threading.Thread] = {}
+_TOKEN_REFRESHES_LOCK = threading.Lock()
+
+
+def _refresh_token_in_background(cwd: str, token: str) -> None:
+    def _refresh() -> None:
+        try:
+            _request_relay_token(cwd, stale=token)
+        except Exception as exc:
+            _debug_log(f"Background relay token refresh failed: {exc}")
+
+    base = _relay_base_url()
+    with _TOKEN_REFRESHES_LOCK:
+        running = _TOKEN_REFRESHES.get(base)
+        if running is not None and running.is_alive():
+            return
+        thread = threading.Thread(target=_refresh, daemon=True)
+        _TOKEN_REFRESHES[base] = thread
+        thread.start()
+
+
 def _get_relay_token(cwd: str) -> str:
-    token_info = get_relay_token(cwd)
+    token_info = get_relay_token(_relay_base_url())
     token = token_info.get("token")
-    expires_at = token_info.get("expires_at")
-    if token and is_token_valid(expires_at):
+    if token and is_token_valid(token_info.get("expires_at")):
+        if token_refresh_due(token_info):
+            _refresh_token_in_background(cwd, token)
         return token
     token, _ = _request_relay_token(cwd)
     return token
 
 
-def _call_relay(context: Dict[str, Any], system_prompt: str = SYSTEM_PROMPT) -> Dict[str, Any]:
+class _RelayWsError(RuntimeError):
+    """A relay WebSocket error with its status; 0 when the channel closed under the request."""
+
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class _RelayChannel:
+    """Persistent relay WebSocket: authenticated once, requests multiplexed by id."""
+
+    def __init__(self, url: str, token: str, timeout: float = 30) -> None:
+        self.url = url
+        self.token = token
+        self._ws = websocket.create_connection(url, header=[f"Authorization: Bearer {token}"], timeout=timeout)
+        ready = json.loads(self._ws.recv())
+        if ready.get("type") != "ready":
+            self._ws.close()
+            raise _RelayWsError(
+                f"Relay WebSocket rejected connection ({ready.get('status')}): {ready.get('detail') or ready}",
+                int(ready.get("status") or 0),
+            )
+        self._ws.settimeout(None)
+        self._send_lock = threading.Lock()
+        self._pending: Dict[str, "queue.Queue"] = {}
+        self.closed = False
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self) -> None:
+        try:
+            while True:
+                raw = self._ws.recv()
+                if not raw:
+                    break
+                message = json.loads(raw)
+                sink = self._pending.get(str(message.get("id") or ""))
+                if sink is not None:
+                    sink.put(message)
+        except Exception as exc:
+            _debug_log(f"Relay WebSocket closed: {exc}")
+        finally:
+            self.closed = True
+            for sink in list(self._pending.values()):
+                sink.put({"type": "error", "status": 0, "detail": "Relay WebSocket closed"})
+
+    def _send(self, message: Dict[str, Any]) -> None:
+        with self._send_lock:
+            self._ws.send(json.dumps(message))
+
+    def request(
+        self,
+        payload: Dict[str, Any],
+        on_delta: Optional[Callable[[str], None]] = None,
+        timeout: float = 60,
+    ) -> Dict[str, Any]:
+        request_id = uuid.uuid4().hex
+        sink: "queue.Queue" = queue.Queue()
+        self._pending[request_id] = sink
+        try:
+            self._send({"type": "request", "id": request_id, "payload": payload, "stream": True})
+            while True:
+                try:
+                    message = sink.get(timeout=timeout)
+                except queue.Empty:
+                    raise RuntimeError("Relay WebSocket request timed out")
+                kind = message.get("type")
+                if kind == "delta":
+                    if on_delta is not None:
+                        on_delta(message.get("content", ""))
+                elif kind == "done":
+                    return message.get("response") or {}
+                elif kind == "error":
+                    raise _RelayWsError(
+                        f"Relay error {message.get('status')}: {message.get('detail')}", int(message.get("status") or 0)
+                    )
+                elif kind == "cancelled":
+                    raise RuntimeError("Relay request cancelled")
+        except BaseException:
+            if not self.closed:
+                self.cancel(request_id)
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    def cancel(self, request_id: str) -> None:
+        try:
+            self._send({"type": "cancel", "id": request_id})
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self._ws.close()
+        except Exception:
+            pass
+
+
+_RELAY_CHANNEL: Optional[_RelayChannel] = None
+_RELAY_CHANNEL_LOCK = threading.Lock()
+_RELAY_WS_UNAVAILABLE = False
+
+
+def _relay_ws_enabled() -> bool:
+    return websocket is not None and os.environ.get("STACKFIX_RELAY_WS") == "1" and not _RELAY_WS_UNAVAILABLE
+
+
+def _relay_ws_url() -> str:
+    url = _relay_endpoint("/ws")
+    if url.startswith("https://"):
+        return "wss://" + url[len("https://"):]
+    if url.startswith("http://"):
+        return "ws://" + url[len("http://"):]
+    return url
+
+
+def _get_relay_channel(token: str) -> _RelayChannel:
+    global _RELAY_CHANNEL
+    with _RELAY_CHANNEL_LOCK:
+        channel = _RELAY_CHANNEL
+        if channel is not None and not channel.closed and channel.token == token:
+            return channel
+        if channel is not None:
+            channel.close()
+        _RELAY_CHANNEL = _RelayChannel(_relay_ws_url(), token)
+        return _RELAY_CHANNEL
+
+
+def _open_relay_channel(cwd: str, token: str) -> Tuple[_RelayChannel, str]:
+    """The shared channel and the token it was opened with, refreshed once if the handshake rejects it."""
+    try:
+        return _get_relay_channel(token), token
+    except _RelayWsError as exc:
+        if exc.status != 401:
+            raise
+    _debug_log("Relay token rejected on WebSocket; refreshing token")
+    token, _ = _request_relay_token(cwd, stale=token)
+    return _get_relay_channel(token), token
+
+
+def _call_relay_ws(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Optional[Dict[str, Any]]:
+    """Send one request over the shared relay channel; None means use HTTP instead.
+
+    A request the relay rejects with 401, or that loses its channel before any
+    token arrives, is sent once more on a fresh channel, with a refreshed token
+    for the 401, as the HTTP path does.
+    """
+    global _RELAY_WS_UNAVAILABLE
     cwd = context.get("cwd") or os.getcwd()
+    _resolve_relay(cwd)
+    token = _get_relay_token(cwd)
     payload = _model_request_payload(context, system_prompt=system_prompt)
+    for attempt in range(2):
+        try:
+            channel, token = _open_relay_channel(cwd, token)
+        except Exception as exc:
+            _debug_log(f"Relay WebSocket unavailable; using HTTP: {exc}")
+            _RELAY_WS_UNAVAILABLE = True
+            return None
+        _log_endpoint_once(channel.url)
+        received: List[str] = []
+
+        def _on_delta(text: str) -> None:
+            received.append(text)
+            if on_delta is not None:
+                on_delta(text)
+
+        try:
+            data = channel.request(payload, on_delta=_on_delta)
+        except _RelayWsError as exc:
+            if attempt or received or exc.status not in (0, 401):
+                raise
+            if exc.status == 401:
+                _debug_log("Relay token rejected on WebSocket request; refreshing token")
+                token, _ = _request_relay_token(cwd, stale=token)
+            else:
+                _debug_log("Relay WebSocket closed before replying; reconnecting")
+            continue
+        return _finish_completion(data, True, on_delta)
+    return None
+
+
+def _call_relay(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Any]:
+    if _relay_ws_enabled():
+        result = _call_relay_ws(context, system_prompt=system_prompt, on_delta=on_delta)
+        if result is not None:
+            return result
+    cwd = context.get("cwd") or os.getcwd()
+    payload = _model_request_payload(context, system_prompt=system_prompt)
+    if on_delta is not None:
+        payload["stream"] = True
+    _resolve_relay(cwd)
     token = _get_relay_token(cwd)
     url = _relay_endpoint("/chat/completions")
     _log_endpoint_once(url)
@@ -202,39 +637,43 @@ def _call_relay(context: Dict[str, Any], system_prompt: str = SYSTEM_PROMPT) ->
         "Content-Type": "application/json",
     }
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
+        resp = retry.post(url, headers=headers, json=payload, stream=on_delta is not None)
     except Exception as exc:
-        if os.environ.get("STACKFIX_RELAY_URL") is None:
+        if os.environ.get("STACKFIX_RELAY_URL") is not None:
+            raise
+        if not _relay_failover(cwd):
             raise RuntimeError(
                 "Relay unreachable. If running locally, set STACKFIX_RELAY_URL=http://localhost:8000/v1"
             ) from exc
-        raise
+        url = _relay_endpoint("/chat/completions")
+        _debug_log(f"Relay unreachable; switched to {url}")
+        resp = retry.post(url, headers=headers, json=payload, stream=on_delta is not None)
     if resp.status_code == 401:
         _debug_log("Relay token expired; refreshing token")
-        token, _ = _request_relay_token(cwd)
+        token, _ = _request_relay_token(cwd, stale=token)
         headers["Authorization"] = f"Bearer {token}"
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
+        resp.close()
+        resp = retry.post(url, headers=headers, json=payload, stream=on_delta is not None)
     _debug_log(f"HTTP status: {resp.status_code}")
     resp.raise_for_status()
-    raw_text = resp.text
-    _debug_log(f"Raw response (first 500 chars): { _redact_secrets(raw_text[:500]) }")
-    data = resp.json()
-    content = _extract_content(data)
-    return _parse_agent_response(content)
+    data, streamed = _read_completion(resp, on_delta)
+    return _finish_completion(data, streamed, on_delta)
 
 
-def _call_modal(endpoint: str, context: Dict[str, Any], system_prompt: str = SYSTEM_PROMPT) -> Dict[str, Any]:
+def _call_modal(
+    endpoint: str,
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Any]:
     payload = _model_request_payload(context, system_prompt=system_prompt)
-    resp = requests.post(endpoint, json=payload, timeout=60)
+    if on_delta is not None:
+        payload["stream"] = True
+    resp = retry.post(endpoint, json=payload, stream=on_delta is not None)
     _debug_log(f"HTTP status: {resp.status_code}")
     resp.raise_for_status()
-    raw_text = resp.text
-    _debug_log(f"Raw response (first 500 chars): { _redact_secrets(raw_text[:500]) }")
-    data = resp.json()
-    content = data.get("content") or data.get("response") or data
-    if isinstance(content, dict):
-        return _validate_agent_json(content)
-    return _parse_agent_response(content)
+    data, streamed = _read_completion(resp, on_delta)
+    return _finish_modal(data, streamed, on_delta)
 
 
 def _parse_agent_response(content: str) -> Dict[str, Any]:
@@ -245,52 +684,48 @@ def _parse_agent_response(content: str) -> Dict[str, Any]:
     try:
         parsed = json.loads(content)
     except Exception:
-        warning = "Agent response was not valid JSON; falling back to raw content"
-        return _fallback_response(content, warning)
+        parsed = _extract_json_object(content)
+        if parsed is None:
+            warning = "Agent response was not valid JSON; falling back to raw content"
+            return _fallback_response(content, warning)
+        _debug_log("Extracted the agent JSON object from surrounding text")
+        result = _validate_agent_json(parsed, raw_content=content)
+        result["_extracted"] = True
+        return result
     return _validate_agent_json(parsed, raw_content=content)
 
 
-def _extract_content(data: Dict[str, Any]) -> str:
-    def _get(obj, key, default=None):
-        if isinstance(obj, dict):
-            return obj.get(key, default)
-        return getattr(obj, key, default)
-
-    choices = _get(data, "choices")
-    if isinstance(choices, list) and choices:
-        choice = choices[0]
-        message = _get(choice, "message")
-        if message is not None:
-            content = _get(message, "content")
-            if isinstance(content, list):
-                parts = []
-                for part in content:
-                    if isinstance(part, dict) and "text" in part:
-                        parts.append(part["text"])
-                if parts:
-                    _debug_log("Parsed content from message.content list")
-                    return "".join(parts)
-            if content is not None and content.strip():
-                _debug_log("Parsed content from message.content")
-                return content
-            # Check for reasoning_content (used by some models like Nebius)
-            reasoning_content = _get(message, "reasoning_content")
-            if reasoning_content is not None and str(reasoning_content).strip():
-                _debug_log("Parsed content from message.reasoning_content")
-                return str(reasoning_content)
-            tool_calls = _get(message, "tool_calls")
-            if isinstance(tool_calls, list) and tool_calls:
-                fn = _get(tool_calls[0], "function", {})
-                args = _get(fn, "arguments")
-                if args:
-                    _debug_log("Parsed content from message.tool_calls.function.arguments")
-                    return args
-        text = _get(choice, "text")
-        if text is not None:
-            _debug_log("Parsed content from choice.text")
-            return text
-    keys = list(data.keys()) if isinstance(data, dict) else dir(data)
-    raise RuntimeError(f"Agent returned no content to parse; top-level keys: {keys}")
+def _extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """The outermost agent JSON object in text wrapped in code fences, prose or trailing notes.
+
+    Raw newlines inside strings are accepted. Objects without any agent key are
+    skipped, so a JSON example in a preamble or a prompt-mode answer is not
+    mistaken for the reply.
+    """
+    decoder = json.JSONDecoder(strict=False)
+    start = text.find("{")
+    while start != -1:
+        try:
+            value, end = decoder.raw_decode(text, start)
+        except ValueError:
+            start = text.find("{", start + 1)
+            continue
+        if isinstance(value, dict) and AGENT_RESPONSE_KEYS & value.keys():
+            return value
+        # Objects nested in one that is not the reply are not the reply either.
+        start = text.find("{", end)
+    return None
+
+
+def _extract_content(data: Dict[str, Any], endpoint: Optional[capabilities.Endpoint] = None) -> str:
+    shape, content = capabilities.extract_content(data, endpoint.content_shape if endpoint else None)
+    if shape is None:
+        keys = list(data.keys()) if isinstance(data, dict) else dir(data)
+        raise RuntimeError(f"Agent returned no content to parse; top-level keys: {keys}")
+    _debug_log(f"Parsed content from {shape}")
+    if endpoint is not None:
+        endpoint.seen(shape)
+    return content
 
 
 def _normalize_rerun_command(value: Any) -> list:
@@ -347,7 +782,7 @@ def _validate_agent_json(parsed: Dict[str, Any], raw_content: Optional[str] = No
     rerun = _normalize_rerun_command(parsed.get("rerun_command"))
     confidence = _coerce_confidence(parsed.get("confidence"))
 
-    return {
+    result = {
         "summary": summary,
         "confidence": confidence,
         "patch_unified_diff": patch,
@@ -355,6 +790,9 @@ def _validate_agent_json(parsed: Dict[str, Any], raw_content: Optional[str] = No
         "_raw_content": raw_content,
         "_warning": None,
     }
+    if isinstance(parsed.get("edits"), list):
+        result["edits"] = parsed["edits"]
+    return result
 
 
 def _is_valid_unified_diff(diff_text: str) -> bool:
@@ -379,40 +817,950 @@ def _is_valid_hunk_header(line: str) -> bool:
     return re.match(r"^@@ -\d+(,\d+)? \+\d+(,\d+)? @@", line) is not None
 
 
-def call_agent(context: Dict[str, Any]) -> Dict[str, Any]:
+class _StreamAborted(Exception):
+    """Raised from a stream callback to stop reading once the patch is known to be invalid."""
+
+    def __init__(self, fields: Dict[str, str]) -> None:
+        super().__init__("stream aborted after invalid patch")
+        self.fields = fields
+
+
+def _select_provider() -> Tuple[str, Optional[str]]:
     endpoint = os.environ.get("STACKFIX_ENDPOINT")
     provider = os.environ.get("STACKFIX_PROVIDER")
-    use_direct = os.environ.get("STACKFIX_USE_DIRECT") == "1"
     if endpoint:
-        result = _call_modal(endpoint, context)
-    elif provider == "direct" or use_direct:
-        result = _call_direct(context)
-    elif provider == "stackfix":
-        result = _call_relay(context)
+        return "modal", endpoint
+    if provider == "direct" or os.environ.get("STACKFIX_USE_DIRECT") == "1":
+        return "direct", None
+    if provider == "stackfix":
+        return "relay", None
+    if os.environ.get("MODEL_API_KEY"):
+        return "direct", None
+    return "relay", None
+
+
+class _PatchRepairer:
+    """Local diff repair, memoized so the stream check and call_agent share one dry run."""
+
+    def __init__(self, cwd: str) -> None:
+        self.cwd = cwd
+        self._results: Dict[str, Optional[str]] = {}
+
+    def __call__(self, patch: str) -> Optional[str]:
+        if patch in self._results:
+            return self._results[patch]
+        repaired = None
+        if patch.strip():
+            try:
+                repaired = repair_unified_diff(patch, self.cwd)
+            except Exception as exc:
+                _debug_log(f"Local diff repair failed: {exc}")
+            stats.record(self.cwd, "diff_repair", "attempts")
+            stats.record(self.cwd, "diff_repair", "repaired" if repaired else "failed")
+        self._results[patch] = repaired
+        return repaired
+
+
+class _StreamHandler:
+    """on_delta for a streamed fix: renders events and checks the patch as soon as its field closes.
+
+    With offload, a repair needed by that check runs in a worker thread instead of
+    on the event loop reading the stream. Its outcome is reported when it
+    finishes, an abort takes effect at the next chunk, and settle() waits for it.
+    """
+
+    def __init__(
+        self,
+        on_stream: StreamCallback,
+        check_patch: bool,
+        abort_invalid: bool,
+        repair: Optional[_PatchRepairer] = None,
+        offload: bool = False,
+    ) -> None:
+        self.on_stream = on_stream
+        self.check_patch = check_patch
+        self.abort_invalid = abort_invalid
+        self.repair = repair
+        self.offload = offload
+        self.parser = streaming.JSONFieldStream(streaming.STREAM_FIELDS, self._on_field)
+        self._pending: Optional["asyncio.Future"] = None
+        self._abort = False
+
+    def __call__(self, text: str) -> None:
+        if self._abort:
+            raise _StreamAborted(dict(self.parser.values))
+        self.on_stream("text", None, text)
+        self.parser.feed(text)
+
+    def _on_field(self, event: str, field: Optional[str], text: str) -> None:
+        self.on_stream(event, field, text)
+        if event != "field_done" or field != "patch_unified_diff" or not self.check_patch:
+            return
+        if _is_valid_unified_diff(text):
+            self.on_stream("patch_valid", field, "")
+            return
+        if self.repair is not None and self.offload:
+            self._pending = asyncio.get_running_loop().run_in_executor(None, self.repair, text)
+            self._pending.add_done_callback(lambda done: self._repaired(field, done))
+            return
+        repaired = self.repair(text) if self.repair is not None else None
+        if self._report(field, repaired):
+            raise _StreamAborted(dict(self.parser.values))
+
+    def _repaired(self, field: Optional[str], done: "asyncio.Future") -> None:
+        if not done.cancelled() and done.exception() is None:
+            self._abort = self._report(field, done.result())
+
+    def _report(self, field: Optional[str], repaired: Optional[str]) -> bool:
+        """Send the outcome of a repair; True when the stream should stop."""
+        if repaired is not None:
+            self.on_stream("patch_repaired", field, repaired)
+            return False
+        self.on_stream("patch_invalid", field, "")
+        return self.abort_invalid
+
+    async def settle(self) -> None:
+        if self._pending is not None:
+            await asyncio.wait([self._pending])
+
+
+class _FirstTokenTimer:
+    """Measures time from the request to the first streamed token."""
+
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.first_token: Optional[float] = None
+
+    def wrap(self, on_delta: Callable[[str], None]) -> Callable[[str], None]:
+        def _timed(text: str) -> None:
+            if self.first_token is None:
+                self.first_token = time.monotonic() - self.started
+            on_delta(text)
+
+        return _timed
+
+
+def _cached_prompt_tokens(usage: Dict[str, Any]) -> int:
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens") if isinstance(details, dict) else None
+    if cached is None:
+        cached = usage.get("prompt_cache_hit_tokens", 0)
+    try:
+        return int(cached or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _record_usage(context: Dict[str, Any], result: Dict[str, Any], timing: _FirstTokenTimer) -> None:
+    cwd = context.get("cwd") or os.getcwd()
+    recovered = {}
+    if result.get("_extracted"):
+        recovered["json_extracted"] = 1
+    if result.get("_continuations"):
+        recovered.update({"continued": 1, "continuation_requests": result["_continuations"]})
+    if recovered:
+        stats.record_counts(cwd, "responses", recovered)
+    usage = result.get("_usage")
+    if isinstance(usage, dict):
+        stats.record_counts(
+            cwd,
+            "prompt_cache",
+            {
+                "requests": 1,
+                "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+                "cached_tokens": _cached_prompt_tokens(usage),
+            },
+        )
+    if timing.first_token is not None:
+        stats.record_counts(cwd, "first_token", {"streams": 1, "seconds_total": timing.first_token})
+
+
+def _call_provider(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_stream: Optional[StreamCallback] = None,
+    check_patch: bool = False,
+    abort_invalid: bool = False,
+    repair: Optional[_PatchRepairer] = None,
+) -> Dict[str, Any]:
+    kind, endpoint = _select_provider()
+    on_delta = None
+    timing = _FirstTokenTimer()
+    if on_stream is not None:
+        on_delta = timing.wrap(_StreamHandler(on_stream, check_patch, abort_invalid, repair))
+    try:
+        result = _call_kind(kind, endpoint, context, system_prompt, on_delta)
+    except _StreamAborted as aborted:
+        _debug_log("Patch field closed with an invalid diff; stopped reading the stream")
+        result = _validate_agent_json(aborted.fields)
+    _record_usage(context, result, timing)
+    return result
+
+
+def _max_continuations() -> int:
+    try:
+        return max(int(os.environ.get("STACKFIX_MAX_CONTINUATIONS", DEFAULT_MAX_CONTINUATIONS)), 0)
+    except ValueError:
+        return DEFAULT_MAX_CONTINUATIONS
+
+
+def _needs_continuation(result: Dict[str, Any]) -> bool:
+    """The reply stopped at max_tokens before it could be parsed."""
+    return (
+        result.get("_finish_reason") == "length"
+        and result.get("_warning") is not None
+        and bool(result.get("_raw_content"))
+    )
+
+
+def _continuation_overlap(partial: str, more: str) -> int:
+    """Length of the start of more that repeats the end of partial."""
+    for size in range(min(len(partial), len(more), MAX_CONTINUATION_OVERLAP), MIN_CONTINUATION_OVERLAP - 1, -1):
+        if partial.endswith(more[:size]):
+            return size
+    return 0
+
+
+def _add_usage(first: Any, second: Any) -> Any:
+    if not isinstance(first, dict):
+        return second
+    if not isinstance(second, dict):
+        return first
+    total = dict(first)
+    for key, value in second.items():
+        if isinstance(value, (int, float)) and isinstance(total.get(key), (int, float)):
+            total[key] += value
+    return total
+
+
+def _join_continuation(
+    result: Dict[str, Any], more: Dict[str, Any], on_delta: Optional[Callable[[str], None]]
+) -> Optional[Dict[str, Any]]:
+    """result's text followed by the continuation in more, parsed again; None if nothing was added."""
+    partial = result["_raw_content"]
+    extra = more.get("_raw_content") or ""
+    extra = extra[_continuation_overlap(partial, extra):]
+    if not extra.strip():
+        return None
+    # The continuation is read whole, so the stream gets it as one delta after the overlap is dropped.
+    if on_delta is not None:
+        on_delta(extra)
+    joined = _parse_agent_response(partial + extra)
+    joined["_finish_reason"] = more.get("_finish_reason")
+    joined["_continuations"] = result.get("_continuations", 0) + 1
+    usage = _add_usage(result.get("_usage"), more.get("_usage"))
+    if usage is not None:
+        joined["_usage"] = usage
+    return joined
+
+
+def _call_kind(
+    kind: str,
+    endpoint: Optional[str],
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+) -> Dict[str, Any]:
+    """One provider call, resumed with continuation requests while the reply is cut off."""
+    result = _call_kind_once(kind, endpoint, context, system_prompt, on_delta)
+    for _ in range(_max_continuations()):
+        if not _needs_continuation(result):
+            break
+        _debug_log("Response stopped at the token limit; asking the model to continue")
+        more = _call_kind_once(kind, endpoint, dict(context, _continuation=result["_raw_content"]), system_prompt, None)
+        joined = _join_continuation(result, more, on_delta)
+        if joined is None:
+            break
+        result = joined
+    return result
+
+
+def _call_kind_once(
+    kind: str,
+    endpoint: Optional[str],
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+) -> Dict[str, Any]:
+    if kind == "modal":
+        return _call_modal(endpoint, context, system_prompt=system_prompt, on_delta=on_delta)
+    if kind == "direct":
+        return _call_direct(context, system_prompt=system_prompt, on_delta=on_delta)
+    return _call_relay(context, system_prompt=system_prompt, on_delta=on_delta)
+
+
+def _available_providers() -> List[Tuple[str, str, Optional[str]]]:
+    """(name, kind, endpoint) for every configured backend; names key the latency stats.
+
+    The public relay is only included when it is the configured provider or
+    STACKFIX_RACE_RELAY=1, so a user with their own key never has their code sent
+    to it just because racing is on.
+    """
+    providers: List[Tuple[str, str, Optional[str]]] = []
+    endpoint = os.environ.get("STACKFIX_ENDPOINT")
+    if endpoint:
+        providers.append((f"modal:{urlsplit(endpoint).hostname or endpoint}", "modal", endpoint))
+    base_url = os.environ.get("MODEL_BASE_URL")
+    if base_url and os.environ.get("MODEL_API_KEY"):
+        providers.append((f"direct:{urlsplit(base_url).hostname or base_url}", "direct", None))
+    if _select_provider()[0] == "relay" or os.environ.get("STACKFIX_RACE_RELAY") == "1":
+        providers.append(("relay", "relay", None))
+    return providers
+
+
+def warm_up(cwd: str) -> None:
+    """Get the backends ready while the failing command still runs; never raises.
+
+    Fetches the relay token, probes a direct endpoint's capabilities and opens a
+    pooled connection, so the model call can start as soon as the command exits.
+    """
+    if _race_providers_available():
+        providers = [(kind, endpoint) for _, kind, endpoint in _available_providers()]
     else:
-        if os.environ.get("MODEL_API_KEY"):
-            result = _call_direct(context)
+        providers = [_select_provider()]
+    for kind, endpoint in providers:
+        try:
+            if kind == "relay":
+                _resolve_relay(cwd)
+                _get_relay_token(cwd)
+                url = _relay_endpoint("/chat/completions")
+            elif kind == "direct":
+                url, headers = _direct_target()
+                capabilities.for_endpoint(url, headers, _model_name())
+            else:
+                url = endpoint
+            transport.warm(url)
+        except Exception as exc:
+            _debug_log(f"Warm-up for {kind} failed: {exc}")
+
+
+def _race_providers_available() -> bool:
+    return hedging.race_enabled() and len(_available_providers()) > 1
+
+
+class _RaceCancelled(Exception):
+    """Raised from a losing contender's stream callback to stop reading its response."""
+
+
+class _Contender:
+    """One provider in a race, streaming through the race's display."""
+
+    def __init__(self, race: "_Race", provider: Tuple[str, str, Optional[str]]) -> None:
+        self.name, self.kind, self.endpoint = provider
+        self.race = race
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        self.timing = _FirstTokenTimer()
+        self.handler = _StreamHandler(self._forward, race.check_patch, True, race.repair, offload=race.offload)
+        self.on_delta = self._cancellable(self.timing.wrap(self.handler))
+
+    def _forward(self, event: str, field: Optional[str], text: str) -> None:
+        self.race.forward(self, event, field, text)
+
+    def _cancellable(self, on_delta: Callable[[str], None]) -> Callable[[str], None]:
+        # Losers are always read as streams so cancelling takes effect at the next chunk.
+        def _checked(text: str) -> None:
+            if self.cancelled.is_set():
+                raise _RaceCancelled()
+            on_delta(text)
+
+        return _checked
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+
+class _Race:
+    """Hedged request: the fastest provider first, a second one after an adaptive delay.
+
+    The first result that passes JSON (and, for fixes, diff) validation wins;
+    the other request is cancelled. Only one contender's stream reaches on_stream.
+    """
+
+    def __init__(
+        self,
+        context: Dict[str, Any],
+        system_prompt: str,
+        on_stream: Optional[StreamCallback],
+        check_patch: bool,
+        repair: Optional[_PatchRepairer],
+        offload: bool = False,
+    ) -> None:
+        self.context = context
+        self.system_prompt = system_prompt
+        self.on_stream = on_stream
+        self.check_patch = check_patch
+        self.repair = repair
+        # Contenders read on an event loop; their stream repairs run in worker threads.
+        self.offload = offload
+        providers = {provider[0]: provider for provider in _available_providers()}
+        order = hedging.race_order(list(providers))
+        self.queued = [providers[name] for name in order[:2]]
+        self.delay = hedging.hedge_delay(order[0])
+        self.started = time.monotonic()
+        self.running: List[_Contender] = []
+        self._owner: Optional[_Contender] = None
+        self._lock = threading.Lock()
+        self._fallback: Optional[Dict[str, Any]] = None
+        self._error: Optional[BaseException] = None
+        _debug_log(f"Racing {' and '.join(order[:2])}; hedge after {self.delay:.1f}s")
+
+    def hedge_wait(self) -> Optional[float]:
+        """Seconds until the next provider should start, or None when none is left."""
+        if not self.queued:
+            return None
+        if not self.running:
+            return 0.0
+        return max(self.started + self.delay - time.monotonic(), 0.0)
+
+    def launch(self) -> _Contender:
+        contender = _Contender(self, self.queued.pop(0))
+        self.running.append(contender)
+        return contender
+
+    def forward(self, contender: _Contender, event: str, field: Optional[str], text: str) -> None:
+        if self.on_stream is None:
+            return
+        with self._lock:
+            if self._owner is None:
+                self._owner = contender
+            if self._owner is not contender:
+                return
+            self.on_stream(event, field, text)
+
+    def _valid(self, result: Dict[str, Any]) -> bool:
+        if not self.check_patch:
+            # Prompt mode answers in plain text; any non-empty answer will do.
+            return bool(str(result.get("summary") or "").strip())
+        if result.get("_warning"):
+            return False
+        return self.repair is None or _accept_patch(result, self.repair)
+
+    def finish(
+        self, contender: _Contender, result: Optional[Dict[str, Any]], error: Optional[BaseException]
+    ) -> bool:
+        """Record one contender's outcome; True when its result wins the race."""
+        self.running.remove(contender)
+        if result is None or not self._valid(result):
+            if error is not None:
+                _debug_log(f"{contender.name} failed in race: {error}")
+            hedging.record_latency(contender.name, contender.elapsed(), "failed")
+            if self._fallback is None:
+                self._fallback = result
+            if self._error is None:
+                self._error = error
+            # Nothing usable yet: start the next provider without waiting for the delay.
+            self.delay = 0.0
+            return False
+        for other in self.running:
+            other.cancelled.set()
+            hedging.record_latency(other.name, other.elapsed(), "lost")
+        hedging.record_latency(contender.name, contender.elapsed(), "won")
+        stats.record(self.context.get("cwd") or os.getcwd(), "race", f"{contender.kind}_wins")
+        with self._lock:
+            if self.on_stream is not None and self._owner not in (None, contender):
+                self.on_stream("retry", None, f"{contender.name} answered first; using its response")
+            self._owner = contender
+        _debug_log(f"{contender.name} won the race after {contender.elapsed():.2f}s")
+        _record_usage(self.context, result, contender.timing)
+        return True
+
+    def outcome(self) -> Dict[str, Any]:
+        """The first invalid result when nothing passed validation; re-raises if none returned."""
+        if self._fallback is not None:
+            return self._fallback
+        if self._error is not None:
+            raise self._error
+        raise RuntimeError("No provider returned a response")
+
+
+def _run_contender(contender: _Contender, race: _Race, outcomes: "queue.Queue") -> None:
+    try:
+        result = _call_kind(contender.kind, contender.endpoint, race.context, race.system_prompt, contender.on_delta)
+    except _StreamAborted as aborted:
+        result = _validate_agent_json(aborted.fields)
+    except _RaceCancelled:
+        return
+    except Exception as exc:
+        outcomes.put((contender, None, exc))
+        return
+    outcomes.put((contender, result, None))
+
+
+def _race_providers(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_stream: Optional[StreamCallback] = None,
+    check_patch: bool = False,
+    repair: Optional[_PatchRepairer] = None,
+) -> Dict[str, Any]:
+    race = _Race(context, system_prompt, on_stream, check_patch, repair)
+    outcomes: "queue.Queue" = queue.Queue()
+    while race.running or race.queued:
+        wait = race.hedge_wait()
+        if wait == 0.0:
+            contender = race.launch()
+            threading.Thread(target=_run_contender, args=(contender, race, outcomes), daemon=True).start()
+            continue
+        try:
+            contender, result, error = outcomes.get(timeout=wait)
+        except queue.Empty:
+            continue
+        if race.finish(contender, result, error):
+            return result
+    return race.outcome()
+
+
+def _cache_variant() -> str:
+    kind, endpoint = _select_provider()
+    model = os.environ.get("MODEL_NAME") or os.environ.get("STACKFIX_MODEL") or "stackfix-default"
+    prompt_hash = hashlib.sha256(_fix_system_prompt().encode("utf-8")).hexdigest()[:12]
+    return f"{kind}|{endpoint or ''}|{model}|{prompt_hash}"
+
+
+def _cache_lookup(context: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    try:
+        key = cache.fingerprint(context, _cache_variant())
+        if key is None:
+            return None, None
+        return key, cache.lookup(context.get("cwd") or os.getcwd(), key)
+    except Exception as exc:
+        _debug_log(f"Response cache lookup failed: {exc}")
+        return None, None
+
+
+def _cache_store(context: Dict[str, Any], key: Optional[str], result: Dict[str, Any]) -> None:
+    if key is None:
+        return
+    entry = {k: v for k, v in result.items() if not k.startswith("_")}
+    try:
+        cache.store(context.get("cwd") or os.getcwd(), key, entry)
+    except Exception as exc:
+        _debug_log(f"Response cache store failed: {exc}")
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def _apply_edits(result: Dict[str, Any], cwd: str) -> None:
+    """Turn search/replace edits into patch_unified_diff and count output tokens per format."""
+    if "_edit_format" in result:
+        return
+    edits = result.pop("edits", None)
+    result["_edit_format"] = "diff" if edits is None else "search_replace"
+    usage = result.get("_usage") if isinstance(result.get("_usage"), dict) else {}
+    output_tokens = usage.get("completion_tokens")
+    if output_tokens is None:
+        output_tokens = _estimate_tokens(result.get("_raw_content") or "")
+    fmt = result["_edit_format"]
+    counts = {f"{fmt}_responses": 1, f"{fmt}_output_tokens": int(output_tokens or 0)}
+    if edits is not None and not result.get("patch_unified_diff"):
+        try:
+            result["patch_unified_diff"] = search_replace_to_diff(edits, cwd)
+        except RuntimeError as exc:
+            _debug_log(f"Search/replace edits could not be placed: {exc}")
+            counts["search_replace_failed"] = 1
         else:
-            result = _call_relay(context)
+            # The diff a unified-diff answer would have had to spell out.
+            counts["search_replace_edit_tokens"] = _estimate_tokens(json.dumps(edits))
+            counts["search_replace_diff_tokens"] = _estimate_tokens(result["patch_unified_diff"])
+    stats.record_counts(cwd, "edit_format", counts)
 
+
+def _accept_patch(result: Dict[str, Any], repair: _PatchRepairer) -> bool:
+    _apply_edits(result, repair.cwd)
     patch = result.get("patch_unified_diff", "")
     if _is_valid_unified_diff(patch):
+        return True
+    repaired = repair(patch)
+    if repaired is None:
+        return False
+    _debug_log("Repaired invalid diff locally; skipping strict diff retry")
+    result["patch_unified_diff"] = repaired
+    result["_repaired"] = True
+    return True
+
+
+def _rule_result(context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if context.get("mode") == "prompt" or not rules.rules_enabled():
+        return None
+    try:
+        result = rules.match(context)
+    except Exception as exc:
+        _debug_log(f"Local rules failed: {exc}")
+        return None
+    if result is not None:
+        _debug_log(f"Local rule {result['_rule']} matched; skipping the model")
+    return result
+
+
+def call_agent(
+    context: Dict[str, Any],
+    on_stream: Optional[StreamCallback] = None,
+    use_cache: bool = True,
+) -> Dict[str, Any]:
+    """Ask the configured backend for a fix; on_stream receives incremental events."""
+    is_prompt_mode = context.get("mode") == "prompt"
+    ruled = _rule_result(context)
+    if ruled is not None:
+        return ruled
+    cache_key = None
+    if use_cache and not is_prompt_mode and cache.cache_enabled():
+        cache_key, cached = _cache_lookup(context)
+        if cached is not None:
+            _debug_log("Using cached agent response")
+            cached.update({"_raw_content": None, "_warning": None, "_cached": True})
+            return cached
+
+    race = _race_providers_available()
+    if is_prompt_mode:
+        if race:
+            return _race_providers(context, on_stream=on_stream)
+        return _call_provider(context, on_stream=on_stream)
+
+    repair = _PatchRepairer(context.get("cwd") or os.getcwd())
+    if race:
+        result = _race_providers(context, on_stream=on_stream, check_patch=True, repair=repair)
+    else:
+        result = _call_provider(context, on_stream=on_stream, check_patch=True, abort_invalid=True, repair=repair)
+    if _accept_patch(result, repair):
+        _cache_store(context, cache_key, result)
         return result
 
     _debug_log("Invalid patch format; retrying once with strict diff prompt")
-    if endpoint:
-        result = _call_modal(endpoint, context, system_prompt=STRICT_DIFF_PROMPT)
-    elif provider == "direct" or use_direct:
-        result = _call_direct(context, system_prompt=STRICT_DIFF_PROMPT)
-    elif provider == "stackfix":
-        result = _call_relay(context, system_prompt=STRICT_DIFF_PROMPT)
+    if on_stream is not None:
+        on_stream("retry", None, "Patch was not a valid unified diff; retrying with strict diff prompt")
+    result = _call_provider(
+        context, system_prompt=STRICT_DIFF_PROMPT, on_stream=on_stream, check_patch=True, repair=repair
+    )
+    if _accept_patch(result, repair):
+        _cache_store(context, cache_key, result)
+        return result
+    _debug_log("Agent returned invalid unified diff after retry; passing to fallback applier")
+    return result
+
+
+async def _apost_completion(
+    url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    on_delta: Optional[Callable[[str], None]],
+    timeout: Any,
+    allow_unauthorized: bool = False,
+) -> Optional[Tuple[Dict[str, Any], bool]]:
+    """POST on the loop's shared client; None means 401 when allow_unauthorized is set.
+
+    The response is read inside the stream context, so cancelling the calling
+    task closes it and hands the connection back to the pool.
+    """
+    client = transport.get_async_client()
+    policy = retry.RetryPolicy()
+    attempt = 1
+    while True:
+        await retry.apace(url, policy)
+        async with client.stream("POST", url, json=payload, headers=headers, timeout=timeout) as resp:
+            _debug_log(f"HTTP status: {resp.status_code}")
+            await asyncio.to_thread(retry.note_response, url, resp.status_code, resp.headers)
+            delay = policy.next_delay(attempt, resp.status_code, resp.headers)
+            if delay is None:
+                if resp.status_code == 401 and allow_unauthorized:
+                    return None
+                if resp.is_error:
+                    await resp.aread()
+                    resp.raise_for_status()
+                if on_delta is not None and "text/event-stream" in resp.headers.get("content-type", ""):
+                    return await streaming.aread_sse_completion(resp, on_delta), True
+                body = await resp.aread()
+                break
+        _debug_log(f"Retrying after HTTP {resp.status_code} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        attempt += 1
+    _debug_log(f"Raw response (first 500 chars): { _redact_secrets(body[:500].decode('utf-8', 'replace')) }")
+    return json.loads(body), False
+
+
+async def _aresolve_relay(cwd: str, force: bool = False) -> str:
+    if not force and (os.environ.get("STACKFIX_RELAY_URL") or _DISCOVERED_RELAY):
+        return _resolve_relay(cwd)
+    return await asyncio.to_thread(_resolve_relay, cwd, force)
+
+
+async def _arequest_relay_token(cwd: str, stale: Optional[str] = None) -> Tuple[str, int]:
+    # Token requests are rare and hold the cross-process file lock, so they run off-loop.
+    return await asyncio.to_thread(_request_relay_token, cwd, stale)
+
+
+async def _aget_relay_token(cwd: str) -> str:
+    token_info = get_relay_token(_relay_base_url())
+    token = token_info.get("token")
+    if token and is_token_valid(token_info.get("expires_at")):
+        if token_refresh_due(token_info):
+            _refresh_token_in_background(cwd, token)
+        return token
+    token, _ = await _arequest_relay_token(cwd)
+    return token
+
+
+async def _acall_direct(
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+    timeout: Any,
+) -> Dict[str, Any]:
+    url, headers = _direct_target()
+    _log_endpoint_once(url)
+    payload = _model_request_payload(context, system_prompt=system_prompt)
+    if on_delta is not None:
+        payload["stream"] = True
+    endpoint = await asyncio.to_thread(capabilities.for_endpoint, url, headers, payload["model"])
+    endpoint.fit(payload)
+    _apply_cache_hints(payload, url)
+    try:
+        data, streamed = await _apost_completion(url, payload, headers, on_delta, timeout)
+    except transport.httpx.HTTPStatusError as exc:
+        if exc.response.status_code in capabilities.REJECTED_STATUSES:
+            await asyncio.to_thread(endpoint.rejected)
+        raise
+    return _finish_completion(data, streamed, on_delta, endpoint)
+
+
+async def _acall_relay(
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+    timeout: Any,
+) -> Dict[str, Any]:
+    cwd = context.get("cwd") or os.getcwd()
+    payload = _model_request_payload(context, system_prompt=system_prompt)
+    if on_delta is not None:
+        payload["stream"] = True
+    await _aresolve_relay(cwd)
+    token = await _aget_relay_token(cwd)
+    url = _relay_endpoint("/chat/completions")
+    _log_endpoint_once(url)
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    try:
+        completion = await _apost_completion(url, payload, headers, on_delta, timeout, allow_unauthorized=True)
+    except transport.httpx.ConnectError as exc:
+        if os.environ.get("STACKFIX_RELAY_URL") is not None:
+            raise
+        if not await asyncio.to_thread(_relay_failover, cwd):
+            raise RuntimeError(
+                "Relay unreachable. If running locally, set STACKFIX_RELAY_URL=http://localhost:8000/v1"
+            ) from exc
+        url = _relay_endpoint("/chat/completions")
+        _debug_log(f"Relay unreachable; switched to {url}")
+        completion = await _apost_completion(url, payload, headers, on_delta, timeout, allow_unauthorized=True)
+    if completion is None:
+        _debug_log("Relay token expired; refreshing token")
+        token, _ = await _arequest_relay_token(cwd, stale=token)
+        headers["Authorization"] = f"Bearer {token}"
+        completion = await _apost_completion(url, payload, headers, on_delta, timeout)
+    data, streamed = completion
+    return _finish_completion(data, streamed, on_delta)
+
+
+async def _acall_modal(
+    endpoint: str,
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+    timeout: Any,
+) -> Dict[str, Any]:
+    payload = _model_request_payload(context, system_prompt=system_prompt)
+    if on_delta is not None:
+        payload["stream"] = True
+    data, streamed = await _apost_completion(endpoint, payload, {}, on_delta, timeout)
+    return _finish_modal(data, streamed, on_delta)
+
+
+async def _acall_provider(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_stream: Optional[StreamCallback] = None,
+    check_patch: bool = False,
+    abort_invalid: bool = False,
+    repair: Optional[_PatchRepairer] = None,
+    timeout: Any = None,
+) -> Dict[str, Any]:
+    kind, endpoint = _select_provider()
+    on_delta = handler = None
+    timing = _FirstTokenTimer()
+    if on_stream is not None:
+        handler = _StreamHandler(on_stream, check_patch, abort_invalid, repair, offload=True)
+        on_delta = timing.wrap(handler)
+    try:
+        result = await _acall_kind(kind, endpoint, context, system_prompt, on_delta, timeout)
+    except _StreamAborted as aborted:
+        _debug_log("Patch field closed with an invalid diff; stopped reading the stream")
+        result = _validate_agent_json(aborted.fields)
+    if handler is not None:
+        await handler.settle()
+    await asyncio.to_thread(_record_usage, context, result, timing)
+    return result
+
+
+async def _acall_kind(
+    kind: str,
+    endpoint: Optional[str],
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+    timeout: Any,
+) -> Dict[str, Any]:
+    result = await _acall_kind_once(kind, endpoint, context, system_prompt, on_delta, timeout)
+    for _ in range(_max_continuations()):
+        if not _needs_continuation(result):
+            break
+        _debug_log("Response stopped at the token limit; asking the model to continue")
+        more = await _acall_kind_once(
+            kind, endpoint, dict(context, _continuation=result["_raw_content"]), system_prompt, None, timeout
+        )
+        joined = _join_continuation(result, more, on_delta)
+        if joined is None:
+            break
+        result = joined
+    return result
+
+
+async def _acall_kind_once(
+    kind: str,
+    endpoint: Optional[str],
+    context: Dict[str, Any],
+    system_prompt: str,
+    on_delta: Optional[Callable[[str], None]],
+    timeout: Any,
+) -> Dict[str, Any]:
+    if kind == "modal":
+        return await _acall_modal(endpoint, context, system_prompt, on_delta, timeout)
+    if kind == "direct":
+        return await _acall_direct(context, system_prompt, on_delta, timeout)
+    return await _acall_relay(context, system_prompt, on_delta, timeout)
+
+
+async def _arun_contender(contender: _Contender, race: _Race, timeout: Any) -> Tuple[Optional[Dict[str, Any]], Any]:
+    try:
+        result = await _acall_kind(
+            contender.kind, contender.endpoint, race.context, race.system_prompt, contender.on_delta, timeout
+        )
+    except _StreamAborted as aborted:
+        result = _validate_agent_json(aborted.fields)
+    except Exception as exc:
+        return None, exc
+    await contender.handler.settle()
+    return result, None
+
+
+async def _arace_providers(
+    context: Dict[str, Any],
+    system_prompt: str = SYSTEM_PROMPT,
+    on_stream: Optional[StreamCallback] = None,
+    check_patch: bool = False,
+    repair: Optional[_PatchRepairer] = None,
+    timeout: Any = None,
+) -> Dict[str, Any]:
+    # Reads the latency history, and finish() validates and records results; both touch files.
+    race = await asyncio.to_thread(_Race, context, system_prompt, on_stream, check_patch, repair, True)
+    tasks: Dict[asyncio.Task, _Contender] = {}
+    try:
+        while tasks or race.queued:
+            wait = race.hedge_wait()
+            if wait == 0.0:
+                contender = race.launch()
+                tasks[asyncio.ensure_future(_arun_contender(contender, race, timeout))] = contender
+                continue
+            done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                contender = tasks.pop(task)
+                result, error = task.result()
+                if await asyncio.to_thread(race.finish, contender, result, error):
+                    return result
+        return race.outcome()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _call_agent_async(
+    context: Dict[str, Any],
+    on_stream: Optional[StreamCallback],
+    use_cache: bool,
+    timeout: Any,
+) -> Dict[str, Any]:
+    is_prompt_mode = context.get("mode") == "prompt"
+    ruled = await asyncio.to_thread(_rule_result, context)
+    if ruled is not None:
+        return ruled
+    cache_key = None
+    if use_cache and not is_prompt_mode and cache.cache_enabled():
+        cache_key, cached = await asyncio.to_thread(_cache_lookup, context)
+        if cached is not None:
+            _debug_log("Using cached agent response")
+            cached.update({"_raw_content": None, "_warning": None, "_cached": True})
+            return cached
+
+    race = _race_providers_available()
+    if is_prompt_mode:
+        if race:
+            return await _arace_providers(context, on_stream=on_stream, timeout=timeout)
+        return await _acall_provider(context, on_stream=on_stream, timeout=timeout)
+
+    repair = _PatchRepairer(context.get("cwd") or os.getcwd())
+    if race:
+        result = await _arace_providers(
+            context, on_stream=on_stream, check_patch=True, repair=repair, timeout=timeout
+        )
     else:
-        if os.environ.get("MODEL_API_KEY"):
-            result = _call_direct(context, system_prompt=STRICT_DIFF_PROMPT)
-        else:
-            result = _call_relay(context, system_prompt=STRICT_DIFF_PROMPT)
-    patch = result.get("patch_unified_diff", "")
-    if _is_valid_unified_diff(patch):
+        result = await _acall_provider(
+            context, on_stream=on_stream, check_patch=True, abort_invalid=True, repair=repair, timeout=timeout
+        )
+    if await asyncio.to_thread(_accept_patch, result, repair):
+        await asyncio.to_thread(_cache_store, context, cache_key, result)
+        return result
+
+    _debug_log("Invalid patch format; retrying once with strict diff prompt")
+    if on_stream is not None:
+        on_stream("retry", None, "Patch was not a valid unified diff; retrying with strict diff prompt")
+    result = await _acall_provider(
+        context,
+        system_prompt=STRICT_DIFF_PROMPT,
+        on_stream=on_stream,
+        check_patch=True,
+        repair=repair,
+        timeout=timeout,
+    )
+    if await asyncio.to_thread(_accept_patch, result, repair):
+        await asyncio.to_thread(_cache_store, context, cache_key, result)
         return result
     _debug_log("Agent returned invalid unified diff after retry; passing to fallback applier")
     return result
+
+
+async def call_agent_async(
+    context: Dict[str, Any],
+    on_stream: Optional[StreamCallback] = None,
+    use_cache: bool = True,
+    timeout: Any = None,
+    deadline: Optional[float] = None,
+) -> Dict[str, Any]:
+    """call_agent for asyncio callers; many calls can share one event loop.
+
+    timeout is an httpx.Timeout (or seconds) applied to each request phase;
+    deadline bounds the whole call, strict-diff retry included. Cancelling the
+    awaiting task closes the in-flight response and frees its connection.
+    """
+    if not transport.async_available():
+        raise RuntimeError("call_agent_async needs httpx; install stackfix[async]")
+    if timeout is None:
+        timeout = transport.async_timeout()
+    call = _call_agent_async(context, on_stream, use_cache, timeout)
+    if deadline is None:
+        return await call
+    try:
+        return await asyncio.wait_for(call, deadline)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Agent call exceeded its {deadline:g}s deadline") from None
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+from typing import Any, Dict, List, Optional
+
+from .util import is_git_repo
+
+CACHE_DIR = ".stackfix/cache"
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+OUTPUT_TAIL_CHARS = 4000
+# As context._STATUS_ARGS, with -z so no path is quoted and every untracked file listed.
+_UNTRACKED_STATUS_ARGS = ["status", "--porcelain", "-z", "--untracked-files=all", "--", ".", ":(exclude).stackfix"]
+
+# Output fragments that change between otherwise identical runs.
+_VOLATILE_PATTERNS = [
+    (re.compile(r"\x1b\[[0-9;?]*[A-Za-z]"), ""),
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?Z?"), "<time>"),
+    (re.compile(r"\b\d{1,2}:\d{2}:\d{2}(\.\d+)?\b"), "<time>"),
+    (re.compile(r"\b\d+(\.\d+)?\s?(ms|s|sec|seconds)\b"), "<duration>"),
+    (re.compile(r"0x[0-9a-fA-F]{6,}"), "0x<addr>"),
+    (re.compile(r"/tmp/[^\s:'\"]+"), "/tmp/<path>"),
+    (re.compile(r"\b(pid|PID)[ =:]\d+"), r"\1=<pid>"),
+]
+
+
+def cache_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_CACHE") != "1"
+
+
+def _max_bytes() -> int:
+    try:
+        return int(os.environ.get("STACKFIX_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+    except ValueError:
+        return DEFAULT_MAX_BYTES
+
+
+def _ttl_seconds() -> int:
+    try:
+        return int(os.environ.get("STACKFIX_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+    except ValueError:
+        return DEFAULT_TTL_SECONDS
+
+
+def normalize_output(text: str, tail_chars: int = OUTPUT_TAIL_CHARS) -> str:
+    text = (text or "")[-tail_chars:]
+    for pattern, repl in _VOLATILE_PATTERNS:
+        text = pattern.sub(repl, text)
+    return "\n".join(line.rstrip() for line in text.splitlines())
+
+
+def _git_output(cwd: str, args: List[str]) -> str:
+    try:
+        return subprocess.check_output(["git", *args], cwd=cwd, text=True, stderr=subprocess.DEVNULL)
+    except Exception:
+        return ""
+
+
+def _git_diff_hash(cwd: str) -> str:
+    digest = hashlib.sha256()
+    try:
+        proc = subprocess.Popen(
+            ["git", "diff", "HEAD", "--binary"],
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except Exception:
+        return ""
+    for block in iter(lambda: proc.stdout.read(65536), b""):
+        digest.update(block)
+    proc.stdout.close()
+    proc.wait()
+    return digest.hexdigest()
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                digest.update(block)
+    except OSError:
+        return ""
+    return digest.hexdigest()
+
+
+def _untracked_stats(cwd: str) -> List[str]:
+    """Size and mtime of every untracked file under cwd.
+
+    Each file is listed on its own, so an edit inside an untracked directory
+    changes the key. StackFix's own state directory is left out; it is rewritten
+    on every call and would otherwise make each key unique.
+    """
+    status = _git_output(cwd, _UNTRACKED_STATUS_ARGS)
+    stats = []
+    for entry in status.split("\0"):
+        if not entry.startswith("?? "):
+            continue
+        rel = entry[3:]
+        try:
+            st = os.stat(os.path.join(cwd, rel))
+        except OSError:
+            continue
+        stats.append(f"{rel}:{st.st_size}:{st.st_mtime_ns}")
+    return sorted(stats)
+
+
+def fingerprint(context: Dict[str, Any], variant: str = "") -> Optional[str]:
+    """Key for a failure: command, output tail, HEAD, working-tree diff and manifests.
+
+    Returns None outside git repositories, where source edits cannot be detected cheaply.
+    """
+    cwd = context.get("cwd") or os.getcwd()
+    if not is_git_repo(cwd):
+        return None
+    manifests = {
+        name: _file_hash(os.path.join(cwd, name)) for name in sorted(context.get("manifests") or {})
+    }
+    parts = {
+        "variant": variant,
+        "command": context.get("command"),
+        "exit_code": context.get("exit_code"),
+        "stdout": normalize_output(context.get("stdout", "")),
+        "stderr": normalize_output(context.get("stderr", "")),
+        "head": _git_output(cwd, ["rev-parse", "HEAD"]).strip(),
+        "diff": _git_diff_hash(cwd),
+        "untracked": _untracked_stats(cwd),
+        "manifests": manifests,
+    }
+    raw = json.dumps(parts, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cache_dir(cwd: str) -> str:
+    return os.path.join(cwd, CACHE_DIR)
+
+
+def lookup(cwd: str, key: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(_cache_dir(cwd), f"{key}.json")
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    if age > _ttl_seconds():
+        _remove(path)
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except Exception:
+        _remove(path)
+        return None
+    os.utime(path, None)
+    result = entry.get("result")
+    return result if isinstance(result, dict) else None
+
+
+def store(cwd: str, key: str, result: Dict[str, Any]) -> None:
+    directory = _cache_dir(cwd)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    entry = {"created_at": int(time.time()), "result": result}
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+    evict(cwd)
+
+
+def evict(cwd: str) -> None:
+    directory = _cache_dir(cwd)
+    try:
+        names = [n for n in os.listdir(directory) if n.endswith(".json")]
+    except OSError:
+        return
+    now = time.time()
+    ttl = _ttl_seconds()
+    entries = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if now - st.st_mtime > ttl:
+            _remove(path)
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    limit = _max_bytes()
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        _remove(path)
+        total -= size
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
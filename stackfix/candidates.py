@@ -0,0 +1,232 @@
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .agent import call_agent
+from .patching import apply_patch
+from .util import is_git_repo
+
+DEFAULT_VERIFY_TIMEOUT = 600
+# Ignored dependency trees that a fresh worktree lacks; linked back in so the
+# rerun command can find its packages.
+SHARED_DEPENDENCY_DIRS = ["node_modules", ".venv", "venv"]
+
+CANDIDATE_HINTS = [
+    "",
+    "Propose a different fix than the most obvious one; consider whether the test or the code is wrong.",
+    "Propose the smallest possible change, touching as few lines as you can.",
+    "Look for the root cause one level deeper than the line in the traceback.",
+]
+
+_WORKSPACE_LOCK = threading.Lock()
+
+
+def _candidate_context(context: Dict[str, Any], index: int, total: int) -> Dict[str, Any]:
+    variant = dict(context)
+    hint = CANDIDATE_HINTS[index % len(CANDIDATE_HINTS)]
+    if hint:
+        variant["candidate_hint"] = f"Candidate {index + 1} of {total}. {hint}"
+    variant["_temperature"] = min(0.2 + 0.25 * index, 1.0)
+    return variant
+
+
+def _git(args: List[str], cwd: str, input_text: Optional[str] = None) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        input=input_text,
+        text=True,
+        capture_output=True,
+        check=True,
+    )
+
+
+def _make_workspace(cwd: str) -> Tuple[str, Callable[[], None]]:
+    """Throwaway copy of cwd: a detached git worktree with the current changes, or a plain copy."""
+    tmp_root = tempfile.mkdtemp(prefix="stackfix-candidate-")
+    path = os.path.join(tmp_root, "tree")
+    if not is_git_repo(cwd):
+        shutil.copytree(cwd, path, symlinks=True, ignore=shutil.ignore_patterns(".stackfix"))
+        return path, lambda: shutil.rmtree(tmp_root, ignore_errors=True)
+
+    _git(["worktree", "add", "--detach", "--quiet", path, "HEAD"], cwd)
+
+    def _cleanup() -> None:
+        subprocess.run(["git", "worktree", "remove", "--force", path], cwd=cwd, capture_output=True)
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+    try:
+        diff = _git(["diff", "HEAD", "--binary"], cwd).stdout
+        if diff:
+            _git(["apply", "--binary", "--whitespace=nowarn", "-"], path, input_text=diff)
+        untracked = _git(["ls-files", "--others", "--exclude-standard", "-z"], cwd).stdout
+        for rel in filter(None, untracked.split("\0")):
+            target = os.path.join(path, rel)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(os.path.join(cwd, rel), target, follow_symlinks=False)
+        for name in SHARED_DEPENDENCY_DIRS:
+            source = os.path.join(cwd, name)
+            if os.path.isdir(source) and not os.path.exists(os.path.join(path, name)):
+                os.symlink(source, os.path.join(path, name))
+    except Exception:
+        _cleanup()
+        raise
+    return path, _cleanup
+
+
+def _verify_command(agent_result: Dict[str, Any], command: List[str]) -> List[str]:
+    # Verification runs before the user has approved anything, so a model-suggested
+    # rerun command is only used when it invokes the same program as the original.
+    rerun = agent_result.get("rerun_command") or []
+    if rerun and command and rerun[0] == command[0]:
+        return rerun
+    return command
+
+
+def _run_until(cmd: List[str], cwd: str, stop: threading.Event, timeout: float) -> Tuple[Optional[int], str, str]:
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            out, err = proc.communicate(timeout=0.2)
+            return proc.returncode, out, err
+        except subprocess.TimeoutExpired:
+            if stop.is_set() or time.monotonic() > deadline:
+                proc.kill()
+                out, err = proc.communicate()
+                return None, out, err
+
+
+def _evaluate(
+    index: int,
+    context: Dict[str, Any],
+    total: int,
+    command: List[str],
+    cwd: str,
+    verify_slots: threading.Semaphore,
+    stop: threading.Event,
+    verifying: Set[int],
+    agent_call: Callable[..., Dict[str, Any]],
+) -> Dict[str, Any]:
+    started = time.monotonic()
+    outcome: Dict[str, Any] = {"index": index, "passed": False, "exit_code": None, "error": None}
+    try:
+        agent_result = agent_call(_candidate_context(context, index, total), use_cache=False)
+    except Exception as exc:
+        outcome.update(error=f"Agent call failed: {exc}", elapsed=time.monotonic() - started)
+        return outcome
+    outcome["agent_result"] = agent_result
+    if stop.is_set():
+        outcome.update(error="Skipped; another candidate passed", elapsed=time.monotonic() - started)
+        return outcome
+    patch = agent_result.get("patch_unified_diff", "")
+    fix_command = agent_result.get("_fix_command") or []
+    if not patch.strip() and fix_command:
+        # A command such as an install changes more than the worktree, so it is
+        # not run before approval; it is offered like a passing patch.
+        outcome.update(fix_command=fix_command, verify_command=command, elapsed=time.monotonic() - started)
+        return outcome
+    if not patch.strip():
+        outcome.update(error="No patch provided", elapsed=time.monotonic() - started)
+        return outcome
+    verify_cmd = _verify_command(agent_result, command)
+    outcome["verify_command"] = verify_cmd
+    with verify_slots:
+        # Registered before the stop check, so run_candidates waits for this
+        # workspace to be removed if it is created at all.
+        with _WORKSPACE_LOCK:
+            verifying.add(index)
+        try:
+            if stop.is_set():
+                outcome.update(error="Skipped; another candidate passed", elapsed=time.monotonic() - started)
+                return outcome
+            try:
+                with _WORKSPACE_LOCK:
+                    workspace, cleanup = _make_workspace(cwd)
+            except Exception as exc:
+                outcome.update(error=f"Could not create workspace: {exc}", elapsed=time.monotonic() - started)
+                return outcome
+            try:
+                apply_patch(patch, workspace)
+                timeout = float(os.environ.get("STACKFIX_CANDIDATE_TIMEOUT", DEFAULT_VERIFY_TIMEOUT))
+                exit_code, out, err = _run_until(verify_cmd, workspace, stop, timeout)
+            except Exception as exc:
+                outcome.update(error=f"Verification failed: {exc}", elapsed=time.monotonic() - started)
+                return outcome
+            finally:
+                cleanup()
+        finally:
+            with _WORKSPACE_LOCK:
+                verifying.discard(index)
+    outcome.update(
+        passed=exit_code == 0,
+        exit_code=exit_code,
+        stdout=out,
+        stderr=err,
+        elapsed=time.monotonic() - started,
+    )
+    return outcome
+
+
+def run_candidates(
+    context: Dict[str, Any],
+    command: List[str],
+    count: int,
+    cwd: str,
+    workers: Optional[int] = None,
+    agent_call: Callable[..., Dict[str, Any]] = call_agent,
+    on_outcome: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Generate count patches concurrently and verify each in an isolated copy of cwd.
+
+    Returns the first outcome whose verification passed, or that proposes a fix
+    command instead of a patch (or None), and every outcome that finished.
+    Verification runs are bounded by workers. Candidates run on daemon threads:
+    once there is a winner, the caller and the process do not wait for the
+    model calls that are still running, only for verification runs to stop and
+    remove their workspaces.
+    """
+    if workers is None:
+        workers = int(os.environ.get("STACKFIX_CANDIDATE_WORKERS", min(count, os.cpu_count() or 2)))
+    verify_slots = threading.Semaphore(max(workers, 1))
+    stop = threading.Event()
+    verifying: Set[int] = set()
+    finished: "queue.Queue" = queue.Queue()
+
+    def _run(index: int) -> None:
+        try:
+            outcome = _evaluate(index, context, count, command, cwd, verify_slots, stop, verifying, agent_call)
+        except Exception as exc:
+            outcome = {"index": index, "passed": False, "exit_code": None, "error": f"Candidate failed: {exc}"}
+        finished.put(outcome)
+
+    threads = [
+        threading.Thread(target=_run, args=(i,), name=f"stackfix-candidate-{i}", daemon=True) for i in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    outcomes: List[Dict[str, Any]] = []
+    winner = None
+    try:
+        for _ in range(count):
+            outcome = finished.get()
+            outcomes.append(outcome)
+            if on_outcome is not None:
+                on_outcome(outcome)
+            if outcome["passed"] or outcome.get("fix_command"):
+                winner = outcome
+                break
+    finally:
+        # Verification runs see the stop flag and kill their command within a
+        # poll interval; their workspaces are removed before returning.
+        stop.set()
+        with _WORKSPACE_LOCK:
+            busy = sorted(verifying)
+        for index in busy:
+            threads[index].join()
+    return winner, sorted(outcomes, key=lambda o: o["index"])
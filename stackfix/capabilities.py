@@ -0,0 +1,225 @@
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import streaming, transport
+from .config import load_user_state, save_user_state, user_lock
+
+CAPABILITIES_FILE = "capabilities.json"
+DEFAULT_CAPABILITY_TTL_SECONDS = 7 * 24 * 3600
+PROBE_TIMEOUT = 15.0
+PROBE_MAX_TOKENS = 16
+# What is assumed for an endpoint that has not been probed.
+DEFAULT_CAPABILITIES = {"response_format": True, "stream": True, "content_shape": None}
+
+# (response_format, stream) in the order they are tried; the first accepted pair wins.
+_PROBE_COMBINATIONS = ((True, True), (False, True), (True, False), (False, False))
+# Statuses that mean the request itself was refused, so another combination may work.
+REJECTED_STATUSES = frozenset({400, 415, 422})
+
+
+def _get(obj: Any, key: str, default: Any = None) -> Any:
+    if isinstance(obj, dict):
+        return obj.get(key, default)
+    return getattr(obj, key, default)
+
+
+def _message_content(choice: Any) -> Optional[str]:
+    content = _get(_get(choice, "message"), "content")
+    if isinstance(content, str) and content.strip():
+        return content
+    return None
+
+
+def _message_content_parts(choice: Any) -> Optional[str]:
+    content = _get(_get(choice, "message"), "content")
+    if not isinstance(content, list):
+        return None
+    parts = [part["text"] for part in content if isinstance(part, dict) and "text" in part]
+    return "".join(parts) if parts else None
+
+
+def _reasoning_content(choice: Any) -> Optional[str]:
+    # Some models (such as those served by Nebius) answer in reasoning_content only.
+    reasoning = _get(_get(choice, "message"), "reasoning_content")
+    if reasoning is not None and str(reasoning).strip():
+        return str(reasoning)
+    return None
+
+
+def _tool_call_arguments(choice: Any) -> Optional[str]:
+    tool_calls = _get(_get(choice, "message"), "tool_calls")
+    if isinstance(tool_calls, list) and tool_calls:
+        args = _get(_get(tool_calls[0], "function", {}), "arguments")
+        return args or None
+    return None
+
+
+def _choice_text(choice: Any) -> Optional[str]:
+    return _get(choice, "text")
+
+
+# Where a completion's text can be, in the order they are tried when the shape is unknown.
+CONTENT_SHAPES: List[Tuple[str, Callable[[Any], Optional[str]]]] = [
+    ("message.content", _message_content),
+    ("message.content list", _message_content_parts),
+    ("message.reasoning_content", _reasoning_content),
+    ("message.tool_calls.function.arguments", _tool_call_arguments),
+    ("choice.text", _choice_text),
+]
+_SHAPE_READERS = dict(CONTENT_SHAPES)
+
+
+def extract_content(data: Any, shape: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    """(shape, text) of a chat completion, trying the endpoint's known shape first.
+
+    Returns (None, None) when the response has no text in any known shape.
+    """
+    choices = _get(data, "choices")
+    if not isinstance(choices, list) or not choices:
+        return None, None
+    choice = choices[0]
+    reader = _SHAPE_READERS.get(shape or "")
+    if reader is not None:
+        text = reader(choice)
+        if text is not None:
+            return shape, text
+    for name, reader in CONTENT_SHAPES:
+        if name == shape:
+            continue
+        text = reader(choice)
+        if text is not None:
+            return name, text
+    return None, None
+
+
+def _ttl_seconds() -> int:
+    try:
+        return int(os.environ.get("STACKFIX_CAPABILITY_TTL", DEFAULT_CAPABILITY_TTL_SECONDS))
+    except ValueError:
+        return DEFAULT_CAPABILITY_TTL_SECONDS
+
+
+def probing_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_PROBE") != "1"
+
+
+def _key(url: str, model: str) -> str:
+    return f"{url.rstrip('/')}|{model}"
+
+
+def saved(url: str, model: str) -> Optional[Dict[str, Any]]:
+    """The stored capabilities of url for model, or None when missing or expired."""
+    entry = load_user_state(CAPABILITIES_FILE).get(_key(url, model))
+    if not isinstance(entry, dict):
+        return None
+    try:
+        age = time.time() - float(entry.get("checked_at", 0))
+    except (TypeError, ValueError):
+        return None
+    return entry if age < _ttl_seconds() else None
+
+
+def _store(url: str, model: str, entry: Optional[Dict[str, Any]]) -> None:
+    try:
+        with user_lock():
+            data = load_user_state(CAPABILITIES_FILE)
+            if entry is None:
+                data.pop(_key(url, model), None)
+            else:
+                data[_key(url, model)] = entry
+            save_user_state(CAPABILITIES_FILE, data)
+    except OSError:
+        pass
+
+
+class Endpoint:
+    """The capabilities of one base URL and model, as used to build and read requests."""
+
+    def __init__(self, url: str, model: str, entry: Optional[Dict[str, Any]] = None) -> None:
+        self.url = url
+        self.model = model
+        self.entry = entry
+        known = dict(DEFAULT_CAPABILITIES, **(entry or {}))
+        self.response_format = bool(known["response_format"])
+        self.stream = bool(known["stream"])
+        self.content_shape: Optional[str] = known["content_shape"]
+
+    def fit(self, payload: Dict[str, Any]) -> None:
+        """Drop the parts of payload the endpoint does not accept."""
+        if not self.response_format:
+            payload.pop("response_format", None)
+        if not self.stream:
+            payload.pop("stream", None)
+
+    def seen(self, shape: Optional[str]) -> None:
+        """Remember where a real response put its text, if that moved since the probe."""
+        if shape is None or shape == self.content_shape:
+            return
+        self.content_shape = shape
+        if self.entry is not None:
+            self.entry = dict(self.entry, content_shape=shape)
+            _store(self.url, self.model, self.entry)
+
+    def rejected(self) -> None:
+        """The endpoint refused a request built from these capabilities; probe again next time."""
+        if self.entry is not None:
+            self.entry = None
+            _store(self.url, self.model, None)
+
+
+def probe(url: str, headers: Dict[str, str], model: str, timeout: float = PROBE_TIMEOUT) -> Optional[Dict[str, Any]]:
+    """Find out with tiny requests whether url accepts response_format and streaming.
+
+    Returns None when the endpoint could not be reached or refused every
+    combination, which says more about the credentials or model name than
+    about its capabilities.
+    """
+    base = {
+        "model": model,
+        "temperature": 0,
+        "max_tokens": PROBE_MAX_TOKENS,
+        "messages": [{"role": "user", "content": 'Reply with the JSON object {"ok": true}.'}],
+    }
+    for response_format, stream in _PROBE_COMBINATIONS:
+        payload = dict(base)
+        if response_format:
+            payload["response_format"] = {"type": "json_object"}
+        if stream:
+            payload["stream"] = True
+        try:
+            resp = transport.post(url, headers=headers, json=payload, timeout=(timeout, timeout), stream=stream)
+        except Exception:
+            return None
+        if resp.status_code in REJECTED_STATUSES:
+            resp.close()
+            continue
+        if resp.status_code != 200:
+            resp.close()
+            return None
+        streamed = stream and "text/event-stream" in (resp.headers.get("content-type") or "")
+        try:
+            data = streaming.read_sse_completion(resp, lambda text: None) if streamed else resp.json()
+        except Exception:
+            return None
+        shape, _ = extract_content(data)
+        if _get((_get(data, "choices") or [{}])[0], "finish_reason") == "length":
+            # A reply cut this short may not have reached the field real answers use.
+            shape = None
+        return {"response_format": response_format, "stream": streamed, "content_shape": shape}
+    return None
+
+
+def for_endpoint(url: str, headers: Dict[str, str], model: str) -> Endpoint:
+    """What url supports for model: saved, freshly probed, or the defaults when unknown.
+
+    A probe that cannot tell is saved as well, with no capabilities, so the
+    endpoint gets the defaults without being probed again until the entry
+    expires or a request is rejected.
+    """
+    entry = saved(url, model)
+    if entry is None and probing_enabled():
+        found = probe(url, headers, model)
+        entry = dict(found or {"undetermined": True}, checked_at=int(time.time()))
+        _store(url, model, entry)
+    return Endpoint(url, model, entry)
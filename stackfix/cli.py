@@ -1,17 +1,62 @@
 import argparse
 import json
 import os
+import shlex
 import sys
-from typing import List
+import time
+from typing import Dict, List, Optional
 
-from .agent import call_agent
-from .context import collect_context
+from .agent import call_agent, warm_up
+from .candidates import run_candidates
+from .context import ContextPrefetch, collect_context, prefetch_enabled
 from .history import write_history, read_last
+from .iterate import LoopBudget, diff_since, incremental_context, snapshot_tree, tokens_used
 from .patching import apply_patch
+from .stats import format_stats, load_stats, record as record_stat
 from .util import run_command_stream
 from .agents import load_agents_instructions
+from .streaming import streaming_enabled
 from .tui import run_tui
 
+_FIELD_HEADERS = {
+    "summary": "\nProposed fix:\n",
+    "patch_unified_diff": "\nPatch preview:\n\n",
+}
+
+
+class _StreamPrinter:
+    """Writes streamed summary and patch text to stdout as it arrives."""
+
+    def __init__(self, raw: bool = False) -> None:
+        self.raw = raw
+        self.streamed: Dict[str, str] = {}
+
+    def __call__(self, event: str, field: Optional[str], text: str) -> None:
+        if self.raw:
+            if event == "text":
+                self.streamed["text"] = self.streamed.get("text", "") + text
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            return
+        if event == "field_delta" and field in _FIELD_HEADERS:
+            if field not in self.streamed:
+                sys.stdout.write(_FIELD_HEADERS[field])
+                self.streamed[field] = ""
+            self.streamed[field] += text
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        elif event == "field_done" and field in self.streamed:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        elif event == "retry":
+            print(f"\n[stackfix] {text}", file=sys.stderr)
+            self.streamed = {}
+        elif event == "patch_repaired":
+            print("[stackfix] Patch had malformed hunks; repaired locally", file=sys.stderr)
+
+    def was_streamed(self, field: str, value: str) -> bool:
+        return self.streamed.get(field) == value
+
 
 def _print_last(cwd: str) -> int:
     last = read_last(cwd)
@@ -25,6 +70,40 @@ def _print_last(cwd: str) -> int:
     return 0
 
 
+def _print_stats(cwd: str) -> int:
+    data = load_stats(cwd)
+    if not data:
+        print("No stats recorded.")
+        return 1
+    print(format_stats(data))
+    return 0
+
+
+def _best_candidate(context: Dict, cmd: List[str], count: int, cwd: str):
+    print(f"\nGenerating {count} candidate patches...")
+
+    def _report(outcome: Dict) -> None:
+        label = f"  candidate {outcome['index'] + 1}:"
+        elapsed = f"{outcome.get('elapsed', 0.0):.1f}s"
+        if outcome["passed"]:
+            print(f"{label} passed ({elapsed})")
+        elif outcome.get("fix_command"):
+            print(f"{label} proposes running {shlex.join(outcome['fix_command'])}, not verified ({elapsed})")
+        elif outcome.get("error"):
+            print(f"{label} {outcome['error']} ({elapsed})")
+        else:
+            print(f"{label} failed with exit code {outcome['exit_code']} ({elapsed})")
+
+    winner, outcomes = run_candidates(context, cmd, count, cwd, on_outcome=_report)
+    keys = ("index", "passed", "exit_code", "error", "elapsed", "verify_command", "fix_command")
+    log = [{k: outcome.get(k) for k in keys} for outcome in outcomes]
+    if winner is None:
+        return None, log
+    agent_result = dict(winner["agent_result"])
+    agent_result["rerun_command"] = winner["verify_command"]
+    return agent_result, log
+
+
 def _normalize_command(cmd: List[str]) -> List[str]:
     if cmd and cmd[0] == "--":
         return cmd[1:]
@@ -34,7 +113,35 @@ def _normalize_command(cmd: List[str]) -> List[str]:
 def main() -> None:
     parser = argparse.ArgumentParser(description="StackFix command wrapper")
     parser.add_argument("--last", action="store_true", help="Show last run summary and patch")
+    parser.add_argument("--stats", action="store_true", help="Show local counters such as the diff repair rate")
     parser.add_argument("--prompt", type=str, help="Run a single prompt non-interactively")
+    parser.add_argument("--no-cache", action="store_true", help="Always ask the model; skip the local response cache")
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Request N patches in parallel and offer the first that passes in an isolated worktree",
+    )
+    parser.add_argument(
+        "--max-iterations",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Keep proposing follow-up patches until the rerun passes, up to N rounds",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        metavar="SECONDS",
+        help="With --max-iterations, start no new round after this much wall time",
+    )
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        metavar="TOKENS",
+        help="With --max-iterations, start no new round once this many model tokens are used",
+    )
     parser.add_argument("command", nargs=argparse.REMAINDER, help="Command to run after --")
     args = parser.parse_args()
 
@@ -43,6 +150,9 @@ def main() -> None:
     if args.last:
         sys.exit(_print_last(cwd))
 
+    if args.stats:
+        sys.exit(_print_stats(cwd))
+
     if args.prompt:
         context = {
             "mode": "prompt",
@@ -52,8 +162,9 @@ def main() -> None:
         agents = load_agents_instructions(cwd)
         if agents:
             context["agent_instructions"] = agents
+        printer = _StreamPrinter(raw=True) if streaming_enabled() else None
         try:
-            agent_result = call_agent(context)
+            agent_result = call_agent(context, on_stream=printer)
         except Exception as exc:
             print(f"Agent call failed: {exc}", file=sys.stderr)
             sys.exit(1)
@@ -61,7 +172,10 @@ def main() -> None:
         warning = agent_result.get("_warning")
         if warning:
             print(f"Warning: {warning}", file=sys.stderr)
-        print(summary)
+        if printer is not None and printer.streamed.get("text"):
+            print()
+        else:
+            print(summary)
         record = {
             "command": None,
             "exit_code": 0,
@@ -77,6 +191,7 @@ def main() -> None:
         run_tui()
         return
 
+    prefetch = ContextPrefetch(cwd, warm_up=lambda: warm_up(cwd)) if prefetch_enabled() else None
     exit_code, stdout, stderr = run_command_stream(cmd, cwd)
 
     if exit_code == 0:
@@ -90,78 +205,198 @@ def main() -> None:
         write_history(cwd, record)
         sys.exit(exit_code)
 
-    context = collect_context(cwd, cmd, exit_code, stdout, stderr)
+    context = collect_context(cwd, cmd, exit_code, stdout, stderr, prefetch=prefetch)
+    context_timings = context.get("_context_timings")
+    budget = LoopBudget(max(args.max_iterations, 1), args.time_budget, args.token_budget)
+    looping = budget.max_iterations > 1
 
-    try:
-        agent_result = call_agent(context)
-    except Exception as exc:
-        print(f"Agent call failed: {exc}", file=sys.stderr)
-        sys.exit(exit_code)
+    printer = None
+    candidate_log = None
+    agent_started = time.monotonic()
+    if args.candidates > 1:
+        agent_result, candidate_log = _best_candidate(context, cmd, args.candidates, cwd)
+        if agent_result is None:
+            record = {
+                "command": cmd,
+                "exit_code": exit_code,
+                "summary": "No candidate patch passed verification.",
+                "patch": "",
+                "rerun_exit_code": None,
+                "applied": False,
+                "candidates": candidate_log,
+                "context_timings": context_timings,
+            }
+            write_history(cwd, record)
+            print("No candidate patch passed verification.")
+            sys.exit(exit_code)
+    else:
+        printer = _StreamPrinter() if streaming_enabled() else None
+        try:
+            agent_result = call_agent(context, on_stream=printer, use_cache=not args.no_cache)
+        except Exception as exc:
+            print(f"Agent call failed: {exc}", file=sys.stderr)
+            sys.exit(exit_code)
+
+    iteration = 1
+    iterations: List[Dict] = []
+    applied_patches: List[str] = []
+    fix_commands: List[List[str]] = []
+    auto_apply = False
+    while True:
+        agent_seconds = time.monotonic() - agent_started
+        budget.tokens += tokens_used(context, agent_result)
+        warning = agent_result.get("_warning")
+        if warning:
+            print(f"Warning: {warning}", file=sys.stderr)
+        if agent_result.get("_cached"):
+            print("[stackfix] Using cached response (pass --no-cache to ask the model again)", file=sys.stderr)
+        if agent_result.get("_rule"):
+            rule_name = agent_result["_rule"]
+            print(f"[stackfix] Matched local rule {rule_name} (STACKFIX_NO_RULES=1 to ask the model)", file=sys.stderr)
 
-    warning = agent_result.get("_warning")
-    if warning:
-        print(f"Warning: {warning}", file=sys.stderr)
+        patch = agent_result.get("patch_unified_diff", "")
+        summary = agent_result.get("summary", "")
+        fix_command = [] if patch.strip() else agent_result.get("_fix_command") or []
+        action = "Run command" if fix_command else "Apply patch"
 
-    patch = agent_result.get("patch_unified_diff", "")
-    summary = agent_result.get("summary", "")
+        if printer is None or not printer.was_streamed("summary", summary):
+            print("\nProposed fix:")
+            print(summary)
+        if fix_command:
+            print("\nCommand:\n")
+            print(shlex.join(fix_command))
+        elif printer is None or not printer.was_streamed("patch_unified_diff", patch):
+            print("\nPatch preview:\n")
+            print(patch)
 
-    print("\nProposed fix:")
-    print(summary)
-    print("\nPatch preview:\n")
-    print(patch)
+        iteration_log = {"iteration": iteration, "agent_seconds": round(agent_seconds, 3), "patch": patch}
+        if fix_command:
+            iteration_log["fix_command"] = fix_command
+        if not (patch.strip() or fix_command) or not auto_apply:
+            if not (patch.strip() or fix_command):
+                print("No patch provided by agent.")
+                reply = ""
+            elif looping:
+                reply = input(f"{action}? [y/N/a = apply this and later rounds]: ").strip().lower()
+            else:
+                reply = input(f"{action}? [y/N]: ").strip().lower()
+            if reply == "a" and looping:
+                auto_apply = True
+            elif reply != "y":
+                if patch.strip():
+                    print("Patch not applied.")
+                elif fix_command:
+                    print("Command not run.")
+                iterations.append(iteration_log)
+                if applied_patches or fix_commands:
+                    # Earlier rounds changed the tree; record them and the last rerun.
+                    break
+                record = {
+                    "command": cmd,
+                    "exit_code": exit_code,
+                    "summary": summary,
+                    "patch": patch,
+                    "rerun_exit_code": None,
+                    "applied": False,
+                    "candidates": candidate_log,
+                }
+                if looping:
+                    record["applied_patches"] = applied_patches
+                    record["iterations"] = iterations
+                write_history(cwd, record)
+                sys.exit(exit_code)
 
-    if not patch.strip():
-        record = {
-            "command": cmd,
-            "exit_code": exit_code,
-            "summary": summary,
-            "patch": patch,
-            "rerun_exit_code": None,
-            "applied": False,
-        }
-        write_history(cwd, record)
-        print("No patch provided by agent.")
-        sys.exit(exit_code)
+        tree_before = snapshot_tree(cwd) if looping else None
+        apply_started = time.monotonic()
+        try:
+            if fix_command:
+                print(f"\nRunning {shlex.join(fix_command)}...")
+                fix_exit, _, _ = run_command_stream(fix_command, cwd)
+                if fix_exit != 0:
+                    raise RuntimeError(f"{shlex.join(fix_command)} exited with {fix_exit}")
+            else:
+                apply_patch(patch, cwd)
+        except Exception as exc:
+            error = f"Fix command failed: {exc}" if fix_command else f"Failed to apply patch: {exc}"
+            print(error, file=sys.stderr)
+            if not (applied_patches or fix_commands):
+                sys.exit(exit_code)
+            iteration_log["error"] = error
+            iterations.append(iteration_log)
+            break
+        if fix_command:
+            fix_commands.append(fix_command)
+        else:
+            applied_patches.append(patch)
+        iteration_log["apply_seconds"] = round(time.monotonic() - apply_started, 3)
 
-    confirm = input("Apply patch? [y/N]: ").strip().lower()
-    if confirm != "y":
-        record = {
-            "command": cmd,
-            "exit_code": exit_code,
-            "summary": summary,
-            "patch": patch,
-            "rerun_exit_code": None,
-            "applied": False,
-        }
-        write_history(cwd, record)
-        print("Patch not applied.")
-        sys.exit(exit_code)
+        rerun_cmd = agent_result.get("rerun_command") or cmd
+        print("\nRerunning command...")
+        rerun_started = time.monotonic()
+        rerun_exit, rerun_stdout, rerun_stderr = run_command_stream(rerun_cmd, cwd)
+        iteration_log.update(
+            rerun_seconds=round(time.monotonic() - rerun_started, 3),
+            rerun_exit_code=rerun_exit,
+            tokens=budget.tokens,
+        )
+        iterations.append(iteration_log)
+        if rerun_exit == 0 and agent_result.get("_rule"):
+            # Rule hits that actually fixed the run, next to the hit counts from the rule engine.
+            record_stat(cwd, "rules", f"{agent_result['_rule']}_fixed")
 
-    try:
-        apply_patch(patch, cwd)
-    except Exception as exc:
-        print(f"Failed to apply patch: {exc}", file=sys.stderr)
-        sys.exit(exit_code)
+        if rerun_exit == 0 or not looping:
+            break
+        stop = budget.stop_reason(iteration + 1)
+        if stop:
+            print(f"\n[stackfix] Stopping: {stop}", file=sys.stderr)
+            break
 
-    rerun_cmd = agent_result.get("rerun_command") or cmd
-    print("\nRerunning command...")
-    rerun_exit, rerun_stdout, rerun_stderr = run_command_stream(rerun_cmd, cwd)
+        iteration += 1
+        print(f"\n[stackfix] Rerun still failing; round {iteration} of {budget.max_iterations}", file=sys.stderr)
+        context = incremental_context(
+            context,
+            iteration,
+            patch,
+            summary,
+            rerun_exit,
+            rerun_stdout,
+            rerun_stderr,
+            diff_since(cwd, tree_before),
+        )
+        printer = _StreamPrinter() if streaming_enabled() else None
+        agent_started = time.monotonic()
+        try:
+            agent_result = call_agent(context, on_stream=printer, use_cache=not args.no_cache)
+        except Exception as exc:
+            print(f"Agent call failed: {exc}", file=sys.stderr)
+            break
 
     record = {
         "command": cmd,
         "exit_code": exit_code,
         "summary": summary,
-        "patch": patch,
+        "patch": "\n".join(applied_patches) if looping else "".join(applied_patches[-1:]),
         "rerun_command": rerun_cmd,
         "rerun_exit_code": rerun_exit,
         "rerun_stdout": rerun_stdout,
         "rerun_stderr": rerun_stderr,
         "applied": True,
+        "candidates": candidate_log,
+        "context_timings": context_timings,
     }
+    if fix_commands:
+        record["fix_commands"] = fix_commands
+    if looping:
+        record["applied_patches"] = applied_patches
+        record["iterations"] = iterations
+        record["elapsed_seconds"] = round(budget.elapsed(), 3)
     write_history(cwd, record)
 
     print("\nRun summary:")
-    print(json.dumps({"before": exit_code, "after": rerun_exit}, indent=2))
+    summary_counts = {"before": exit_code, "after": rerun_exit}
+    if looping:
+        summary_counts["iterations"] = len(iterations)
+    print(json.dumps(summary_counts, indent=2))
     sys.exit(rerun_exit)
 
 
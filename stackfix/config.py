@@ -1,64 +1,156 @@
+import copy
 import json
 import os
+import threading
 import time
 import uuid
-from typing import Any, Dict
+from contextlib import contextmanager
+from typing import Any, ContextManager, Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+    import msvcrt
 
 CONFIG_DIR = ".stackfix"
 CONFIG_FILE = "config.json"
+# Shared by every project for this user: device fingerprint and relay tokens.
+USER_CONFIG_DIR = "~/.stackfix"
+RELAY_FILE = "relay.json"
+RELAY_LOCK_FILE = "relay.lock"
+# Held while a relay token is requested, so a slow relay does not hold up user_lock().
+TOKEN_LOCK_FILE = "relay-token.lock"
+
+# path -> (mtime_ns, size, parsed); re-parsed only when the file changes.
+_READ_CACHE: Dict[str, Tuple[int, int, Dict[str, Any]]] = {}
+_READ_CACHE_LOCK = threading.Lock()
 
 
 def _config_path(cwd: str) -> str:
-    os.makedirs(os.path.join(cwd, CONFIG_DIR), exist_ok=True)
     return os.path.join(cwd, CONFIG_DIR, CONFIG_FILE)
 
 
-def load_config(cwd: str) -> Dict[str, Any]:
-    path = _config_path(cwd)
-    if not os.path.isfile(path):
+def user_config_dir() -> str:
+    return os.path.expanduser(os.environ.get("STACKFIX_HOME") or USER_CONFIG_DIR)
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    try:
+        st = os.stat(path)
+    except OSError:
         return {}
+    with _READ_CACHE_LOCK:
+        cached = _READ_CACHE.get(path)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return copy.deepcopy(cached[2])
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
     except Exception:
         return {}
+    if not isinstance(data, dict):
+        return {}
+    with _READ_CACHE_LOCK:
+        _READ_CACHE[path] = (st.st_mtime_ns, st.st_size, data)
+    return copy.deepcopy(data)
 
 
-def save_config(cwd: str, data: Dict[str, Any]) -> None:
-    path = _config_path(cwd)
-    with open(path, "w", encoding="utf-8") as f:
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_config(cwd: str) -> Dict[str, Any]:
+    return _read_json(_config_path(cwd))
+
+
+def save_config(cwd: str, data: Dict[str, Any]) -> None:
+    _write_json(_config_path(cwd), data)
+
+
+@contextmanager
+def _file_lock(name: str) -> Iterator[None]:
+    directory = user_config_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, name), "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:  # pragma: no cover - Windows
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:  # pragma: no cover - Windows
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def user_lock() -> ContextManager[None]:
+    """Exclusive lock over the user-level relay state, held across processes."""
+    return _file_lock(RELAY_LOCK_FILE)
+
+
+def token_lock() -> ContextManager[None]:
+    """Exclusive lock over relay token requests, held across processes; separate from user_lock()."""
+    return _file_lock(TOKEN_LOCK_FILE)
+
+
+def load_user_state(name: str) -> Dict[str, Any]:
+    """A JSON file in the user-level config directory, or {} when missing."""
+    return _read_json(os.path.join(user_config_dir(), name))
+
+
+def save_user_state(name: str, data: Dict[str, Any]) -> None:
+    _write_json(os.path.join(user_config_dir(), name), data)
+
+
+def _relay_path() -> str:
+    return os.path.join(user_config_dir(), RELAY_FILE)
 
 
 def get_or_create_device_fingerprint(cwd: str) -> str:
-    cfg = load_config(cwd)
-    relay = cfg.get("relay", {})
-    fingerprint = relay.get("device_fingerprint")
+    fingerprint = _read_json(_relay_path()).get("device_fingerprint")
     if fingerprint:
         return fingerprint
-    fingerprint = str(uuid.uuid4())
-    relay["device_fingerprint"] = fingerprint
-    cfg["relay"] = relay
-    save_config(cwd, cfg)
+    with user_lock():
+        data = _read_json(_relay_path())
+        fingerprint = data.get("device_fingerprint")
+        if not fingerprint:
+            # Adopt a fingerprint from the older per-project config if there is one.
+            project = load_config(cwd).get("relay", {})
+            fingerprint = project.get("device_fingerprint") or str(uuid.uuid4())
+            data["device_fingerprint"] = fingerprint
+            _write_json(_relay_path(), data)
     return fingerprint
 
 
-def get_relay_token(cwd: str) -> Dict[str, Any]:
-    cfg = load_config(cwd)
-    relay = cfg.get("relay", {})
+def get_relay_token(relay_url: str) -> Dict[str, Any]:
+    tokens = _read_json(_relay_path()).get("tokens", {})
+    entry = tokens.get(relay_url.rstrip("/")) or {}
     return {
-        "token": relay.get("token"),
-        "expires_at": relay.get("expires_at"),
+        "token": entry.get("token"),
+        "expires_at": entry.get("expires_at"),
+        "issued_at": entry.get("issued_at"),
     }
 
 
-def set_relay_token(cwd: str, token: str, expires_at: int) -> None:
-    cfg = load_config(cwd)
-    relay = cfg.get("relay", {})
-    relay["token"] = token
-    relay["expires_at"] = expires_at
-    cfg["relay"] = relay
-    save_config(cwd, cfg)
+def set_relay_token(relay_url: str, token: str, expires_at: int) -> None:
+    """Store a token for relay_url; callers should hold user_lock()."""
+    data = _read_json(_relay_path())
+    tokens = data.setdefault("tokens", {})
+    tokens[relay_url.rstrip("/")] = {
+        "token": token,
+        "expires_at": expires_at,
+        "issued_at": int(time.time()),
+    }
+    _write_json(_relay_path(), data)
 
 
 def is_token_valid(expires_at: Any, skew_seconds: int = 60) -> bool:
@@ -66,4 +158,20 @@ def is_token_valid(expires_at: Any, skew_seconds: int = 60) -> bool:
         expires_at_int = int(expires_at)
     except Exception:
         return False
-    return time.time() + skew_seconds < expires_at_int
\ No newline at end of file
+    return time.time() + skew_seconds < expires_at_int
+
+
+def token_refresh_due(token_info: Dict[str, Any], window_seconds: int = 600) -> bool:
+    """True once a token is in the last window_seconds (or last fifth) of its lifetime."""
+    try:
+        expires_at = int(token_info.get("expires_at"))
+    except Exception:
+        return True
+    issued_at: Optional[Any] = token_info.get("issued_at")
+    window = window_seconds
+    if issued_at is not None:
+        try:
+            window = min(window, (expires_at - int(issued_at)) / 5)
+        except (TypeError, ValueError):
+            pass
+    return time.time() + window >= expires_at
@@ -1,16 +1,76 @@
+import hashlib
+import json
 import os
+import re
 import subprocess
-from typing import Dict
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from .util import truncate_text, is_git_repo
+from . import lockfiles, reducers, stats, symbols
+from .util import truncate_middle, truncate_text, is_git_repo
 from .safety import is_forbidden_path
-from .agents import load_agents_instructions
+from .agents import MAX_AGENT_BYTES, find_agents_file
+from .slicing import find_locations, source_snippets
 
 MAX_STDIO_CHARS = 20000
 MAX_GIT_CHARS = 20000
 MAX_FILE_CHARS = 12000
 MAX_FILE_BYTES = 200000
 
+CONTEXT_CACHE_FILE = ".stackfix/context_cache.json"
+# StackFix's own state is left out so writing it does not look like a project change.
+_STATUS_ARGS = ["status", "--porcelain", "--", ".", ":(exclude).stackfix"]
+# Files changed this recently are not cached; see ContextCache.
+RACY_SECONDS = 2
+# Longest the model call waits for the symbol index update after the command exits.
+SYMBOL_WAIT_SECONDS = 2.0
+
+# Most git output read for one failure; git is stopped there, so a huge diff costs no more.
+MAX_GIT_READ_BYTES = 4 * MAX_GIT_CHARS
+MAX_DIFF_STAT_CHARS = 4000
+# Files a failure names that are fetched on their own when the bounded read stopped short.
+MAX_LATE_DIFF_FILES = 3
+# Generated and vendored files, left out of the diff body; --stat still lists them.
+GENERATED_PATHSPECS = [
+    f":(exclude,glob){pattern}"
+    for pattern in (
+        "**/*.lock",
+        "**/package-lock.json",
+        "**/pnpm-lock.yaml",
+        "**/*.min.js",
+        "**/*.min.css",
+        "**/*.map",
+        "**/*.snap",
+        "**/*_pb2.py",
+        "**/*.pb.go",
+        "**/dist/**",
+        "**/build/**",
+        "**/vendor/**",
+        "**/node_modules/**",
+    )
+]
+_DIFF_HEADER = re.compile(r'^diff --git "?a/.*? "?b/(?P<path>.*?)"?$')
+
+# Top-level files that say what kind of project this is, for the repository summary.
+PROJECT_MARKERS = {
+    "package.json": "node",
+    "tsconfig.json": "typescript",
+    "pyproject.toml": "python",
+    "setup.py": "python",
+    "requirements.txt": "python",
+    "Cargo.toml": "rust",
+    "go.mod": "go",
+    "pom.xml": "java",
+    "build.gradle": "java",
+    "build.gradle.kts": "java",
+    "Gemfile": "ruby",
+    "composer.json": "php",
+    "CMakeLists.txt": "cmake",
+    "Makefile": "make",
+}
+MAX_SUMMARY_ENTRIES = 100
+
 MANIFESTS = [
     "package.json",
     "pnpm-lock.yaml",
@@ -26,48 +86,529 @@ def _read_file(path: str) -> str:
         return f.read()
 
 
-def collect_context(cwd: str, command: list, exit_code: int, stdout: str, stderr: str) -> Dict:
-    ctx = {
-        "command": command,
-        "cwd": cwd,
-        "exit_code": exit_code,
-        "stdout": truncate_text(stdout, MAX_STDIO_CHARS),
-        "stderr": truncate_text(stderr, MAX_STDIO_CHARS),
-    }
+def prefetch_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_PREFETCH") != "1"
 
-    agents = load_agents_instructions(cwd)
-    if agents:
-        ctx["agent_instructions"] = truncate_text(agents, MAX_FILE_CHARS)
 
-    if is_git_repo(cwd):
-        try:
-            status = subprocess.check_output(["git", "status", "--porcelain"], cwd=cwd, text=True)
-        except Exception:
-            status = ""
+def _stamp(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _settled(stamp: Optional[List[int]]) -> bool:
+    """Whether a file is old enough that a same-size edit would change its mtime."""
+    return stamp is not None and time.time_ns() - stamp[0] > RACY_SECONDS * 1_000_000_000
+
+
+class ContextCache:
+    """Context reads kept in .stackfix/context_cache.json and reused while the inputs are unchanged.
+
+    Files are keyed on their mtime and size. The git diff is keyed on HEAD, the
+    stat of .git/index, the `git status` output and the stat of every changed
+    file. Files touched in the last RACY_SECONDS are never stored, because a
+    same-size edit in the same clock tick would go unnoticed.
+    """
+
+    def __init__(self, cwd: str) -> None:
+        self.path = os.path.join(cwd, CONTEXT_CACHE_FILE)
+        self._lock = threading.Lock()
+        self._dirty = False
         try:
-            diff = subprocess.check_output(["git", "diff"], cwd=cwd, text=True)
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
         except Exception:
-            diff = ""
-        ctx["git_status"] = truncate_text(status, MAX_GIT_CHARS)
-        ctx["git_diff"] = truncate_text(diff, MAX_GIT_CHARS)
+            data = {}
+        self._data: Dict[str, Any] = data if isinstance(data, dict) else {}
+        self._files: Dict[str, Any] = self._data.setdefault("files", {})
+
+    def read(self, path: str) -> str:
+        """path's contents, from the cache while its size and mtime are unchanged."""
+        stamp = _stamp(path)
+        with self._lock:
+            entry = self._files.get(path)
+        if entry and stamp is not None and entry.get("stamp") == stamp:
+            return entry["content"]
+        content = _read_file(path)
+        if _settled(stamp) and _stamp(path) == stamp:
+            with self._lock:
+                self._files[path] = {"stamp": stamp, "content": content}
+                self._dirty = True
+        return content
+
+    def get(self, section: str) -> Any:
+        with self._lock:
+            return self._data.get(section)
+
+    def put(self, section: str, value: Any) -> None:
+        with self._lock:
+            self._data[section] = value
+            self._dirty = True
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            # Forget files that are gone so the cache does not grow without bound.
+            for path in [path for path in self._files if not os.path.exists(path)]:
+                del self._files[path]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._data, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                pass
+            self._dirty = False
+
+
+def _status_paths(status: str) -> Optional[List[str]]:
+    """Paths named by `git status --porcelain`, or None if one is quoted and cannot be checked."""
+    paths = []
+    for line in status.splitlines():
+        path = line[3:].split(" -> ")[-1]
+        if path.startswith('"'):
+            return None
+        paths.append(path)
+    return paths
+
+
+def _git_args(args: List[str]) -> List[str]:
+    if os.environ.get("STACKFIX_GIT_FSMONITOR") == "1":
+        # Let git watch the tree instead of scanning it; needs git 2.37+ on macOS or Windows.
+        args = ["-c", "core.fsmonitor=true", "-c", "core.untrackedCache=true", *args]
+    return ["git", *args]
+
+
+def _git_output(cwd: str, args: List[str]) -> str:
+    try:
+        return subprocess.check_output(_git_args(args), cwd=cwd, text=True, stderr=subprocess.DEVNULL)
+    except Exception:
+        return ""
+
+
+def _git_stream(cwd: str, args: List[str], limit: int) -> Tuple[str, bool]:
+    """Up to limit bytes of git's output and whether there was more.
+
+    Output is read in blocks and git is killed once the limit is passed, so
+    memory and time stay flat however large the output would have been.
+    """
+    try:
+        proc = subprocess.Popen(_git_args(args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except Exception:
+        return "", False
+    chunks = []
+    size = 0
+    more = False
+    try:
+        while True:
+            block = proc.stdout.read(min(65536, limit + 1 - size))
+            if not block:
+                break
+            chunks.append(block)
+            size += len(block)
+            if size > limit:
+                more = True
+                proc.kill()
+                break
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if not more and proc.returncode != 0:
+        return "", False
+    return b"".join(chunks)[:limit].decode("utf-8", errors="replace"), more
+
+
+def _split_diff(diff: str) -> List[List[str]]:
+    """[path, text] for each file in a diff, without binary files."""
+    files: List[List[str]] = []
+    for section in re.split(r"(?m)^(?=diff --git )", diff):
+        header = _DIFF_HEADER.match(section.split("\n", 1)[0])
+        if header is None:
+            continue
+        if re.search(r"(?m)^(Binary files .* differ|GIT binary patch)$", section):
+            continue
+        files.append([header.group("path"), section])
+    return files
+
+
+def _read_diff(cwd: str) -> Dict[str, Any]:
+    """`git diff --stat` and the per-file diff of source files, each read within a bound.
+
+    `complete` is False when the bounded read stopped before the last file; that
+    file's text is then cut short.
+    """
+    stat, _ = _git_stream(cwd, ["diff", "--no-color", "--stat=120", "--stat-count=100"], MAX_DIFF_STAT_CHARS)
+    body, more = _git_stream(
+        cwd, ["diff", "--no-color", "--no-ext-diff", "--", ".", *GENERATED_PATHSPECS], MAX_GIT_READ_BYTES
+    )
+    return {"stat": stat, "files": _split_diff(body), "complete": not more}
+
+
+def _git_key(cwd: str) -> Optional[Dict[str, Any]]:
+    head = _git_output(cwd, ["rev-parse", "HEAD"]).strip()
+    index = _stamp(os.path.join(cwd, ".git", "index"))
+    if not head or index is None:
+        return None
+    return {"head": head, "index": index}
+
+
+def _diff_for_failure(cwd: str, diff: Dict[str, Any], stdout: str, stderr: str) -> str:
+    """The stat, then file diffs ranked by relevance to the failure, within MAX_GIT_CHARS.
+
+    Files at a location the output names come first, then files whose name the
+    output mentions, then the rest in git's order. When the bounded read stopped
+    early, named files it did not reach are fetched on their own.
+    """
+    output = f"{stdout}\n{stderr}"
+    named = {os.path.normpath(path) for path, _, _ in find_locations(output)}
+    named = {os.path.relpath(path, cwd) if os.path.isabs(path) else path for path in named}
+    named = {path for path in named if not path.startswith("..") and os.path.isfile(os.path.join(cwd, path))}
+
+    def score(path: str) -> int:
+        if any(path == name or path.endswith("/" + name) or name.endswith("/" + path) for name in named):
+            return 2
+        return 1 if os.path.basename(path) in output else 0
 
-    files = {}
+    files = list(diff["files"])
+    if not diff["complete"]:
+        seen = {path for path, _ in files[:-1]}
+        late = [name for name in sorted(named) if name not in seen][:MAX_LATE_DIFF_FILES]
+        for name in late:
+            text, _ = _git_stream(cwd, ["diff", "--no-color", "--no-ext-diff", "--", name], MAX_GIT_CHARS)
+            files = [entry for entry in files if entry[0] != name] + _split_diff(text)
+    ranked = sorted(enumerate(files), key=lambda item: (-score(item[1][0]), item[0]))
+
+    parts = [diff["stat"]] if diff["stat"] else []
+    used = len(diff["stat"])
+    left_out = 0
+    cut = False
+    for _, (_, text) in ranked:
+        room = MAX_GIT_CHARS - used
+        if len(text) <= room:
+            parts.append(text)
+            used += len(text)
+        elif not cut and room > 500:
+            # The best-ranked file that does not fit is shown in part rather than not at all.
+            parts.append(truncate_text(text, room - 100))
+            used = MAX_GIT_CHARS
+            cut = True
+        else:
+            left_out += 1
+    if left_out or not diff["complete"]:
+        parts.append("... [more changed files not shown; see the stat above]\n")
+    return "\n".join(part.rstrip("\n") for part in parts) + "\n" if parts else ""
+
+
+def _git_state(cwd: str, cache: Optional[ContextCache] = None) -> Optional[Dict[str, Any]]:
+    """git status and diff (see _read_diff), with the stat of every file status names when both were read.
+
+    `git status` always runs; the diff comes from cache when HEAD, the index,
+    the status and the changed files are all as they were when it was stored.
+    """
+    if not is_git_repo(cwd):
+        return None
+    status, more = _git_stream(cwd, _STATUS_ARGS, MAX_GIT_READ_BYTES)
+    # Taken after status, which may have refreshed the index.
+    key = _git_key(cwd) if cache is not None else None
+    paths = None if more else _status_paths(status)
+    stamps = None if paths is None else {path: _stamp(os.path.join(cwd, path)) for path in paths}
+    cached = cache.get("git_diff") if key is not None else None
+    if stamps is not None and cached and cached.get("key") == key and cached.get("status") == status:
+        if cached.get("stamps") == stamps:
+            return {"status": status, "diff": cached["diff"], "stamps": stamps, "cached": True}
+    diff = _read_diff(cwd)
+    if stamps is not None and any(_stamp(os.path.join(cwd, path)) != stamp for path, stamp in stamps.items()):
+        # A file changed while the diff was read, so it cannot be vouched for later.
+        stamps = None
+    if key is not None and key != _git_key(cwd):
+        key = None
+    if key is not None and stamps is not None and all(_settled(stamp) for stamp in stamps.values() if stamp):
+        cache.put("git_diff", {"key": key, "status": status, "stamps": stamps, "diff": diff})
+    return {"status": status, "diff": diff, "stamps": stamps, "cached": False}
+
+
+def _git_state_still_valid(cwd: str, state: Dict[str, Any]) -> bool:
+    """Whether the prefetched diff still describes the tree: same status, same changed files."""
+    if state["stamps"] is None or _git_stream(cwd, _STATUS_ARGS, MAX_GIT_READ_BYTES)[0] != state["status"]:
+        return False
+    return all(_stamp(os.path.join(cwd, path)) == stamp for path, stamp in state["stamps"].items())
+
+
+def _manifest_stamps(cwd: str) -> Dict[str, Optional[List[int]]]:
+    return {name: _stamp(os.path.join(cwd, name)) for name in MANIFESTS}
+
+
+def _agent_instructions(cwd: str, cache: ContextCache) -> Optional[str]:
+    path = find_agents_file(cwd)
+    if not path:
+        return None
+    try:
+        if os.path.getsize(path) > MAX_AGENT_BYTES:
+            return None
+        return cache.read(path)
+    except Exception:
+        return None
+
+
+def _lockfile_table(path: str, name: str, cache: ContextCache) -> Optional[Dict[str, List[str]]]:
+    """The package table of a lockfile, parsed again only when its content hash changes."""
+    stamp = _stamp(path)
+    if stamp is None or stamp[1] > lockfiles.MAX_LOCKFILE_BYTES:
+        return None
+    tables = cache.get("lockfiles") or {}
+    entry = tables.get(path)
+    if entry and entry.get("stamp") == stamp:
+        return entry["packages"]
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if entry and entry.get("hash") == digest:
+        packages = entry["packages"]
+    else:
+        packages = lockfiles.parse(name, data.decode("utf-8", errors="replace"))
+    # A file changed in the last RACY_SECONDS is stored without a stamp, so its hash is checked next time.
+    stored = stamp if _settled(stamp) else None
+    tables = dict(tables)
+    tables[path] = {"stamp": stored, "hash": digest, "packages": packages}
+    cache.put("lockfiles", tables)
+    return packages
+
+
+def _top_level(cwd: str) -> List[str]:
+    """Top-level names, directories ending in "/"; from HEAD in a git repository."""
+    if is_git_repo(cwd):
+        listing = _git_output(cwd, ["ls-tree", "-z", "HEAD"])
+        entries = []
+        for entry in listing.split("\0"):
+            info, _, name = entry.partition("\t")
+            if name:
+                entries.append(name + "/" if info.split(" ")[1:2] == ["tree"] else name)
+        if entries:
+            return entries
+    entries = []
+    with os.scandir(cwd) as listing:
+        for entry in listing:
+            if entry.name.startswith(".") or entry.name in symbols.SKIPPED_DIRS:
+                continue
+            entries.append(entry.name + "/" if entry.is_dir() else entry.name)
+    return entries
+
+
+def _repo_summary(cwd: str) -> Dict[str, Any]:
+    """The sorted top-level layout and detected project types.
+
+    Only names go in, so the summary is byte-identical from run to run and can
+    sit in the cached prompt prefix. In a git repository the layout is read from
+    HEAD, so build output and caches the failing command writes leave it alone.
+    """
+    names = sorted(name for name in _top_level(cwd) if not is_forbidden_path(os.path.join(cwd, name), cwd))
+    summary: Dict[str, Any] = {
+        "project_types": sorted({PROJECT_MARKERS[name] for name in names if name in PROJECT_MARKERS}),
+        "top_level": names[:MAX_SUMMARY_ENTRIES],
+    }
+    if len(names) > MAX_SUMMARY_ENTRIES:
+        summary["more_entries"] = len(names) - MAX_SUMMARY_ENTRIES
+    return summary
+
+
+def _read_manifests(cwd: str, cache: ContextCache) -> Dict[str, Any]:
+    """Manifests as text and lockfiles as package tables.
+
+    Lockfiles appear in `files` as their package count and the locked versions
+    of the direct dependencies in package.json or pyproject.toml; the full
+    tables are returned under `tables` for lockfiles.failure_entries.
+    """
+    stamps = _manifest_stamps(cwd)
+    files: Dict[str, Any] = {}
+    contents: Dict[str, str] = {}
+    tables: Dict[str, Dict[str, List[str]]] = {}
     for name in MANIFESTS:
         path = os.path.join(cwd, name)
         if not os.path.isfile(path):
             continue
         if is_forbidden_path(path, cwd):
             continue
+        if name in lockfiles.PARSERS:
+            try:
+                table = _lockfile_table(path, name, cache)
+            except Exception:
+                table = None
+            if table is not None:
+                tables[name] = table
+            continue
         size = os.path.getsize(path)
         if size > MAX_FILE_BYTES:
             continue
         try:
-            content = _read_file(path)
+            content = cache.read(path)
         except Exception:
             continue
+        contents[name] = content
         files[name] = truncate_text(content, MAX_FILE_CHARS)
+    direct = set()
+    if "package.json" in contents:
+        direct |= lockfiles.package_json_dependencies(contents["package.json"])
+    if "pyproject.toml" in contents:
+        direct |= lockfiles.pyproject_dependencies(contents["pyproject.toml"])
+    for name, table in tables.items():
+        files[name] = lockfiles.summarize(table, direct)
+    return {"files": files, "stamps": stamps, "tables": tables}
+
+
+class ContextPrefetch:
+    """Project context gathered in background threads, started before the failing command.
+
+    AGENTS.md, git state, manifests and the repository summary do not depend on
+    the command output, so they are read while the command runs. Git state and manifests are checked
+    again once it exits and read again if the command changed them. warm_up
+    runs alongside; the CLI uses it to get the relay token and a connection
+    ready, and the symbol index is updated. Threads are daemons so a passing
+    command exits without waiting.
+    All steps read through one ContextCache.
+    """
+
+    def __init__(self, cwd: str, warm_up: Optional[Callable[[], None]] = None) -> None:
+        self.cwd = cwd
+        self.started = time.monotonic()
+        self.cache = ContextCache(cwd)
+        self.timings: Dict[str, float] = {}
+        self._results: Dict[str, Any] = {}
+        self._threads: Dict[str, threading.Thread] = {}
+        steps: Dict[str, Callable[[], Any]] = {
+            "agent_instructions": lambda: _agent_instructions(cwd, self.cache),
+            "git": lambda: _git_state(cwd, self.cache),
+            "manifests": lambda: _read_manifests(cwd, self.cache),
+            "repo_summary": lambda: _repo_summary(cwd),
+        }
+        if symbols.index_enabled():
+            steps["symbols"] = lambda: symbols.update_index(cwd)
+        if warm_up is not None:
+            steps["warm_up"] = warm_up
+        for name, step in steps.items():
+            thread = threading.Thread(target=self._run, args=(name, step), name=f"stackfix-{name}", daemon=True)
+            self._threads[name] = thread
+            thread.start()
+
+    def _run(self, name: str, step: Callable[[], Any]) -> None:
+        started = time.monotonic()
+        try:
+            self._results[name] = step()
+        except Exception:
+            self._results[name] = None
+        self.timings[f"{name}_seconds"] = round(time.monotonic() - started, 3)
+
+    def result(self, name: str, timeout: Optional[float] = None) -> Any:
+        """What step name returned; None when it failed, was not started or outlasted timeout."""
+        thread = self._threads.get(name)
+        if thread is None:
+            return None
+        thread.join(timeout)
+        return self._results.get(name)
+
+
+def collect_context(
+    cwd: str,
+    command: list,
+    exit_code: int,
+    stdout: str,
+    stderr: str,
+    prefetch: Optional[ContextPrefetch] = None,
+) -> Dict:
+    """The failure plus project context; with prefetch, reuses what was read during the run.
+
+    `repo_summary` holds the top-level layout and detected project types.
+    Lockfiles are summarized in `manifests`; the locked versions of packages the
+    output names go under `lockfile_entries`. Source around the file:line
+    locations in the output goes under `source_snippets`,
+    and the definitions of symbols the error names under `symbol_definitions`.
+    stdout and stderr go through the log reducers first; what each removed is
+    returned under `_output_reduction`. Per-step timings are returned under
+    `_context_timings`. `wait_seconds` is the time spent here after the command
+    exited, which the model call waits for.
+    """
+    started = time.monotonic()
+    reduction = None
+    if reducers.reducing_enabled():
+        stdout, stderr, reduction = reducers.reduce_output(command, stdout, stderr)
+    ctx = {
+        "command": command,
+        "cwd": cwd,
+        "exit_code": exit_code,
+        "stdout": truncate_middle(stdout, MAX_STDIO_CHARS),
+        "stderr": truncate_middle(stderr, MAX_STDIO_CHARS),
+    }
+    recheck = prefetch is not None
+    if prefetch is None:
+        prefetch = ContextPrefetch(cwd)
+    timings: Dict[str, Any] = {}
+
+    agents = prefetch.result("agent_instructions")
+    if agents:
+        ctx["agent_instructions"] = truncate_text(agents, MAX_FILE_CHARS)
+
+    git = prefetch.result("git")
+    if git is not None and recheck:
+        checked = time.monotonic()
+        reused = _git_state_still_valid(cwd, git)
+        if not reused:
+            git = _git_state(cwd, prefetch.cache)
+        timings["git_recheck_seconds"] = round(time.monotonic() - checked, 3)
+        timings["git_reused"] = reused
+    if git is not None:
+        timings["git_diff_cached"] = git["cached"]
+        ctx["git_status"] = truncate_text(git["status"], MAX_GIT_CHARS)
+        ctx["git_diff"] = _diff_for_failure(cwd, git["diff"], stdout, stderr)
+
+    manifests = prefetch.result("manifests")
+    if manifests is None or (recheck and manifests["stamps"] != _manifest_stamps(cwd)):
+        manifests = _read_manifests(cwd, prefetch.cache)
+    if manifests["files"]:
+        ctx["manifests"] = manifests["files"]
+    summary = prefetch.result("repo_summary")
+    if summary and summary["top_level"]:
+        ctx["repo_summary"] = summary
+    entries = lockfiles.failure_entries(manifests["tables"], f"{stdout}\n{stderr}")
+    if entries:
+        ctx["lockfile_entries"] = entries
+
+    sliced = time.monotonic()
+    snippets = source_snippets(cwd, stdout, stderr)
+    timings["slicing_seconds"] = round(time.monotonic() - sliced, 3)
+    if snippets:
+        ctx["source_snippets"] = snippets
 
-    if files:
-        ctx["manifests"] = files
+    # The index is brought up to date while the command runs. A first build in a
+    # large repository can outlast it, so the update is waited for at most
+    # SYMBOL_WAIT_SECONDS; then the lookup reads what earlier runs indexed and the
+    # build carries on in the background for the next run.
+    if symbols.index_enabled() and symbols.error_symbols(stdout, stderr):
+        timings["symbols_ready"] = prefetch.result("symbols", timeout=SYMBOL_WAIT_SECONDS) is not None
+        looked_up = time.monotonic()
+        definitions = symbols.definitions_for_failure(cwd, stdout, stderr)
+        timings["symbol_lookup_seconds"] = round(time.monotonic() - looked_up, 3)
+        if definitions:
+            ctx["symbol_definitions"] = definitions
 
+    # The warm-up is not waited for; it only shows up here if it already finished.
+    timings.update(prefetch.timings)
+    timings["wait_seconds"] = round(time.monotonic() - started, 3)
+    ctx["_context_timings"] = timings
+    counts = {name: float(value) for name, value in timings.items() if name.endswith("_seconds")}
+    counts["collections"] = 1
+    for flag in ("git_reused", "git_diff_cached", "symbols_ready"):
+        if flag in timings:
+            counts[flag] = int(timings[flag])
+    stats.record_counts(cwd, "context", counts)
+    if reduction is not None:
+        ctx["_output_reduction"] = reduction
+        reduced = {"runs": 1}
+        for name, counts in reduction["reducers"].items():
+            reduced[f"{name}_chars_in"] = counts["chars_in"]
+            reduced[f"{name}_chars_out"] = counts["chars_out"]
+        stats.record_counts(cwd, "reducers", reduced)
+    prefetch.cache.save()
     return ctx
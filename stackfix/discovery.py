@@ -0,0 +1,107 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+from . import transport
+from .config import load_config, save_config
+
+DEFAULT_PROBE_TIMEOUT = 2.0
+DEFAULT_DISCOVERY_TTL_SECONDS = 24 * 3600
+
+
+def _probe_timeout() -> float:
+    try:
+        return float(os.environ.get("STACKFIX_RELAY_PROBE_TIMEOUT", DEFAULT_PROBE_TIMEOUT))
+    except ValueError:
+        return DEFAULT_PROBE_TIMEOUT
+
+
+def _ttl_seconds() -> int:
+    try:
+        return int(os.environ.get("STACKFIX_RELAY_DISCOVERY_TTL", DEFAULT_DISCOVERY_TTL_SECONDS))
+    except ValueError:
+        return DEFAULT_DISCOVERY_TTL_SECONDS
+
+
+def healthz_url(base: str) -> str:
+    """The relay serves /healthz at its root, outside the /v1 API prefix."""
+    base = base.rstrip("/")
+    if base.endswith("/v1"):
+        base = base[: -len("/v1")]
+    return f"{base}/healthz"
+
+
+def _probe(base: str, timeout: float) -> Optional[float]:
+    """Seconds for a healthy /healthz response, or None if the relay is not usable."""
+    started = time.monotonic()
+    try:
+        resp = transport.get(healthz_url(base), timeout=(timeout, timeout))
+    except Exception:
+        return None
+    if resp.status_code != 200:
+        return None
+    return time.monotonic() - started
+
+
+def probe_fastest(candidates: List[str], timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """Probe all candidates at once and return the first healthy one to answer."""
+    if timeout is None:
+        timeout = _probe_timeout()
+    pool = ThreadPoolExecutor(max_workers=max(len(candidates), 1))
+    pending = {pool.submit(_probe, base, timeout): base for base in candidates}
+    deadline = time.monotonic() + timeout * 2
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                base = pending.pop(future)
+                latency = future.result()
+                if latency is not None:
+                    return {"url": base, "latency_ms": int(latency * 1000)}
+        return None
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def saved_relay(cwd: str, candidates: List[str]) -> Optional[str]:
+    entry = load_config(cwd).get("relay", {}).get("endpoint") or {}
+    url = entry.get("url")
+    if url not in candidates:
+        return None
+    try:
+        age = time.time() - float(entry.get("checked_at", 0))
+    except (TypeError, ValueError):
+        return None
+    return url if age < _ttl_seconds() else None
+
+
+def _save_choice(cwd: str, choice: Optional[Dict[str, Any]]) -> None:
+    cfg = load_config(cwd)
+    relay = cfg.get("relay", {})
+    if choice is None:
+        relay.pop("endpoint", None)
+    else:
+        relay["endpoint"] = dict(choice, checked_at=int(time.time()))
+    cfg["relay"] = relay
+    save_config(cwd, cfg)
+
+
+def discover_relay(cwd: str, candidates: List[str], force: bool = False) -> str:
+    """Pick a relay base URL, reusing the saved choice until it expires or force is set.
+
+    Falls back to the first candidate when none answers its health check.
+    """
+    if not force:
+        url = saved_relay(cwd, candidates)
+        if url:
+            return url
+    choice = probe_fastest(candidates)
+    try:
+        _save_choice(cwd, choice)
+    except OSError:
+        pass
+    return choice["url"] if choice else candidates[0]
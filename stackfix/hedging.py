@@ -0,0 +1,91 @@
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from .config import load_user_state, save_user_state, user_lock
+
+LATENCY_FILE = "latency.json"
+DEFAULT_HEDGE_DELAY = 8.0
+MIN_HEDGE_DELAY = 1.0
+MAX_HEDGE_DELAY = 60.0
+# Weights of a new sample in the moving average and in the mean deviation (as in TCP RTO).
+_ALPHA = 0.2
+_BETA = 0.25
+
+
+def race_enabled() -> bool:
+    return os.environ.get("STACKFIX_RACE") == "1"
+
+
+def load_latency() -> Dict[str, Dict[str, Any]]:
+    return load_user_state(LATENCY_FILE)
+
+
+def race_order(names: List[str]) -> List[str]:
+    """Measured providers fastest first, then unmeasured ones in their default order."""
+    latency = load_latency()
+
+    def _key(item):
+        index, name = item
+        average = (latency.get(name) or {}).get("avg_seconds")
+        if not isinstance(average, (int, float)):
+            return (1, 0.0, index)
+        return (0, float(average), index)
+
+    return [name for _, name in sorted(enumerate(names), key=_key)]
+
+
+def hedge_delay(name: str) -> float:
+    """Seconds to wait on name before starting the second provider.
+
+    STACKFIX_HEDGE_DELAY fixes the delay; otherwise it is the provider's
+    average plus twice its mean deviation, so the hedge only fires on a slow tail.
+    """
+    override = os.environ.get("STACKFIX_HEDGE_DELAY")
+    if override:
+        try:
+            return max(float(override), 0.0)
+        except ValueError:
+            pass
+    entry = load_latency().get(name) or {}
+    average = entry.get("avg_seconds")
+    if not isinstance(average, (int, float)):
+        return DEFAULT_HEDGE_DELAY
+    delay = average + 2 * float(entry.get("dev_seconds") or 0)
+    return min(max(delay, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+
+def _sample(entry: Dict[str, Any], seconds: float, outcome: str) -> Optional[float]:
+    average = entry.get("avg_seconds")
+    if outcome == "won":
+        return seconds
+    if outcome == "lost":
+        # A cancelled request only tells us the answer would have come later than this.
+        return seconds if average is None or seconds > average else None
+    # Failures count as twice the usual latency so an unreliable provider drops back.
+    return max(seconds, 2 * (average if average is not None else seconds))
+
+
+def record_latency(name: str, seconds: float, outcome: str) -> None:
+    """Fold one race result (won, lost or failed) into name's stats; never raises."""
+    try:
+        with user_lock():
+            data = load_latency()
+            entry = data.setdefault(name, {})
+            entry[outcome] = entry.get(outcome, 0) + 1
+            sample = _sample(entry, seconds, outcome)
+            if sample is not None:
+                average = entry.get("avg_seconds")
+                if average is None:
+                    entry["avg_seconds"] = sample
+                    entry["dev_seconds"] = sample / 2
+                else:
+                    deviation = entry.get("dev_seconds") or 0.0
+                    entry["dev_seconds"] = (1 - _BETA) * deviation + _BETA * abs(sample - average)
+                    entry["avg_seconds"] = (1 - _ALPHA) * average + _ALPHA * sample
+                entry["avg_seconds"] = round(entry["avg_seconds"], 3)
+                entry["dev_seconds"] = round(entry["dev_seconds"], 3)
+            entry["updated_at"] = int(time.time())
+            save_user_state(LATENCY_FILE, data)
+    except Exception:
+        pass
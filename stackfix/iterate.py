@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from . import reducers
+from .context import MAX_GIT_CHARS, MAX_STDIO_CHARS
+from .slicing import source_snippets
+from .util import is_git_repo, truncate_middle, truncate_text
+
+# Context that stays the same across iterations; kept so the prompt-cache prefix matches.
+CARRIED_CONTEXT_KEYS = ("cwd", "agent_instructions", "manifests", "repo_summary")
+
+
+def _git(cwd: str, args: List[str], env: Optional[Dict[str, str]] = None) -> str:
+    return subprocess.run(
+        ["git", *args], cwd=cwd, env=env, text=True, capture_output=True, check=True
+    ).stdout
+
+
+def snapshot_tree(cwd: str) -> Optional[str]:
+    """Tree id of the working tree, untracked files included, without touching the real index."""
+    if not is_git_repo(cwd):
+        return None
+    try:
+        index_path = _git(cwd, ["rev-parse", "--git-path", "index"]).strip()
+        with tempfile.TemporaryDirectory(prefix="stackfix-index-") as tmp:
+            temp_index = os.path.join(tmp, "index")
+            try:
+                # Starting from the real index lets git reuse its stat cache; copy2 keeps
+                # the index mtime so git still re-reads entries changed in the same second.
+                shutil.copy2(os.path.join(cwd, index_path), temp_index)
+            except OSError:
+                pass
+            env = dict(os.environ, GIT_INDEX_FILE=temp_index)
+            _git(cwd, ["add", "-A", "--", ".", ":(exclude).stackfix"], env=env)
+            return _git(cwd, ["write-tree"], env=env).strip()
+    except Exception:
+        return None
+
+
+def diff_since(cwd: str, tree: Optional[str]) -> str:
+    if not tree:
+        return ""
+    current = snapshot_tree(cwd)
+    if not current or current == tree:
+        return ""
+    try:
+        return _git(cwd, ["diff", tree, current])
+    except Exception:
+        return ""
+
+
+def incremental_context(
+    base_context: Dict[str, Any],
+    iteration: int,
+    previous_patch: str,
+    previous_summary: str,
+    exit_code: int,
+    stdout: str,
+    stderr: str,
+    changes: str,
+) -> Dict[str, Any]:
+    """Follow-up request: the last patch, the new failure and what changed since the last call.
+
+    The new output is reduced like the first, and source snippets are sliced
+    again from it and the patched files.
+    """
+    if reducers.reducing_enabled():
+        stdout, stderr, _ = reducers.reduce_output(base_context.get("command") or [], stdout, stderr)
+    context = {key: base_context[key] for key in CARRIED_CONTEXT_KEYS if key in base_context}
+    context.update(
+        {
+            "command": base_context.get("command"),
+            "iteration": iteration,
+            "note": "The previous patch was applied and the command still fails. Propose a follow-up patch "
+            "against the current files.",
+            "previous_summary": previous_summary,
+            "previous_patch": truncate_text(previous_patch, MAX_GIT_CHARS),
+            "exit_code": exit_code,
+            "stdout": truncate_middle(stdout, MAX_STDIO_CHARS),
+            "stderr": truncate_middle(stderr, MAX_STDIO_CHARS),
+            "diff_since_last_iteration": truncate_text(changes, MAX_GIT_CHARS),
+        }
+    )
+    snippets = source_snippets(base_context["cwd"], stdout, stderr) if base_context.get("cwd") else []
+    if snippets:
+        context["source_snippets"] = snippets
+    return context
+
+
+def tokens_used(context: Dict[str, Any], agent_result: Dict[str, Any]) -> int:
+    """Tokens reported by the provider, or a rough 4-characters-per-token estimate."""
+    usage = agent_result.get("_usage")
+    if isinstance(usage, dict):
+        total = usage.get("total_tokens")
+        if total is None:
+            total = (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+        try:
+            return int(total)
+        except (TypeError, ValueError):
+            pass
+    sent = len(json.dumps({k: v for k, v in context.items() if not k.startswith("_")}))
+    received = len(agent_result.get("_raw_content") or "") or len(json.dumps(agent_result, default=str))
+    return (sent + received) // 4
+
+
+class LoopBudget:
+    """Iteration, wall-time and token limits for --max-iterations."""
+
+    def __init__(self, max_iterations: int, time_budget: Optional[float], token_budget: Optional[int]) -> None:
+        self.max_iterations = max_iterations
+        self.time_budget = time_budget
+        self.token_budget = token_budget
+        self.started = time.monotonic()
+        self.tokens = 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def stop_reason(self, iteration: int) -> Optional[str]:
+        """Why iteration (1-based) must not start, or None when it may."""
+        if iteration > self.max_iterations:
+            return f"reached --max-iterations {self.max_iterations}"
+        if self.time_budget is not None and self.elapsed() >= self.time_budget:
+            return f"time budget of {self.time_budget:g}s used"
+        if self.token_budget is not None and self.tokens >= self.token_budget:
+            return f"token budget of {self.token_budget} used ({self.tokens} tokens)"
+        return None
@@ -0,0 +1,249 @@
+import json
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import tomllib
+except ImportError:  # pragma: no cover - Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Lockfiles this large are still summarized; they are read once per change and never sent whole.
+MAX_LOCKFILE_BYTES = 20_000_000
+# Entries sent for packages the failure output names.
+MAX_FAILURE_ENTRIES = 40
+# Direct dependencies listed per lockfile in the manifests section.
+MAX_DIRECT_ENTRIES = 200
+
+Table = Dict[str, List[str]]
+
+_YARN_VERSION = re.compile(r'^\s+version:?\s+"?([^"\s]+)"?')
+# v5: /name/1.2.3, v6: /name@1.2.3, v9: name@1.2.3; scoped names keep their leading @.
+_PNPM_KEY = re.compile(r"^  '?/?(@[^/@\s]+/[^/@\s(]+|[^/@\s(']+)[@/](\d[^():'\s_]*)")
+_POETRY_FIELD = re.compile(r'^(name|version)\s*=\s*"([^"]+)"')
+_PEP508_NAME = re.compile(r"\s*([A-Za-z0-9][A-Za-z0-9._\-]*)")
+_SCOPED_TOKEN = re.compile(r"@[\w.\-]+/[\w.\-]+")
+_WORD_TOKEN = re.compile(r"[A-Za-z0-9][\w.\-]*")
+# A quoted module specifier, as in "Cannot find module 'lodash/fp'" or "No module named 'yaml'".
+_QUOTED_SPECIFIER = re.compile(r"""['"`]((?:@[\w.\-]+/)?[\w.\-]+)[^'"`\s]*['"`]""")
+_TOML_HEADER = re.compile(r"^\s*\[+\s*([^\]]+?)\s*\]+\s*(?:#.*)?$")
+_TOML_STRING = re.compile(r"\"([^\"\n]*)\"|'([^'\n]*)'|(\])")
+_TOML_KEY = re.compile(r"^\s*\"?([A-Za-z0-9][A-Za-z0-9._\-]*)\"?\s*=", re.MULTILINE)
+
+
+def _add(table: Table, name: str, version: str) -> None:
+    versions = table.setdefault(name, [])
+    if version not in versions:
+        versions.append(version)
+
+
+def _yarn_name(spec: str) -> str:
+    spec = spec.strip().strip('"')
+    # The @ of a scope is not the version separator.
+    return "@" + spec[1:].split("@", 1)[0] if spec.startswith("@") else spec.split("@", 1)[0]
+
+
+def parse_yarn(text: str) -> Table:
+    """yarn.lock, classic (v1) or berry: `"a@^1", a@^1.2:` headers followed by a version line."""
+    table: Table = {}
+    names: List[str] = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        if not line[0].isspace():
+            names = [_yarn_name(spec) for spec in line.rstrip(":").split(",")] if line.endswith(":") else []
+            continue
+        match = _YARN_VERSION.match(line) if names else None
+        if match:
+            for name in names:
+                if name and name != "__metadata":
+                    _add(table, name, match.group(1))
+            names = []
+    return table
+
+
+def parse_pnpm(text: str) -> Table:
+    """pnpm-lock.yaml v5 to v9: the keys of `packages:` (and `snapshots:`)."""
+    table: Table = {}
+    in_packages = False
+    for line in text.splitlines():
+        if line and not line[0].isspace():
+            in_packages = line.rstrip() in ("packages:", "snapshots:")
+            continue
+        if in_packages:
+            match = _PNPM_KEY.match(line)
+            if match:
+                _add(table, match.group(1), match.group(2))
+    return table
+
+
+def parse_poetry(text: str) -> Table:
+    """poetry.lock: the name and version of each [[package]] table."""
+    packages: List[Dict[str, str]] = []
+    current: Optional[Dict[str, str]] = None
+    for line in text.splitlines():
+        if line.startswith("["):
+            # Sub-tables such as [package.dependencies] end the fields of the package.
+            current = {} if line.strip() == "[[package]]" else None
+            if current is not None:
+                packages.append(current)
+            continue
+        match = _POETRY_FIELD.match(line) if current is not None else None
+        if match:
+            current.setdefault(match.group(1), match.group(2))
+    table: Table = {}
+    for package in packages:
+        if "name" in package and "version" in package:
+            _add(table, normalize_python_name(package["name"]), package["version"])
+    return table
+
+
+PARSERS: Dict[str, Callable[[str], Table]] = {
+    "yarn.lock": parse_yarn,
+    "pnpm-lock.yaml": parse_pnpm,
+    "poetry.lock": parse_poetry,
+}
+# Lockfiles whose names compare after PEP 503 normalization.
+PYTHON_LOCKFILES = {"poetry.lock"}
+
+
+def normalize_python_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def package_json_dependencies(content: str) -> Set[str]:
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return set()
+    names: Set[str] = set()
+    if isinstance(data, dict):
+        for key in ("dependencies", "devDependencies", "peerDependencies", "optionalDependencies"):
+            if isinstance(data.get(key), dict):
+                names.update(data[key])
+    return names
+
+
+def _toml_strings(text: str, start: int = 0, array: bool = False) -> List[str]:
+    strings = []
+    for match in _TOML_STRING.finditer(text, start):
+        if match.group(3) is not None:
+            if array:
+                break
+            continue
+        strings.append(match.group(1) if match.group(1) is not None else match.group(2))
+    return strings
+
+
+def _scan_pyproject(content: str) -> Tuple[List[str], List[str]]:
+    """(PEP 508 requirements, Poetry dependency names), read line by line without a TOML parser."""
+    sections: Dict[str, List[str]] = {}
+    section = ""
+    for line in content.splitlines():
+        header = _TOML_HEADER.match(line)
+        if header:
+            section = header.group(1)
+            continue
+        sections.setdefault(section, []).append(line)
+    requirements: List[str] = []
+    project = "\n".join(sections.get("project", []))
+    start = re.search(r"^\s*dependencies\s*=\s*\[", project, re.MULTILINE)
+    if start:
+        requirements.extend(_toml_strings(project, start.end(), array=True))
+    requirements.extend(_toml_strings("\n".join(sections.get("project.optional-dependencies", []))))
+    poetry: List[str] = []
+    for name, lines in sections.items():
+        if name.startswith("tool.poetry") and name.endswith("dependencies"):
+            poetry.extend(_TOML_KEY.findall("\n".join(lines)))
+    return requirements, poetry
+
+
+def pyproject_requirements(content: str) -> Tuple[List[str], List[str]]:
+    """(PEP 621 requirement strings, Poetry dependency names) declared in pyproject.toml.
+
+    Only the dependency tables count, and Poetry's python key is left out.
+    Without tomllib or tomli the file is scanned line by line, which covers
+    the usual layouts of those tables.
+    """
+    if tomllib is None:
+        requirements, poetry = _scan_pyproject(content)
+    else:
+        try:
+            data = tomllib.loads(content)
+        except ValueError:
+            return [], []
+        project = data.get("project") or {}
+        requirements = list(project.get("dependencies") or [])
+        for extra in (project.get("optional-dependencies") or {}).values():
+            requirements.extend(extra)
+        tool_poetry = (data.get("tool") or {}).get("poetry") or {}
+        tables = [tool_poetry.get("dependencies") or {}, tool_poetry.get("dev-dependencies") or {}]
+        tables.extend(group.get("dependencies") or {} for group in (tool_poetry.get("group") or {}).values())
+        poetry = [name for table in tables for name in table]
+    return [str(requirement) for requirement in requirements], [name for name in poetry if name != "python"]
+
+
+def pyproject_dependencies(content: str) -> Set[str]:
+    """PEP 621 and Poetry dependency names, normalized."""
+    requirements, poetry = pyproject_requirements(content)
+    names = set()
+    for requirement in requirements:
+        match = _PEP508_NAME.match(requirement)
+        if match:
+            names.add(normalize_python_name(match.group(1)))
+    names.update(normalize_python_name(name) for name in poetry)
+    return names
+
+
+def _versions(table: Table, names: Iterable[str], limit: int) -> Dict[str, str]:
+    """Versions of the names found in table, in the order given, up to limit."""
+    entries = {}
+    for name in names:
+        if name in table:
+            entries[name] = ", ".join(table[name])
+            if len(entries) >= limit:
+                break
+    return entries
+
+
+def summarize(table: Table, direct: Set[str]) -> Dict[str, Any]:
+    """What goes in the manifests section for a lockfile: its size and the direct dependencies' versions."""
+    return {"packages": len(table), "direct": _versions(table, sorted(direct), MAX_DIRECT_ENTRIES)}
+
+
+def _mentions(text: str) -> List[str]:
+    """Names in text that may be packages, most telling first.
+
+    Quoted module specifiers, as import and require errors print them, come
+    first. Other words follow from the end of the output backwards, since the
+    error that stopped the command is usually last. Common words that are also
+    package names, such as test, debug or color, then rank behind the culprit.
+    """
+    last: Dict[str, int] = {}
+    for pattern in (_SCOPED_TOKEN, _WORD_TOKEN):
+        for match in pattern.finditer(text):
+            last[match.group(0).rstrip(".-")] = match.end()
+    quoted = [match.group(1) for match in _QUOTED_SPECIFIER.finditer(text)]
+    ranked = list(dict.fromkeys(reversed(quoted)))
+    seen = set(ranked)
+    ranked.extend(sorted((token for token in last if token not in seen), key=lambda token: -last[token]))
+    return ranked
+
+
+def failure_entries(tables: Dict[str, Table], text: str) -> Dict[str, Dict[str, str]]:
+    """Per lockfile, the locked versions of packages named in text, the most telling MAX_FAILURE_ENTRIES."""
+    mentions = _mentions(text)
+    python_mentions = list(dict.fromkeys(normalize_python_name(token) for token in mentions))
+    found = {}
+    for name, table in tables.items():
+        entries = _versions(table, python_mentions if name in PYTHON_LOCKFILES else mentions, MAX_FAILURE_ENTRIES)
+        if entries:
+            found[name] = entries
+    return found
+
+
+def parse(name: str, content: str) -> Optional[Table]:
+    parser = PARSERS.get(name)
+    return parser(content) if parser else None
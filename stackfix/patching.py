@@ -1,7 +1,8 @@
+import difflib
 import os
 import re
 import subprocess
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from .safety import is_forbidden_path
 from .util import is_git_repo
@@ -116,14 +117,20 @@ def _apply_simple_replace(path: str, old_lines: List[str], new_lines: List[str])
         f.write(content)
 
 
+def _git_apply_cmd(cwd: str, check: bool = False) -> List[str]:
+    cmd = ["git", "apply"]
+    if not is_git_repo(cwd):
+        cmd.append("--no-index")
+    if check:
+        cmd.append("--check")
+    return cmd + ["--whitespace=nowarn", "-"]
+
+
 def apply_patch(diff_text: str, cwd: str) -> None:
     paths = validate_patch_paths(diff_text, cwd)
 
     if _is_valid_unified_diff(diff_text):
-        if is_git_repo(cwd):
-            cmd = ["git", "apply", "--whitespace=nowarn", "-"]
-        else:
-            cmd = ["git", "apply", "--no-index", "--whitespace=nowarn", "-"]
+        cmd = _git_apply_cmd(cwd)
         proc = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE, text=True)
         proc.communicate(diff_text)
         if proc.returncode == 0:
@@ -136,3 +143,332 @@ def apply_patch(diff_text: str, cwd: str) -> None:
     abs_path = os.path.abspath(os.path.join(cwd, rel))
     old_lines, new_lines = _parse_simple_blocks(diff_text)
     _apply_simple_replace(abs_path, old_lines, new_lines)
+
+
+REPAIR_CONTEXT_LINES = 3
+
+
+class _FilePatch:
+    def __init__(self, path: str, kind: str = "update") -> None:
+        self.path = path
+        self.kind = kind
+        self.hunks: List[Tuple[Optional[int], List[str]]] = []
+
+
+def _strip_diff_path(value: str) -> str:
+    path = value.strip().split("\t", 1)[0].strip()
+    if path.startswith("a/") or path.startswith("b/"):
+        path = path[2:]
+    return path
+
+
+def _hunk_start_hint(header: str) -> Optional[int]:
+    match = re.match(r"^@@ -(\d+)", header)
+    return int(match.group(1)) if match else None
+
+
+def _parse_loose_unified(diff_text: str) -> List[_FilePatch]:
+    files: List[_FilePatch] = []
+    current: Optional[_FilePatch] = None
+    lines = diff_text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("diff --git "):
+            parts = line.split(" b/", 1)
+            current = _FilePatch(parts[1].strip() if len(parts) == 2 else "")
+            files.append(current)
+        elif line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ "):
+            old_path = _strip_diff_path(line[4:])
+            new_path = _strip_diff_path(lines[i + 1][4:])
+            if current is None or current.hunks:
+                current = _FilePatch("")
+                files.append(current)
+            if old_path == "/dev/null":
+                current.kind = "add"
+            elif new_path == "/dev/null":
+                current.kind = "delete"
+            current.path = new_path if new_path != "/dev/null" else old_path
+            i += 1
+        elif line.startswith("@@"):
+            if current is None:
+                return []
+            current.hunks.append((_hunk_start_hint(line), []))
+        elif current is not None and current.hunks:
+            current.hunks[-1][1].append(line)
+        i += 1
+    return files
+
+
+def _parse_begin_patch(diff_text: str) -> List[_FilePatch]:
+    files: List[_FilePatch] = []
+    current: Optional[_FilePatch] = None
+    markers = (("*** Update File: ", "update"), ("*** Add File: ", "add"), ("*** Delete File: ", "delete"))
+    for line in diff_text.splitlines():
+        if line.startswith("*** Begin Patch") or line.startswith("*** End Patch") or line.startswith("*** End of File"):
+            continue
+        if line.startswith("*** Move to: "):
+            return []
+        marker = next(((m, kind) for m, kind in markers if line.startswith(m)), None)
+        if marker is not None:
+            current = _FilePatch(line[len(marker[0]):].strip(), marker[1])
+            files.append(current)
+            if current.kind == "add":
+                current.hunks.append((None, []))
+            continue
+        if current is None:
+            continue
+        if line.startswith("@@"):
+            current.hunks.append((None, []))
+            continue
+        if not current.hunks:
+            current.hunks.append((None, []))
+        current.hunks[-1][1].append(line)
+    return files
+
+
+def _normalize_body(body: List[str]) -> List[str]:
+    out = []
+    for line in body:
+        if line.startswith("\\"):
+            continue
+        if not line:
+            out.append(" ")
+        elif line[0] in " +-":
+            out.append(line)
+        else:
+            out.append(" " + line)
+    while out and out[-1] == " ":
+        out.pop()
+    return out
+
+
+def _find_block(file_lines: List[str], old: List[str], search_from: int, hint: Optional[int]) -> Optional[int]:
+    for normalize in (lambda v: v, lambda v: v.rstrip()):
+        target = [normalize(v) for v in old]
+        matches = [
+            start
+            for start in range(search_from, len(file_lines) - len(old) + 1)
+            if [normalize(v) for v in file_lines[start:start + len(old)]] == target
+        ]
+        if matches:
+            if hint is None:
+                return matches[0]
+            return min(matches, key=lambda start: abs(start + 1 - hint))
+    return None
+
+
+def _render_file_patch(fp: _FilePatch, cwd: str) -> Optional[str]:
+    abs_path = os.path.abspath(os.path.join(cwd, fp.path))
+    if not fp.path or is_forbidden_path(abs_path, cwd):
+        return None
+    header = [f"diff --git a/{fp.path} b/{fp.path}"]
+    if fp.kind == "add":
+        added = [line[1:] if line.startswith("+") else line for hunk in fp.hunks for line in hunk[1]]
+        while added and not added[-1]:
+            added.pop()
+        header += ["new file mode 100644", "--- /dev/null", f"+++ b/{fp.path}", f"@@ -0,0 +1,{len(added)} @@"]
+        return "\n".join(header + ["+" + line for line in added]) + "\n"
+    try:
+        with open(abs_path, "r", encoding="utf-8", errors="replace") as f:
+            file_lines = f.read().splitlines()
+    except OSError:
+        return None
+    if fp.kind == "delete":
+        header += ["deleted file mode 100644", f"--- a/{fp.path}", "+++ /dev/null", f"@@ -1,{len(file_lines)} +0,0 @@"]
+        return "\n".join(header + ["-" + line for line in file_lines]) + "\n"
+
+    header += [f"--- a/{fp.path}", f"+++ b/{fp.path}"]
+    located = []
+    search_from = 0
+    for hint, raw_body in fp.hunks:
+        body = _normalize_body(raw_body)
+        old = [line[1:] for line in body if line[0] in " -"]
+        if not old or not any(line[0] in "+-" for line in body):
+            return None
+        start = _find_block(file_lines, old, search_from, hint)
+        if start is None:
+            return None
+        actual = iter(file_lines[start:start + len(old)])
+        located.append((start, start + len(old), [line if line[0] == "+" else line[0] + next(actual) for line in body]))
+        search_from = start + len(old)
+    if not located:
+        return None
+
+    # git apply anchors a hunk without trailing context to end of file, so pad
+    # every hunk with real context lines, never overlapping its neighbours.
+    out = []
+    offset = 0
+    prev_end = 0
+    for index, (start, end, body) in enumerate(located):
+        next_start = located[index + 1][0] if index + 1 < len(located) else len(file_lines)
+        lead_from = max(start - REPAIR_CONTEXT_LINES, prev_end)
+        trail_to = min(end + REPAIR_CONTEXT_LINES, next_start)
+        body = (
+            [" " + line for line in file_lines[lead_from:start]]
+            + body
+            + [" " + line for line in file_lines[end:trail_to]]
+        )
+        old_len = sum(1 for line in body if line[0] in " -")
+        new_len = sum(1 for line in body if line[0] in " +")
+        out.append(f"@@ -{lead_from + 1},{old_len} +{lead_from + 1 + offset},{new_len} @@")
+        out.extend(body)
+        offset += new_len - old_len
+        prev_end = trail_to
+    return "\n".join(header + out) + "\n"
+
+
+def _git_apply_check(diff_text: str, cwd: str) -> bool:
+    try:
+        proc = subprocess.run(
+            _git_apply_cmd(cwd, check=True),
+            cwd=cwd,
+            input=diff_text,
+            text=True,
+            capture_output=True,
+            timeout=30,
+        )
+    except Exception:
+        return False
+    return proc.returncode == 0
+
+
+def repair_unified_diff(diff_text: str, cwd: str) -> Optional[str]:
+    """Rebuild a malformed diff against the files on disk; None if it cannot be made to apply.
+
+    Handles bare or wrong @@ ranges, missing diff --git/---/+++ headers and
+    *** Begin Patch blocks. The result is dry-run with git apply --check.
+    """
+    if not diff_text or not diff_text.strip():
+        return None
+    if _is_begin_patch(diff_text):
+        files = _parse_begin_patch(diff_text)
+    else:
+        files = _parse_loose_unified(diff_text)
+    if not files:
+        return None
+    rendered = []
+    for fp in files:
+        text = _render_file_patch(fp, cwd)
+        if text is None:
+            return None
+        rendered.append(text)
+    repaired = "".join(rendered)
+    if not _git_apply_check(repaired, cwd):
+        return None
+    return repaired
+
+
+def _match_lines(content: str, search: str) -> Optional[Tuple[int, int, str]]:
+    """Find search ignoring indentation and trailing whitespace: (start, end, extra indent)."""
+    file_lines = content.splitlines(keepends=True)
+    target = [line.strip() for line in search.splitlines()]
+    while target and not target[-1]:
+        target.pop()
+    while target and not target[0]:
+        target.pop(0)
+    if not target:
+        return None
+    matches = [
+        start
+        for start in range(len(file_lines) - len(target) + 1)
+        if [line.strip() for line in file_lines[start:start + len(target)]] == target
+    ]
+    if len(matches) != 1:
+        return None
+    start = matches[0]
+    first = file_lines[start]
+    search_first = next(line for line in search.splitlines() if line.strip())
+    file_indent = first[: len(first) - len(first.lstrip())]
+    search_indent = search_first[: len(search_first) - len(search_first.lstrip())]
+    indent = file_indent[: len(file_indent) - len(search_indent)] if file_indent.endswith(search_indent) else ""
+    begin = sum(len(line) for line in file_lines[:start])
+    end = begin + sum(len(line) for line in file_lines[start:start + len(target)])
+    return begin, end, indent
+
+
+def _replace_block(content: str, search: str, replace: str, path: str) -> str:
+    count = content.count(search)
+    if count == 1:
+        return content.replace(search, replace, 1)
+    if count > 1:
+        raise RuntimeError(f"Search block for {path} matches {count} times; include more context")
+    located = _match_lines(content, search)
+    if located is None:
+        raise RuntimeError(f"Search block not found in {path}")
+    begin, end, indent = located
+    lines = replace.splitlines(keepends=True)
+    if indent:
+        lines = [indent + line if line.strip() else line for line in lines]
+    block = "".join(lines)
+    if content[begin:end].endswith("\n") and not block.endswith("\n"):
+        block += "\n"
+    return content[:begin] + block + content[end:]
+
+
+def _diff_lines(lines: List[str]) -> List[str]:
+    out = []
+    for line in lines:
+        if line.endswith("\n"):
+            out.append(line)
+        else:
+            out.append(line + "\n\\ No newline at end of file\n")
+    return out
+
+
+def search_replace_to_diff(edits: List[Dict[str, Any]], cwd: str) -> str:
+    """Unified diff for a list of {path, search, replace} edits, matched against the files on disk.
+
+    Edits to one file apply in order. Each search block must match once,
+    verbatim or else ignoring indentation and trailing whitespace; an empty
+    search creates a new file. Raises RuntimeError when an edit cannot be placed.
+    """
+    originals: Dict[str, Optional[str]] = {}
+    updated: Dict[str, str] = {}
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise RuntimeError("Edit is not an object with path, search and replace")
+        path = str(edit.get("path") or "").strip()
+        search = str(edit.get("search") or "")
+        replace = str(edit.get("replace") or "")
+        if path.startswith("a/") or path.startswith("b/"):
+            path = path[2:]
+        abs_path = os.path.abspath(os.path.join(cwd, path))
+        if not path or is_forbidden_path(abs_path, cwd):
+            raise RuntimeError(f"Edit touches forbidden path: {path}")
+        if path not in originals:
+            try:
+                with open(abs_path, "r", encoding="utf-8", errors="replace", newline="") as f:
+                    originals[path] = f.read()
+            except FileNotFoundError:
+                originals[path] = None
+            updated[path] = originals[path] or ""
+        if not search.strip():
+            if originals[path] is not None:
+                raise RuntimeError(f"Edit for existing file {path} has an empty search block")
+            updated[path] += replace
+            continue
+        updated[path] = _replace_block(updated[path], search, replace, path)
+
+    rendered = []
+    for path, new_text in updated.items():
+        old_text = originals[path]
+        if old_text == new_text:
+            continue
+        old_lines = (old_text or "").splitlines(keepends=True)
+        new_lines = new_text.splitlines(keepends=True)
+        header = [f"diff --git a/{path} b/{path}\n"]
+        if old_text is None:
+            header.append("new file mode 100644\n")
+        hunks = difflib.unified_diff(
+            old_lines,
+            new_lines,
+            fromfile="/dev/null" if old_text is None else f"a/{path}",
+            tofile=f"b/{path}",
+            n=REPAIR_CONTEXT_LINES,
+        )
+        body = list(hunks)
+        rendered.append("".join(header) + "".join(body[:2]) + "".join(_diff_lines(body[2:])))
+    if not rendered:
+        raise RuntimeError("Edits make no changes")
+    return "".join(rendered)
@@ -0,0 +1,254 @@
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# A reducer takes one output stream and returns it shorter, or None when it does not apply.
+Reducer = Callable[[str], Optional[str]]
+
+_ANSI = re.compile(r"\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]")
+# tqdm, pip and npm style bars; a run of block characters next to a percentage or a size.
+_PROGRESS_BAR = re.compile(
+    r"[█▉▊▋▌▍▎▏━░▒▓]{5,}.*?(?:\d+%|\d+(?:\.\d+)?/\d+(?:\.\d+)?\s*[kMG]?i?B|eta)"
+    r"|\d+%\s*\|[█▉▊▋▌▍▎▏ ]*\|"
+    r"|\[[#=>\-. ]{10,}\]\s*\d{1,3}%"
+)
+# Notes StackFix itself puts in output, such as the capture's elided-lines marker; always kept.
+_NOTE = re.compile(r"^\.\.\. \[.*\]")
+# Lines that are a warning, by their prefix: Python's "path:1: DeprecationWarning:",
+# compiler "warning:" and "file:1:2: warning:", npm's "WARN". Traceback frames that only
+# mention a name such as deprecated_helper do not match.
+_WARNING_LINE = re.compile(r"^\s*(?:\S+:\d+: )?(?:\w*Warning|warning(?:\[\w+\])?):|^\s*(?:npm )?WARN\b")
+# A line repeated more than this many times in a row is collapsed into a note.
+MAX_REPEATS = 2
+
+
+def reducing_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_REDUCE") != "1"
+
+
+def strip_ansi(text: str) -> Optional[str]:
+    return _ANSI.sub("", text)
+
+
+def resolve_redraws(text: str) -> Optional[str]:
+    """Keep what a terminal would finally show of each carriage-return redraw; drop progress bars."""
+    lines = []
+    for line in text.split("\n"):
+        if "\r" in line:
+            parts = [part for part in line.split("\r") if part]
+            line = parts[-1] if parts else ""
+        if _PROGRESS_BAR.search(line):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def collapse_repeats(text: str) -> Optional[str]:
+    """Collapse runs of identical lines, and drop warning lines already seen earlier."""
+    lines: List[str] = []
+    seen_warnings = set()
+    dropped_warnings = 0
+    run = 0
+
+    def _end_run() -> None:
+        if run > MAX_REPEATS:
+            lines.append(f"... [previous line repeated {run} more times]")
+        elif run:
+            lines.extend([lines[-1]] * run)
+
+    for line in text.split("\n"):
+        if lines and line == lines[-1] and line.strip():
+            run += 1
+            continue
+        _end_run()
+        run = 0
+        if _WARNING_LINE.match(line):
+            if line in seen_warnings:
+                dropped_warnings += 1
+                continue
+            seen_warnings.add(line)
+        lines.append(line)
+    _end_run()
+    if dropped_warnings:
+        lines.append(f"... [{dropped_warnings} repeated warning lines removed]")
+    return "\n".join(lines)
+
+
+_PYTEST_SECTION = re.compile(r"^={3,} (?P<title>.*?) ={3,}$")
+_PYTEST_KEPT = ("FAILURES", "ERRORS", "short test summary info")
+_PYTEST_SUMMARY = re.compile(r"\b\d+ (?:failed|passed|errors?|skipped|xfailed|deselected)\b|no tests ran")
+
+
+def _pytest(text: str) -> Optional[str]:
+    """The FAILURES, ERRORS and short summary sections and the final tally; progress and passes go."""
+    kept: List[str] = []
+    keeping = False
+    found = False
+    for line in text.split("\n"):
+        section = _PYTEST_SECTION.match(line)
+        if section:
+            title = section.group("title")
+            keeping = title in _PYTEST_KEPT
+            if keeping or _PYTEST_SUMMARY.search(title):
+                found = True
+                kept.append(line)
+            continue
+        if keeping or _NOTE.match(line):
+            kept.append(line)
+    return "\n".join(kept) if found else None
+
+
+_JEST_FAIL = re.compile(r"^\s*FAIL\s")
+_JEST_PASS = re.compile(r"^\s*PASS\s")
+_JEST_SUMMARY = re.compile(r"^(?:Test Suites|Tests|Snapshots|Time):|^Ran all test suites")
+_JEST_PASSED_TEST = re.compile(r"^\s*[✓√○]")
+
+
+def _jest(text: str) -> Optional[str]:
+    """FAIL suites with their ● failure blocks and the summary; PASS suites and passing tests go."""
+    kept: List[str] = []
+    keeping = False
+    for line in text.split("\n"):
+        if _JEST_FAIL.match(line):
+            keeping = True
+        elif _JEST_PASS.match(line):
+            keeping = False
+            continue
+        elif _JEST_SUMMARY.match(line):
+            keeping = False
+            kept.append(line)
+            continue
+        if (keeping and not _JEST_PASSED_TEST.match(line)) or _NOTE.match(line):
+            kept.append(line)
+    return "\n".join(kept) if kept else None
+
+
+_TSC_ERROR = re.compile(r"^\S.*?(?:\(\d+,\d+\): | ?:\d+:\d+ - )error TS\d+:")
+_TSC_FOUND = re.compile(r"^Found \d+ errors?")
+
+
+def _tsc(text: str) -> Optional[str]:
+    """Error lines with their continuation and code frame, and the error count."""
+    kept: List[str] = []
+    keeping = False
+    for line in text.split("\n"):
+        if _TSC_ERROR.match(line) or _TSC_FOUND.match(line):
+            keeping = True
+            kept.append(line)
+        elif _NOTE.match(line):
+            kept.append(line)
+        elif keeping and line.strip() and (line[0].isspace() or line[0].isdigit() or line.startswith("~")):
+            kept.append(line)
+        else:
+            keeping = False
+    return "\n".join(kept) if kept else None
+
+
+_CARGO_PROGRESS = re.compile(
+    r"^\s*(?:Compiling|Checking|Downloaded|Downloading|Updating|Fresh|Blocking|Locking|Adding|Finished|Documenting)\s"
+)
+
+
+def _cargo(text: str) -> Optional[str]:
+    """Everything but build progress and warning blocks, which are counted instead."""
+    kept: List[str] = []
+    in_warning = False
+    warnings = 0
+    for line in text.split("\n"):
+        if re.match(r"^warning(?:\[\w+\])?: ", line) and " generated " not in line:
+            in_warning = True
+            warnings += 1
+            continue
+        if in_warning:
+            if line.strip():
+                continue
+            in_warning = False
+            continue
+        if _CARGO_PROGRESS.match(line):
+            continue
+        kept.append(line)
+    if warnings:
+        kept.append(f"... [{warnings} warnings removed]")
+    return "\n".join(kept)
+
+
+_PIP_PROGRESS = re.compile(
+    r"^\s*(?:Collecting|Downloading|Using cached|Requirement already satisfied|Obtaining|Processing"
+    r"|Looking in indexes|Installing build dependencies|Getting requirements|Preparing metadata"
+    r"|Building wheel|Created wheel|Stored in directory|Installing collected packages)\b"
+)
+
+
+def _pip(text: str) -> Optional[str]:
+    """Everything but resolver and download progress."""
+    return "\n".join(line for line in text.split("\n") if not _PIP_PROGRESS.match(line))
+
+
+# Applied to every stream, in order.
+GENERIC_REDUCERS: List[Tuple[str, Reducer]] = [
+    ("ansi", strip_ansi),
+    ("progress", resolve_redraws),
+    ("repeats", collapse_repeats),
+]
+# (tool, command names, output signature, reducer); the first match wins.
+TOOLS: List[Tuple[str, Tuple[str, ...], "re.Pattern", Reducer]] = [
+    (
+        "pytest",
+        ("pytest", "py.test"),
+        re.compile(r"^={3,} (?:FAILURES|ERRORS|test session starts) ={3,}$", re.M),
+        _pytest,
+    ),
+    ("jest", ("jest", "vitest"), re.compile(r"^(?:Test Suites|Tests): ", re.M), _jest),
+    ("tsc", ("tsc", "vue-tsc"), re.compile(r"error TS\d+:"), _tsc),
+    ("cargo", ("cargo",), re.compile(r"^\s+Compiling \S+ v\d|^error\[E\d{4}\]", re.M), _cargo),
+    (
+        "pip",
+        ("pip", "pip3"),
+        re.compile(r"^(?:Collecting \S|ERROR: (?:Could not|No matching distribution))", re.M),
+        _pip,
+    ),
+]
+
+
+def detect_tool(command: Sequence[str], text: str) -> Optional[str]:
+    """The tool that produced text: named in the command, else recognised from the output."""
+    words = {os.path.basename(str(arg)).lower() for arg in command}
+    for name, commands, _, _ in TOOLS:
+        if words.intersection(commands):
+            return name
+    for name, _, signature, _ in TOOLS:
+        if signature.search(text):
+            return name
+    return None
+
+
+def reduce_output(command: Sequence[str], stdout: str, stderr: str) -> Tuple[str, str, Dict[str, Any]]:
+    """stdout and stderr with noise removed, and a report of what each reducer did.
+
+    The report gives the detected tool and, per reducer, the characters before
+    and after it ran over both streams. A tool reducer that finds nothing it
+    recognises leaves the stream as it was.
+    """
+    report: Dict[str, Any] = {"tool": None, "chars_in": len(stdout) + len(stderr), "reducers": {}}
+    streams = [stdout, stderr]
+    for name, reducer in GENERIC_REDUCERS:
+        streams = [_apply(report, name, reducer, text) for text in streams]
+    tool = detect_tool(command, "\n".join(streams))
+    if tool is not None:
+        report["tool"] = tool
+        reducer = next(entry[3] for entry in TOOLS if entry[0] == tool)
+        streams = [_apply(report, tool, reducer, text) for text in streams]
+    report["chars_out"] = sum(len(text) for text in streams)
+    return streams[0], streams[1], report
+
+
+def _apply(report: Dict[str, Any], name: str, reducer: Reducer, text: str) -> str:
+    if not text:
+        return text
+    reduced = reducer(text)
+    if reduced is None or not reduced.strip():
+        reduced = text
+    counts = report["reducers"].setdefault(name, {"chars_in": 0, "chars_out": 0})
+    counts["chars_in"] += len(text)
+    counts["chars_out"] += len(reduced)
+    return reduced
@@ -0,0 +1,207 @@
+import asyncio
+import email.utils
+import os
+import random
+import re
+import time
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+from . import transport
+from .config import load_user_state, save_user_state, user_lock
+
+# Statuses that mean "try again later"; a 500 may already have run the model, so it is not retried.
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_DEADLINE_SECONDS = 120.0
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 20.0
+# Requests start being spaced out once this few remain in the current rate-limit window.
+PACE_THRESHOLD = 10
+MAX_PACE_INTERVAL = 10.0
+# Shared by every stackfix process for this user, so parallel CI jobs pace together.
+RATE_LIMIT_FILE = "ratelimit.json"
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+_sleep = time.sleep
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def _header(headers: Any, *names: str) -> Optional[str]:
+    if not headers:
+        return None
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            value = headers.get(name.lower())
+        if value not in (None, ""):
+            return str(value).strip()
+    return None
+
+
+def _seconds_until(value: str, now: float) -> Optional[float]:
+    """Seconds from now for delta seconds, epoch seconds, a duration like 1m30s, or an HTTP date."""
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if number is not None:
+        return max(number - now, 0.0) if number > 1e9 else max(number, 0.0)
+    parts = _DURATION.findall(value)
+    if parts and "".join(amount + unit for amount, unit in parts) == value.replace(" ", ""):
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(parsed.timestamp() - now, 0.0)
+
+
+def retry_after(headers: Any) -> Optional[float]:
+    value = _header(headers, "Retry-After")
+    return _seconds_until(value, time.time()) if value else None
+
+
+def note_response(url: str, status: int, headers: Any) -> None:
+    """Remember the origin's rate-limit window and any Retry-After; never raises."""
+    now = time.time()
+    entry: Dict[str, Any] = {}
+    remaining = _header(headers, "X-RateLimit-Remaining", "X-RateLimit-Remaining-Requests")
+    reset = _header(headers, "X-RateLimit-Reset", "X-RateLimit-Reset-Requests")
+    try:
+        if remaining is not None:
+            entry["remaining"] = int(float(remaining))
+    except ValueError:
+        pass
+    reset_in = _seconds_until(reset, now) if reset else None
+    if reset_in is not None:
+        entry["reset_at"] = now + reset_in
+    wait = retry_after(headers) if status in RETRY_STATUSES else None
+    if status == 429 and wait is None and entry.get("remaining") == 0 and reset_in is not None:
+        wait = reset_in
+    if wait:
+        entry["blocked_until"] = now + wait
+    if not entry:
+        return
+    try:
+        with user_lock():
+            data = load_user_state(RATE_LIMIT_FILE)
+            data.setdefault(_origin(url), {}).update(entry, updated_at=int(now))
+            save_user_state(RATE_LIMIT_FILE, data)
+    except Exception:
+        pass
+
+
+def reserve(url: str) -> float:
+    """Seconds to wait before sending to url.
+
+    Honors a shared Retry-After, waits out an exhausted window, and spaces
+    requests evenly over the rest of the window once few remain.
+    """
+    origin = _origin(url)
+    if origin not in load_user_state(RATE_LIMIT_FILE):
+        return 0.0
+    with user_lock():
+        data = load_user_state(RATE_LIMIT_FILE)
+        entry = data.get(origin) or {}
+        now = time.time()
+        start = max(now, float(entry.get("next_at") or 0), float(entry.get("blocked_until") or 0))
+        remaining = entry.get("remaining")
+        reset_at = float(entry.get("reset_at") or 0)
+        if isinstance(remaining, int) and reset_at > now:
+            if remaining <= 0:
+                return max(start, reset_at) - now
+            if remaining <= PACE_THRESHOLD:
+                entry["next_at"] = start + min((reset_at - now) / (remaining + 1), MAX_PACE_INTERVAL)
+                # Count this request so other processes see the smaller budget before the reply arrives.
+                entry["remaining"] = remaining - 1
+                data[origin] = entry
+                save_user_state(RATE_LIMIT_FILE, data)
+        return start - now
+
+
+class RetryPolicy:
+    """Attempt limit and overall deadline for one logical request, retries included."""
+
+    def __init__(self, max_attempts: Optional[int] = None, deadline: Optional[float] = None) -> None:
+        if max_attempts is None:
+            max_attempts = _env_int("STACKFIX_HTTP_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)
+        if deadline is None:
+            deadline = _env_float("STACKFIX_RETRY_DEADLINE", DEFAULT_DEADLINE_SECONDS)
+        self.max_attempts = max(max_attempts, 1)
+        self.deadline = time.monotonic() + deadline
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def wait_before(self, url: str) -> float:
+        delay = reserve(url)
+        if delay > self.remaining():
+            raise RuntimeError(
+                f"Rate limit for {_origin(url)} resets in {int(delay)}s; not waiting past the retry deadline"
+            )
+        return delay
+
+    def next_delay(self, attempt: int, status: int, headers: Any) -> Optional[float]:
+        """Seconds to wait before another attempt, or None to keep this response."""
+        if status not in RETRY_STATUSES or attempt >= self.max_attempts:
+            return None
+        hinted = retry_after(headers)
+        if hinted is not None:
+            delay = hinted + random.uniform(0, BACKOFF_BASE_SECONDS)
+        else:
+            # Full jitter keeps processes that failed together from retrying together.
+            delay = random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        if delay > self.remaining():
+            return None
+        return delay
+
+
+def post(url: str, policy: Optional[RetryPolicy] = None, **kwargs: Any) -> Any:
+    """transport.post with pacing and retries on 429/502/503/504; returns the last response.
+
+    Batch and CI scripts calling the relay or a provider directly should use this
+    so concurrent stackfix processes share one view of the rate limit.
+    """
+    policy = policy or RetryPolicy()
+    attempt = 1
+    while True:
+        delay = policy.wait_before(url)
+        if delay > 0:
+            _sleep(delay)
+        resp = transport.post(url, **kwargs)
+        headers = getattr(resp, "headers", None)
+        note_response(url, resp.status_code, headers)
+        delay = policy.next_delay(attempt, resp.status_code, headers)
+        if delay is None:
+            return resp
+        close = getattr(resp, "close", None)
+        if close is not None:
+            close()
+        _sleep(delay)
+        attempt += 1
+
+
+async def apace(url: str, policy: RetryPolicy) -> None:
+    delay = await asyncio.to_thread(policy.wait_before, url)
+    if delay > 0:
+        await asyncio.sleep(delay)
@@ -0,0 +1,307 @@
+import os
+import re
+import shutil
+from typing import Any, Callable, Dict, List, Optional
+
+from . import lockfiles, stats
+from .patching import search_replace_to_diff
+
+# Failures are matched against the end of the output, where the error usually is.
+SCAN_CHARS = 8000
+
+# Import names that differ from the distribution that provides them.
+MODULE_DISTRIBUTIONS = {
+    "yaml": "pyyaml",
+    "PIL": "pillow",
+    "cv2": "opencv-python",
+    "sklearn": "scikit-learn",
+    "bs4": "beautifulsoup4",
+    "dateutil": "python-dateutil",
+    "dotenv": "python-dotenv",
+    "jwt": "pyjwt",
+    "magic": "python-magic",
+    "serial": "pyserial",
+    "attr": "attrs",
+    "google.protobuf": "protobuf",
+}
+
+RuleHandler = Callable[["re.Match", Dict[str, Any]], Optional[Dict[str, Any]]]
+
+
+class Rule:
+    """A stderr/stdout pattern and a handler that turns a match into a fix, or None to pass."""
+
+    def __init__(self, name: str, pattern: str, handler: RuleHandler) -> None:
+        self.name = name
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.MULTILINE)
+        self.handler = handler
+
+
+_RULES: List[Rule] = []
+_MATCHER: Optional["re.Pattern"] = None
+
+
+def register(rule: Rule) -> None:
+    """Add a rule; rules registered first win when several patterns match the same text."""
+    global _MATCHER
+    _RULES.append(rule)
+    _MATCHER = None
+
+
+def rule(name: str, pattern: str) -> Callable[[RuleHandler], RuleHandler]:
+    def _decorator(handler: RuleHandler) -> RuleHandler:
+        register(Rule(name, pattern, handler))
+        return handler
+
+    return _decorator
+
+
+def _matcher() -> "re.Pattern":
+    # One alternation over every rule, so a miss is a single regex scan.
+    global _MATCHER
+    if _MATCHER is None:
+        alternatives = [
+            f"(?P<rule{index}>{re.sub(r'[(][?]P<[A-Za-z_][A-Za-z0-9_]*>', '(?:', r.pattern)})"
+            for index, r in enumerate(_RULES)
+        ]
+        _MATCHER = re.compile("|".join(alternatives), re.MULTILINE)
+    return _MATCHER
+
+
+def rules_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_RULES") != "1"
+
+
+def fix_result(summary: str, patch: str = "", fix_command: Optional[List[str]] = None) -> Dict[str, Any]:
+    """An agent result for a rule: a patch to apply, a command to run, or both."""
+    result: Dict[str, Any] = {
+        "summary": summary,
+        "confidence": 0.9,
+        "patch_unified_diff": patch,
+        "rerun_command": [],
+        "_raw_content": None,
+        "_warning": None,
+    }
+    if fix_command:
+        result["_fix_command"] = fix_command
+    return result
+
+
+def match(context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """A local fix for a known failure class, or None to ask the model.
+
+    Follow-up rounds of the fix loop always go to the model: a rule that did
+    not fix the failure the first time would only repeat itself.
+    """
+    if not _RULES or context.get("iteration", 1) > 1:
+        return None
+    text = "\n".join(str(context.get(key) or "")[-SCAN_CHARS:] for key in ("stderr", "stdout"))
+    cwd = context.get("cwd") or os.getcwd()
+    matcher = _matcher()
+    position = 0
+    while True:
+        found = matcher.search(text, position)
+        if found is None:
+            break
+        # Later rules may match the same spot when the first one passes on it.
+        for current in _RULES[int(found.lastgroup[len("rule"):]):]:
+            located = current.regex.match(text, found.start())
+            if located is None:
+                continue
+            try:
+                result = current.handler(located, context)
+            except Exception:
+                result = None
+            if result is not None:
+                stats.record_counts(cwd, "rules", {"attempts": 1, current.name: 1})
+                result["_rule"] = current.name
+                return result
+        position = found.start() + 1
+    stats.record(cwd, "rules", "attempts")
+    return None
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+_REQUIREMENT = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*([<>=!~][^;#\"']*)?\s*(;.*)?$")
+
+
+def declared_requirement(manifests: Dict[str, str], distribution: str) -> Optional[str]:
+    """The requirement for distribution as written in requirements.txt or pyproject.toml."""
+    wanted = _normalize(distribution)
+    for line in (manifests.get("requirements.txt") or "").splitlines():
+        line = line.split("#", 1)[0].strip()
+        found = _REQUIREMENT.match(line)
+        if found and _normalize(found.group(1)) == wanted:
+            return line
+    requirements, poetry = lockfiles.pyproject_requirements(manifests.get("pyproject.toml") or "")
+    for requirement in requirements:
+        found = _REQUIREMENT.match(requirement)
+        if found and _normalize(found.group(1)) == wanted:
+            return requirement.strip()
+    for name in poetry:
+        # Poetry lists dependencies as keys: requests = "^2.31"
+        if _normalize(name) == wanted:
+            return name
+    return None
+
+
+def _module_distributions(module: str) -> List[str]:
+    top = module.split(".", 1)[0]
+    names = [MODULE_DISTRIBUTIONS.get(module), MODULE_DISTRIBUTIONS.get(top), top]
+    return [name for name in names if name]
+
+
+@rule("missing_init", r"(?:ModuleNotFoundError: )?No module named '(?P<module>[\w]+(?:\.[\w]+)+)'")
+def _missing_init(found: "re.Match", context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    cwd = context.get("cwd") or os.getcwd()
+    parts = found.group("module").split(".")
+    target = os.path.join(cwd, *parts)
+    if not (os.path.isfile(target + ".py") or os.path.isdir(target)):
+        return None
+    edits = [
+        {
+            "path": "/".join(parts[:depth] + ["__init__.py"]),
+            "search": "",
+            "replace": f'"""{parts[depth - 1]} package."""\n',
+        }
+        for depth in range(1, len(parts))
+        if not os.path.isfile(os.path.join(cwd, *parts[:depth], "__init__.py"))
+    ]
+    if not edits:
+        return None
+    patch = search_replace_to_diff(edits, cwd)
+    paths = ", ".join(edit["path"] for edit in edits)
+    return fix_result(f"Add {paths} so {found.group('module')} can be imported as a package.", patch)
+
+
+_PYTHON_EXECUTABLE = re.compile(r"^(?:python|pypy)[\d.]*(?:\.exe)?$", re.IGNORECASE)
+
+
+# Where a project virtualenv keeps its interpreter, relative to the project root.
+PROJECT_VENV_PYTHONS = (
+    os.path.join(".venv", "bin", "python"),
+    os.path.join("venv", "bin", "python"),
+    os.path.join(".venv", "Scripts", "python.exe"),
+    os.path.join("venv", "Scripts", "python.exe"),
+)
+
+
+def _shebang_python(path: str) -> Optional[str]:
+    """The Python interpreter named on the #! line of the script at path, if any."""
+    try:
+        with open(path, "rb") as handle:
+            first = handle.readline(512).decode("utf-8", "replace")
+    except OSError:
+        return None
+    if not first.startswith("#!"):
+        return None
+    words = first[2:].split()
+    if words and os.path.basename(words[0]) == "env":
+        words = [word for word in words[1:] if not word.startswith("-")]
+        return shutil.which(words[0]) if words and _PYTHON_EXECUTABLE.match(words[0]) else None
+    return words[0] if words and _PYTHON_EXECUTABLE.match(os.path.basename(words[0])) else None
+
+
+def _command_python(context: Dict[str, Any]) -> Optional[str]:
+    """The interpreter the failing command ran under: the command itself, its script's #! line, or the project venv.
+
+    StackFix's own interpreter is not a fallback; installing there leaves the project's environment unchanged.
+    """
+    cwd = context.get("cwd") or os.getcwd()
+    command = context.get("command") or []
+    if isinstance(command, str):
+        command = command.split()
+    if command:
+        tool = str(command[0])
+        if _PYTHON_EXECUTABLE.match(os.path.basename(tool)):
+            return tool
+        path = os.path.join(cwd, tool) if os.sep in tool or (os.altsep and os.altsep in tool) else shutil.which(tool)
+        python = _shebang_python(path) if path else None
+        if python:
+            return python
+    for relative in PROJECT_VENV_PYTHONS:
+        if os.path.isfile(os.path.join(cwd, relative)):
+            return os.path.join(cwd, relative)
+    return None
+
+
+def _pip_install(context: Dict[str, Any], spec: str) -> Optional[List[str]]:
+    """pip install spec with the failing command's interpreter, or None when that cannot be found."""
+    python = _command_python(context)
+    return [python, "-m", "pip", "install", spec] if python else None
+
+
+@rule("missing_module", r"ModuleNotFoundError: No module named '(?P<module>[\w.]+)'")
+def _missing_module(found: "re.Match", context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    manifests = context.get("manifests") or {}
+    for distribution in _module_distributions(found.group("module")):
+        spec = declared_requirement(manifests, distribution)
+        install = _pip_install(context, spec) if spec else None
+        if install:
+            return fix_result(
+                f"{found.group('module')} is declared as {spec} but not installed; install it.",
+                fix_command=install,
+            )
+    return None
+
+
+def _node_installer(cwd: str) -> List[str]:
+    if os.path.isfile(os.path.join(cwd, "pnpm-lock.yaml")):
+        return ["pnpm", "install"]
+    if os.path.isfile(os.path.join(cwd, "yarn.lock")):
+        return ["yarn", "install"]
+    return ["npm", "install"]
+
+
+@rule(
+    "command_not_found",
+    r"^(?:\S*sh: (?:(?:line )?\d+: )?)?(?P<tool>[\w.+-]+): (?:command )?not found\s*$",
+)
+def _command_not_found(found: "re.Match", context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    tool = found.group("tool")
+    manifests = context.get("manifests") or {}
+    cwd = context.get("cwd") or os.getcwd()
+    package_json = manifests.get("package.json") or ""
+    if re.search(rf"\"{re.escape(tool)}\"\s*:", package_json):
+        installer = _node_installer(cwd)
+        return fix_result(
+            f"{tool} is a project dependency that is not installed; run {' '.join(installer)}.",
+            fix_command=installer,
+        )
+    spec = declared_requirement(manifests, tool)
+    install = _pip_install(context, spec) if spec else None
+    if install:
+        return fix_result(
+            f"{tool} is declared as {spec} but not installed; install it.",
+            fix_command=install,
+        )
+    return None
+
+
+# Lockfile checks that fail when the manifest changed without relocking.
+_LOCKFILE_FIXES = [
+    (r"`npm ci` can only install packages when your package\.json and package-lock\.json", ["npm", "install"]),
+    (r"Your lockfile needs to be updated, but yarn was run with `--frozen-lockfile`", ["yarn", "install"]),
+    (r"ERR_PNPM_OUTDATED_LOCKFILE", ["pnpm", "install", "--no-frozen-lockfile"]),
+    (r"pyproject\.toml changed significantly since poetry\.lock was last generated", ["poetry", "lock"]),
+    (r"The lockfile at `uv\.lock` needs to be updated", ["uv", "lock"]),
+    (r"the lock file \S+ needs to be updated but --locked was passed", ["cargo", "update", "--workspace"]),
+]
+
+
+def _lockfile_rule(fix_command: List[str]) -> RuleHandler:
+    def _handler(found: "re.Match", context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return fix_result(
+            f"The lockfile is out of sync with the manifest; run {' '.join(fix_command)} to update it.",
+            fix_command=fix_command,
+        )
+
+    return _handler
+
+
+for _pattern, _command in _LOCKFILE_FIXES:
+    register(Rule("lockfile_out_of_sync", _pattern, _lockfile_rule(_command)))
@@ -0,0 +1,226 @@
+import mmap
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .safety import is_forbidden_path
+
+# Total size of all snippets; the model gets the highest-ranked windows that fit.
+MAX_SOURCE_BYTES = 12000
+MAX_SNIPPETS = 6
+WINDOW_BEFORE = 8
+WINDOW_AFTER = 6
+# Minified bundles can put a whole program on one line.
+MAX_LINE_CHARS = 300
+# Only this much of the failure output is scanned for locations: the end, where errors are.
+MAX_SCAN_CHARS = 200000
+
+_PATH = r"[^\s:()'\"<>]*[^\s:()'\"<>.]"
+
+# Python tracebacks: File "app/main.py", line 12, in handler
+_PYTHON_FRAME = re.compile(r'^\s*File "(?P<path>[^"]+)", line (?P<line>\d+)')
+# Node stacks: at handler (/app/src/index.js:12:5) or at /app/src/index.js:12:5
+_NODE_FRAME = re.compile(r"^\s*at (?:.*?\()?(?:file://)?(?P<path>" + _PATH + r"):(?P<line>\d+):\d+\)?\s*$")
+# tsc: src/index.ts(12,5): error TS2322: ...
+_TSC_ERROR = re.compile(r"^(?P<path>" + _PATH + r")\((?P<line>\d+),\d+\): (?:error|warning)")
+# rustc: --> src/main.rs:12:5
+_RUST_ARROW = re.compile(r"^\s*--> (?P<path>" + _PATH + r"):(?P<line>\d+):\d+")
+# pytest (tests/test_x.py:12: AssertionError), tsc --pretty, gcc, clang, go, eslint --format unix:
+# a path with an extension, a line and an optional column at the start of a line.
+_COMPILER = re.compile(r"^(?P<path>" + _PATH + r"\.[A-Za-z0-9]+):(?P<line>\d+)(?::\d+)?(?::| - )")
+
+_LINE_PATTERNS = (_PYTHON_FRAME, _TSC_ERROR, _RUST_ARROW, _COMPILER)
+
+
+def find_locations(text: str) -> List[Tuple[str, int, int]]:
+    """(path, line, rank) for each source location named in text; a higher rank is more relevant.
+
+    Later output ranks higher, so the last failure wins over earlier ones. Within a
+    Python traceback the innermost frame is printed last and so ranks highest;
+    Node prints the innermost frame first, so each run of `at` lines is reversed.
+    """
+    lines = text[-MAX_SCAN_CHARS:].splitlines()
+    found: List[Tuple[str, int, int]] = []
+    index = 0
+    while index < len(lines):
+        match = _NODE_FRAME.match(lines[index])
+        if match:
+            stack = []
+            while index < len(lines) and match:
+                stack.append((match.group("path"), int(match.group("line")), index))
+                index += 1
+                match = _NODE_FRAME.match(lines[index]) if index < len(lines) else None
+            start = stack[0][2]
+            for depth, (path, line, _) in enumerate(reversed(stack)):
+                found.append((path, line, start + depth))
+            continue
+        for pattern in _LINE_PATTERNS:
+            match = pattern.match(lines[index])
+            if match:
+                found.append((match.group("path"), int(match.group("line")), index))
+                break
+        index += 1
+    return found
+
+
+class LineIndex:
+    """Offsets of line starts in a file, found through mmap only as far as a lookup needs.
+
+    The file is never read whole: a window near the top of a large file touches
+    only the pages before it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.stamp = _stamp(path)
+        self.offsets = [0]
+        self._scanned = 0
+        self._complete = False
+
+    def _scan_to(self, mm: mmap.mmap, line: int) -> None:
+        while not self._complete and len(self.offsets) <= line:
+            newline = mm.find(b"\n", self._scanned)
+            if newline < 0:
+                self._complete = True
+                break
+            self._scanned = newline + 1
+            if self._scanned < len(mm):
+                self.offsets.append(self._scanned)
+            else:
+                self._complete = True
+
+    def lines(self, first: int, last: int) -> List[Tuple[int, bytes]]:
+        """(number, bytes) of lines first..last, 1-based, cut short at the end of the file."""
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self._scan_to(mm, last)
+                result = []
+                for number in range(max(first, 1), min(last, len(self.offsets)) + 1):
+                    start = self.offsets[number - 1]
+                    end = self.offsets[number] if number < len(self.offsets) else len(mm)
+                    result.append((number, mm[start : min(end, start + MAX_LINE_CHARS * 4)]))
+                return result
+
+
+def _stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+_indexes: Dict[str, LineIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def _line_index(path: str) -> LineIndex:
+    """The LineIndex of path, reused across calls while the file is unchanged."""
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None or index.stamp != _stamp(path):
+            index = _indexes[path] = LineIndex(path)
+        return index
+
+
+def _resolve(path: str, cwd: str) -> Optional[str]:
+    """path as an existing file inside cwd that may be shown to the model, else None."""
+    cwd = os.path.abspath(cwd)
+    full = os.path.normpath(os.path.join(cwd, path))
+    if not os.path.isfile(full) or is_forbidden_path(full, cwd):
+        return None
+    real = os.path.realpath(full)
+    if real != full and is_forbidden_path(real, os.path.realpath(cwd)):
+        return None
+    return full
+
+
+def _render(lines: List[Tuple[int, bytes]], marked: set) -> Optional[str]:
+    if any(b"\0" in raw for _, raw in lines):
+        return None
+    width = len(str(lines[-1][0]))
+    rendered = []
+    for number, raw in lines:
+        text = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+        if len(text) > MAX_LINE_CHARS:
+            text = text[:MAX_LINE_CHARS] + " ..."
+        marker = ">" if number in marked else " "
+        rendered.append(f"{marker} {number:>{width}} | {text}")
+    return "\n".join(rendered)
+
+
+def read_window(path: str, first: int, last: int, marked: set) -> Optional[Tuple[int, int, str]]:
+    """(start, end, text) of lines first..last of path, with marked lines flagged.
+
+    None when the file cannot be read, is binary or has no lines in the range.
+    """
+    try:
+        lines = _line_index(path).lines(first, last)
+    except (OSError, ValueError):
+        return None
+    if not lines:
+        return None
+    text = _render(lines, marked)
+    if text is None:
+        return None
+    return lines[0][0], lines[-1][0], text
+
+
+def source_snippets(cwd: str, *outputs: str, budget: int = MAX_SOURCE_BYTES) -> List[Dict[str, Any]]:
+    """Source windows around the locations named in outputs, best first, within budget bytes.
+
+    Pass the outputs oldest first: locations in later ones rank higher. Locations
+    outside cwd, in forbidden paths or in missing files are skipped. Repeated
+    locations count once at their best rank; nearby lines in one file share a
+    window. Each snippet marks its failing lines with ">".
+    """
+    best: Dict[Tuple[str, int], int] = {}
+    offset = 0
+    for text in outputs:
+        if not text:
+            continue
+        for path, line, rank in find_locations(text):
+            full = _resolve(path, cwd)
+            if full is None or line < 1:
+                continue
+            key = (full, line)
+            best[key] = max(best.get(key, -1), offset + rank)
+        offset += len(text.splitlines()) + 1
+
+    windows: List[Dict[str, Any]] = []
+    for (full, line), _ in sorted(best.items(), key=lambda item: item[1], reverse=True):
+        for window in windows:
+            if window["path"] == full and window["start"] - WINDOW_AFTER <= line <= window["end"] + WINDOW_BEFORE:
+                window["lines"].add(line)
+                window["start"] = min(window["start"], line - WINDOW_BEFORE)
+                window["end"] = max(window["end"], line + WINDOW_AFTER)
+                break
+        else:
+            if len(windows) < MAX_SNIPPETS:
+                start, end = line - WINDOW_BEFORE, line + WINDOW_AFTER
+                windows.append({"path": full, "lines": {line}, "start": start, "end": end})
+
+    snippets: List[Dict[str, Any]] = []
+    used = 0
+    for window in windows:
+        found = read_window(window["path"], window["start"], window["end"], window["lines"])
+        if found is None:
+            continue
+        start, end, text = found
+        size = len(text.encode("utf-8"))
+        if used + size > budget:
+            continue
+        used += size
+        snippets.append(
+            {
+                "path": os.path.relpath(window["path"], os.path.abspath(cwd)),
+                "lines": sorted(window["lines"]),
+                "start": start,
+                "end": end,
+                "source": text,
+            }
+        )
+    return snippets
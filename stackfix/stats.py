@@ -0,0 +1,68 @@
+import json
+import os
+from typing import Any, Dict, List
+
+STATS_FILE = ".stackfix/stats.json"
+
+
+def load_stats(cwd: str) -> Dict[str, Dict[str, Any]]:
+    path = os.path.join(cwd, STATS_FILE)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save_stats(cwd: str, data: Dict[str, Dict[str, Any]]) -> None:
+    path = os.path.join(cwd, STATS_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def record(cwd: str, group: str, name: str, amount: float = 1) -> None:
+    """Add amount to a named counter; stats are best-effort and never raise."""
+    record_counts(cwd, group, {name: amount})
+
+
+def record_counts(cwd: str, group: str, amounts: Dict[str, float]) -> None:
+    """Add several counters in one read-modify-write of the stats file."""
+    try:
+        data = load_stats(cwd)
+        counters = data.setdefault(group, {})
+        for name, amount in amounts.items():
+            counters[name] = counters.get(name, 0) + amount
+        save_stats(cwd, data)
+    except Exception:
+        pass
+
+
+def format_stats(data: Dict[str, Dict[str, Any]]) -> str:
+    """Counters per group; groups with an `attempts` counter also show rates.
+
+    An `X_chars_out` counter with a matching `X_chars_in` shows the ratio between them.
+    """
+    lines: List[str] = []
+    for group in sorted(data):
+        counters = data[group]
+        if not isinstance(counters, dict):
+            continue
+        lines.append(f"{group}:")
+        attempts = counters.get("attempts")
+        for name in sorted(counters):
+            value = counters[name]
+            if isinstance(value, float):
+                value = round(value, 3)
+            line = f"  {name}: {value}"
+            if attempts and name != "attempts" and isinstance(value, (int, float)):
+                line += f" ({100.0 * value / attempts:.0f}%)"
+            elif name.endswith("_chars_out") and counters.get(name[:-3] + "in"):
+                line += f" ({100.0 * value / counters[name[:-3] + 'in']:.0f}% of input)"
+            lines.append(line)
+    return "\n".join(lines)
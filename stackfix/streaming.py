@@ -0,0 +1,226 @@
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+# on_stream(event, field, text). Events:
+#   text          raw content delta from the model
+#   field_delta   decoded text appended to a watched top-level string field
+#   field_done    watched field closed; text is the full decoded value
+#   patch_valid   patch field closed and passed the unified-diff check
+#   patch_invalid patch field closed and failed the check; the stream is cut short
+#   retry         a new model round trip is starting; text says why
+StreamCallback = Callable[[str, Optional[str], str], None]
+
+STREAM_FIELDS = ("summary", "patch_unified_diff")
+
+
+def streaming_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_STREAM") != "1"
+
+
+SSE_DONE = object()
+
+
+def parse_sse_line(raw: Any) -> Any:
+    """Decode one SSE line: a dict event, SSE_DONE at the end marker, or None to skip."""
+    if not raw:
+        return None
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8", errors="replace")
+    if not raw.startswith("data:"):
+        return None
+    data = raw[5:].strip()
+    if data == "[DONE]":
+        return SSE_DONE
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+
+def iter_sse_data(lines: Iterable[Any]) -> Iterator[Dict[str, Any]]:
+    for raw in lines:
+        event = parse_sse_line(raw)
+        if event is SSE_DONE:
+            return
+        if event is not None:
+            yield event
+
+
+class CompletionBuilder:
+    """Accumulates chat completion chunks into the non-streaming response shape."""
+
+    def __init__(self, on_delta: Callable[[str], None]) -> None:
+        self._on_delta = on_delta
+        self._content: list = []
+        self._reasoning: list = []
+        self._finish_reason: Optional[str] = None
+        self._usage: Optional[Dict[str, Any]] = None
+
+    def add(self, chunk: Dict[str, Any]) -> None:
+        if isinstance(chunk.get("usage"), dict):
+            self._usage = chunk["usage"]
+        choices = chunk.get("choices") or []
+        if not choices:
+            return
+        choice = choices[0] or {}
+        delta = choice.get("delta") or {}
+        text = delta.get("content")
+        if text:
+            self._content.append(text)
+            self._on_delta(text)
+        reasoning = delta.get("reasoning_content")
+        if reasoning:
+            self._reasoning.append(reasoning)
+        if choice.get("finish_reason"):
+            self._finish_reason = choice["finish_reason"]
+
+    def build(self) -> Dict[str, Any]:
+        message: Dict[str, Any] = {"role": "assistant", "content": "".join(self._content)}
+        if self._reasoning:
+            message["reasoning_content"] = "".join(self._reasoning)
+        data: Dict[str, Any] = {"choices": [{"message": message, "finish_reason": self._finish_reason}]}
+        if self._usage is not None:
+            data["usage"] = self._usage
+        return data
+
+
+def read_sse_completion(resp: Any, on_delta: Callable[[str], None]) -> Dict[str, Any]:
+    """Consume an OpenAI-style SSE stream and return it in non-streaming shape."""
+    builder = CompletionBuilder(on_delta)
+    try:
+        for chunk in iter_sse_data(resp.iter_lines(decode_unicode=True)):
+            builder.add(chunk)
+    finally:
+        resp.close()
+    return builder.build()
+
+
+async def aread_sse_completion(resp: Any, on_delta: Callable[[str], None]) -> Dict[str, Any]:
+    """Async counterpart of read_sse_completion for httpx streaming responses."""
+    builder = CompletionBuilder(on_delta)
+    async for line in resp.aiter_lines():
+        event = parse_sse_line(line)
+        if event is SSE_DONE:
+            break
+        if event is not None:
+            builder.add(event)
+    return builder.build()
+
+
+class JSONFieldStream:
+    """Incrementally pulls top-level string fields out of a JSON object being generated.
+
+    Only string values of the watched keys are decoded; everything else is just
+    scanned for structure, so arbitrary prefixes such as code fences are tolerated.
+    """
+
+    def __init__(self, fields: Iterable[str], on_event: StreamCallback) -> None:
+        self._fields = set(fields)
+        self._on_event = on_event
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode_left = 0
+        self._expect_key = False
+        self._after_colon = False
+        self._string_is_key = False
+        self._key_raw: list = []
+        self._last_key: Optional[str] = None
+        self._field: Optional[str] = None
+        self._field_raw: list = []
+        self._pending = ""
+        self.values: Dict[str, str] = {}
+
+    def feed(self, text: str) -> None:
+        for ch in text:
+            if self._in_string:
+                self._string_char(ch)
+            elif ch == '"':
+                self._start_string()
+            elif ch in "{[":
+                self._depth += 1
+                self._expect_key = self._depth == 1 and ch == "{"
+                self._after_colon = False
+            elif ch in "}]":
+                self._depth -= 1
+            elif self._depth == 1 and ch == ",":
+                self._expect_key = True
+                self._after_colon = False
+            elif self._depth == 1 and ch == ":":
+                self._expect_key = False
+                self._after_colon = True
+            elif not ch.isspace():
+                self._after_colon = False
+        self._flush()
+
+    def _start_string(self) -> None:
+        self._in_string = True
+        self._string_is_key = self._depth == 1 and self._expect_key
+        if self._string_is_key:
+            self._key_raw = []
+        elif self._depth == 1 and self._after_colon and self._last_key in self._fields:
+            self._field = self._last_key
+            self._field_raw = []
+            self._pending = ""
+        self._after_colon = False
+
+    def _string_char(self, ch: str) -> None:
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode_left = 4
+        elif self._unicode_left:
+            self._unicode_left -= 1
+        elif ch == "\\":
+            self._escape = True
+        elif ch == '"':
+            self._end_string()
+            return
+        if self._string_is_key:
+            self._key_raw.append(ch)
+        elif self._field is not None:
+            self._field_raw.append(ch)
+            self._pending += ch
+
+    def _end_string(self) -> None:
+        self._in_string = False
+        if self._string_is_key:
+            self._last_key = _decode("".join(self._key_raw))
+            self._expect_key = False
+            return
+        if self._field is None:
+            return
+        self._flush(final=True)
+        field = self._field
+        value = _decode("".join(self._field_raw))
+        self._field = None
+        self.values[field] = value
+        self._on_event("field_done", field, value)
+
+    def _flush(self, final: bool = False) -> None:
+        if self._field is None or not self._pending:
+            return
+        hold = 0
+        if not final:
+            if self._escape:
+                hold = 1
+            elif self._unicode_left:
+                hold = 6 - self._unicode_left
+        ready = self._pending[: len(self._pending) - hold]
+        decoded = _decode(ready)
+        if not final and decoded and "\ud800" <= decoded[-1] <= "\udbff":
+            # Wait for the low surrogate so the pair is emitted as one character.
+            ready = ready[:-6]
+            decoded = decoded[:-1]
+        self._pending = self._pending[len(ready):]
+        if decoded:
+            self._on_event("field_delta", self._field, decoded)
+
+
+def _decode(raw: str) -> str:
+    try:
+        return json.loads(f'"{raw}"', strict=False)
+    except ValueError:
+        return raw
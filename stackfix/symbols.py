@@ -0,0 +1,345 @@
+import ast
+import hashlib
+import multiprocessing
+import os
+import re
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .safety import DENYLIST_DIRS, is_forbidden_path
+from .slicing import read_window
+from .util import is_git_repo
+
+SYMBOL_INDEX_FILE = ".stackfix/symbols.db"
+# Bumped whenever the tables or what the parsers extract change; the index is then rebuilt.
+SCHEMA_VERSION = 1
+MAX_INDEX_FILE_BYTES = 1_000_000
+# Outside a git repository the tree is walked, and stops here.
+MAX_INDEX_FILES = 200_000
+# Fewer changed files than this are parsed in-process; starting workers costs more.
+POOL_THRESHOLD = 500
+# Files touched this recently are checked again next time; see context.RACY_SECONDS.
+RACY_SECONDS = 2
+
+MAX_SYMBOLS = 5
+MAX_DEFINITIONS = 6
+MAX_DEFINITION_BYTES = 6000
+DEFINITION_LINES = 12
+
+LANGUAGES = {
+    ".py": "python",
+    ".js": "javascript",
+    ".jsx": "javascript",
+    ".mjs": "javascript",
+    ".cjs": "javascript",
+    ".ts": "javascript",
+    ".tsx": "javascript",
+    ".go": "go",
+    ".rs": "rust",
+}
+SKIPPED_DIRS = DENYLIST_DIRS | {".stackfix", ".tox", ".mypy_cache", ".pytest_cache", "venv", "target", "vendor"}
+
+# Kinds that say where a name comes from, as opposed to where it is used.
+DEFINITION_KINDS = ("class", "function", "variable", "type", "export")
+
+_JS_PATTERNS = [
+    (re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)"), "function"),
+    (re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+([A-Za-z_$][\w$]*)"), "class"),
+    (re.compile(r"^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)"), "variable"),
+    (re.compile(r"^\s*(?:export\s+)?(?:declare\s+)?(?:interface|type|enum)\s+([A-Za-z_$][\w$]*)"), "type"),
+]
+_JS_EXPORT_LIST = re.compile(r"^\s*export\s*\{([^}]*)\}")
+_JS_IMPORT = re.compile(r"^\s*import\s+(?:type\s+)?(.+?)\s+from\s+['\"]")
+_JS_REQUIRE = re.compile(r"^\s*(?:const|let|var)\s+(\{[^}]*\}|[A-Za-z_$][\w$]*)\s*=\s*require\(")
+_GO_PATTERNS = [
+    (re.compile(r"^func\s+(?:\([^)]*\)\s*)?([A-Za-z_]\w*)"), "function"),
+    (re.compile(r"^type\s+([A-Za-z_]\w*)"), "type"),
+    (re.compile(r"^(?:var|const)\s+([A-Za-z_]\w*)"), "variable"),
+]
+_RUST_PATTERNS = [
+    (re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:unsafe\s+)?fn\s+([A-Za-z_]\w*)"), "function"),
+    (re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|type|union)\s+([A-Za-z_]\w*)"), "type"),
+    (re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:const|static)\s+([A-Za-z_]\w*)"), "variable"),
+    (re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?use\s+.*?([A-Za-z_]\w*)\s*;"), "import"),
+]
+
+# Names an error says are missing, undefined or not exported.
+ERROR_SYMBOL_PATTERNS = [
+    re.compile(r"NameError: name '([A-Za-z_]\w*)' is not defined"),
+    re.compile(r"ImportError: cannot import name '([A-Za-z_]\w*)'"),
+    re.compile(r"has no attribute '([A-Za-z_]\w*)'"),
+    re.compile(r"ReferenceError: ([A-Za-z_$][\w$]*) is not defined"),
+    re.compile(r"TypeError: (?:[\w$]+\.)*([A-Za-z_$][\w$]*) is not a (?:function|constructor)"),
+    re.compile(r"does not provide an export named '([A-Za-z_$][\w$]*)'"),
+    re.compile(r"Cannot find name '([A-Za-z_$][\w$]*)'"),
+    re.compile(r"has no exported member '([A-Za-z_$][\w$]*)'"),
+    re.compile(r"Property '([A-Za-z_$][\w$]*)' does not exist"),
+    re.compile(r"undefined reference to `([A-Za-z_]\w*)"),
+    re.compile(r"undefined symbol: _?([A-Za-z_]\w*)"),
+    re.compile(r"use of undeclared identifier '([A-Za-z_]\w*)'"),
+    re.compile(r"cannot find (?:value|function|type|struct|trait|macro) `([A-Za-z_]\w*)`"),
+    re.compile(r"unresolved import `(?:[\w:]*::)?([A-Za-z_]\w*)`"),
+    re.compile(r"undefined: ([A-Za-z_]\w*)"),
+]
+
+
+def index_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_SYMBOLS") != "1"
+
+
+def _python_symbols(source: str) -> List[Tuple[str, str, int]]:
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    found = []
+    for node in tree.body:
+        scopes = [node]
+        if isinstance(node, ast.ClassDef):
+            found.append((node.name, "class", node.lineno))
+            scopes = [child for child in node.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        for item in scopes:
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                found.append((item.name, "function", item.lineno))
+        if isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    found.append((target.id, "variable", node.lineno))
+                    if target.id == "__all__" and isinstance(node.value, (ast.List, ast.Tuple)):
+                        for element in node.value.elts:
+                            if isinstance(element, ast.Constant) and isinstance(element.value, str):
+                                found.append((element.value, "export", node.lineno))
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name != "*":
+                    found.append(((alias.asname or alias.name).split(".")[0], "import", node.lineno))
+    return found
+
+
+def _names(clause: str) -> List[str]:
+    """The local names bound by an import or export clause such as `a, { b as c }`."""
+    names = []
+    for part in re.split(r"[{},]", clause):
+        part = part.strip()
+        if part.startswith("* as "):
+            part = part[5:]
+        words = part.split()
+        if words and re.match(r"^[A-Za-z_$][\w$]*$", words[-1]) and words[-1] != "type":
+            names.append(words[-1])
+    return names
+
+
+def _pattern_symbols(source: str, patterns: List[Tuple[Any, str]]) -> List[Tuple[str, str, int]]:
+    found = []
+    for number, line in enumerate(source.splitlines(), 1):
+        for pattern, kind in patterns:
+            match = pattern.match(line)
+            if match:
+                found.append((match.group(1), kind, number))
+                break
+    return found
+
+
+def _javascript_symbols(source: str) -> List[Tuple[str, str, int]]:
+    found = _pattern_symbols(source, _JS_PATTERNS)
+    for number, line in enumerate(source.splitlines(), 1):
+        match = _JS_EXPORT_LIST.match(line)
+        if match:
+            found.extend((name, "export", number) for name in _names(match.group(1)))
+            continue
+        match = _JS_IMPORT.match(line) or _JS_REQUIRE.match(line)
+        if match:
+            found.extend((name, "import", number) for name in _names(match.group(1)))
+    return found
+
+
+_PARSERS = {
+    "python": _python_symbols,
+    "javascript": _javascript_symbols,
+    "go": lambda source: _pattern_symbols(source, _GO_PATTERNS),
+    "rust": lambda source: _pattern_symbols(source, _RUST_PATTERNS),
+}
+
+
+def _index_file(job: Tuple[str, str, Optional[str]]) -> Tuple[str, Optional[str], Optional[List[Tuple[str, str, int]]]]:
+    """(path, hash, symbols) of one file; symbols is None when its hash is unchanged.
+
+    Runs in worker processes during the first build, so it only takes and returns plain data.
+    """
+    full, language, known_hash = job
+    try:
+        with open(full, "rb") as f:
+            data = f.read(MAX_INDEX_FILE_BYTES + 1)
+    except OSError:
+        return full, None, []
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == known_hash:
+        return full, digest, None
+    if len(data) > MAX_INDEX_FILE_BYTES or b"\0" in data:
+        return full, digest, []
+    return full, digest, _PARSERS[language](data.decode("utf-8", errors="replace"))
+
+
+def _source_files(cwd: str) -> List[str]:
+    """Indexable files under cwd (absolute), relative to it: git's tracked and unignored files, else a walk."""
+    if is_git_repo(cwd):
+        try:
+            listed = subprocess.run(
+                ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+                cwd=cwd,
+                capture_output=True,
+                check=True,
+            ).stdout
+            paths = [path for path in listed.decode("utf-8", errors="replace").split("\0") if path]
+            return [path for path in paths if os.path.splitext(path)[1] in LANGUAGES]
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    paths = []
+    for root, dirs, files in os.walk(cwd):
+        dirs[:] = [name for name in dirs if name not in SKIPPED_DIRS and not name.startswith(".")]
+        prefix = root[len(cwd) + 1 :]
+        for name in files:
+            if os.path.splitext(name)[1] in LANGUAGES:
+                paths.append(os.path.join(prefix, name))
+                if len(paths) >= MAX_INDEX_FILES:
+                    return paths
+    return paths
+
+
+def _connect(cwd: str) -> sqlite3.Connection:
+    path = os.path.join(cwd, SYMBOL_INDEX_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=5)
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript(
+            f"""
+            DROP TABLE IF EXISTS files;
+            DROP TABLE IF EXISTS symbols;
+            CREATE TABLE files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT);
+            CREATE TABLE symbols (name TEXT, kind TEXT, path TEXT, line INTEGER);
+            CREATE INDEX symbols_name ON symbols (name COLLATE NOCASE);
+            CREATE INDEX symbols_path ON symbols (path);
+            PRAGMA user_version = {SCHEMA_VERSION};
+            """
+        )
+    return conn
+
+
+def _parse_all(jobs: List[Tuple[str, str, Optional[str]]]) -> Iterable[Tuple[str, Optional[str], Any]]:
+    if len(jobs) >= POOL_THRESHOLD:
+        # spawn, not fork: this runs in a prefetch thread and forking a threaded process is unsafe.
+        try:
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+                return list(pool.map(_index_file, jobs, chunksize=64))
+        except Exception:
+            pass
+    return [_index_file(job) for job in jobs]
+
+
+def update_index(cwd: str) -> Dict[str, int]:
+    """Bring .stackfix/symbols.db up to date with the tree and return what was done.
+
+    A file is read again only when its mtime or size changed, and parsed again
+    only when its content hash changed too. Forbidden paths are never indexed.
+    """
+    cwd = os.path.abspath(cwd)
+    counts = {"files": 0, "parsed": 0, "removed": 0}
+    paths = _source_files(cwd)
+    with _connect(cwd) as conn:
+        known = {row[0]: row[1:] for row in conn.execute("SELECT path, mtime_ns, size, hash FROM files")}
+        jobs = []
+        stamps = {}
+        for path in paths:
+            try:
+                st = os.stat(os.path.join(cwd, path))
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            entry = known.get(path)
+            if entry is not None and tuple(entry[:2]) == stamp:
+                stamps[path] = stamp
+                continue
+            # Checked only for new and changed files; the rest passed when they were indexed.
+            if is_forbidden_path(os.path.join(cwd, path), cwd):
+                continue
+            stamps[path] = stamp
+            jobs.append((os.path.join(cwd, path), LANGUAGES[os.path.splitext(path)[1]], entry and entry[2]))
+        counts["files"] = len(stamps)
+        removed = [path for path in known if path not in stamps]
+        conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+        conn.executemany("DELETE FROM symbols WHERE path = ?", [(path,) for path in removed])
+        counts["removed"] = len(removed)
+        racy = time.time_ns() - RACY_SECONDS * 1_000_000_000
+        for full, digest, symbols in _parse_all(jobs):
+            path = full[len(cwd) + 1 :]
+            mtime_ns, size = stamps[path]
+            # A file changed within RACY_SECONDS is stored with no mtime, so the next run hashes it again.
+            stored = mtime_ns if mtime_ns < racy else 0
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, stored, size, digest))
+            if symbols is not None:
+                counts["parsed"] += 1
+                conn.execute("DELETE FROM symbols WHERE path = ?", (path,))
+                rows = [(name, kind, path, line) for name, kind, line in symbols]
+                conn.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?)", rows)
+    conn.close()
+    return counts
+
+
+def error_symbols(*outputs: str) -> List[str]:
+    """Names the error output says are undefined, missing or not exported, last first."""
+    found: List[Tuple[int, str]] = []
+    for offset, text in enumerate(outputs):
+        for pattern in ERROR_SYMBOL_PATTERNS:
+            for match in pattern.finditer(text or ""):
+                found.append((offset * 10**9 + match.start(), match.group(1)))
+    names: List[str] = []
+    for _, name in sorted(found, reverse=True):
+        if name not in names:
+            names.append(name)
+    return names[:MAX_SYMBOLS]
+
+
+def lookup(cwd: str, name: str, limit: int = MAX_DEFINITIONS) -> List[Dict[str, Any]]:
+    """Where name is defined or exported, exact-case matches first; case-insensitive to catch typos."""
+    path = os.path.join(cwd, SYMBOL_INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    placeholders = ",".join("?" for _ in DEFINITION_KINDS)
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5)
+        try:
+            rows = conn.execute(
+                f"SELECT name, kind, path, line FROM symbols WHERE name = ? COLLATE NOCASE "
+                f"AND kind IN ({placeholders}) ORDER BY name != ?, path LIMIT ?",
+                (name, *DEFINITION_KINDS, name, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return []
+    return [{"symbol": row[0], "kind": row[1], "path": row[2], "line": row[3]} for row in rows]
+
+
+def definitions_for_failure(
+    cwd: str, stdout: str, stderr: str, budget: int = MAX_DEFINITION_BYTES
+) -> List[Dict[str, Any]]:
+    """The source of the definitions of symbols the error names, within budget bytes."""
+    definitions: List[Dict[str, Any]] = []
+    used = 0
+    for name in error_symbols(stdout, stderr):
+        for found in lookup(cwd, name):
+            if len(definitions) >= MAX_DEFINITIONS:
+                return definitions
+            full = os.path.join(cwd, found["path"])
+            if is_forbidden_path(full, cwd):
+                continue
+            window = read_window(full, found["line"], found["line"] + DEFINITION_LINES - 1, {found["line"]})
+            if window is None or used + len(window[2].encode("utf-8")) > budget:
+                continue
+            used += len(window[2].encode("utf-8"))
+            definitions.append(dict(found, source=window[2]))
+    return definitions
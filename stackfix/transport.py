@@ -0,0 +1,141 @@
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except Exception:  # pragma: no cover - optional dependency
+    httpx = None
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_CONNECT_RETRIES = 2
+
+_SESSIONS: Dict[str, requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+# One async client per event loop: httpx connections are bound to the loop that opened them.
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def default_timeout(read: Optional[float] = None) -> Tuple[float, float]:
+    connect = _env_float("STACKFIX_HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+    if read is None:
+        read = _env_float("STACKFIX_HTTP_TIMEOUT", DEFAULT_READ_TIMEOUT)
+    return connect, read
+
+
+def _build_session() -> requests.Session:
+    pool_size = max(_env_int("STACKFIX_HTTP_POOL_SIZE", DEFAULT_POOL_SIZE), 1)
+    connect_retries = max(_env_int("STACKFIX_HTTP_RETRIES", DEFAULT_CONNECT_RETRIES), 0)
+    # Only connection failures are retried here: the request never reached the
+    # server, so a retried POST cannot be billed twice.
+    retry = Retry(
+        total=connect_retries,
+        connect=connect_retries,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=0.2,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    key = _origin(url)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = _build_session()
+            _SESSIONS[key] = session
+        return session
+
+
+def post(url: str, **kwargs: Any) -> requests.Response:
+    kwargs.setdefault("timeout", default_timeout())
+    return get_session(url).post(url, **kwargs)
+
+
+def get(url: str, **kwargs: Any) -> requests.Response:
+    kwargs.setdefault("timeout", default_timeout())
+    return get_session(url).get(url, **kwargs)
+
+
+def warm(url: str, timeout: float = 5.0) -> None:
+    """Open a pooled connection to url's origin so the next request skips connect and TLS setup."""
+    try:
+        get_session(url).head(_origin(url), timeout=(timeout, timeout), allow_redirects=False).close()
+    except Exception:
+        pass
+
+
+def close_sessions() -> None:
+    with _SESSIONS_LOCK:
+        for session in _SESSIONS.values():
+            session.close()
+        _SESSIONS.clear()
+
+
+def async_available() -> bool:
+    return httpx is not None
+
+
+def async_timeout(read: Optional[float] = None) -> Any:
+    """Per-phase httpx timeout; the pool wait is bounded like a connect."""
+    connect, read = default_timeout(read=read)
+    return httpx.Timeout(connect=connect, read=read, write=connect, pool=connect)
+
+
+def get_async_client() -> Any:
+    """Shared AsyncClient for the running event loop, keeping connections alive across calls."""
+    if httpx is None:
+        raise RuntimeError("Async agent calls need httpx; install stackfix[async]")
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_CLIENTS.get(loop)
+    if client is None or client.is_closed:
+        pool_size = max(_env_int("STACKFIX_HTTP_POOL_SIZE", DEFAULT_POOL_SIZE), 1)
+        connect_retries = max(_env_int("STACKFIX_HTTP_RETRIES", DEFAULT_CONNECT_RETRIES), 0)
+        client = httpx.AsyncClient(
+            timeout=async_timeout(),
+            limits=httpx.Limits(max_connections=pool_size * 4, max_keepalive_connections=pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=connect_retries),
+        )
+        _ASYNC_CLIENTS[loop] = client
+    return client
+
+
+async def aclose_async_client() -> None:
+    client = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -1,20 +1,24 @@
+import asyncio
 import json
 import os
 import shlex
 import subprocess
 import threading
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from textual.app import App, ComposeResult
 from textual.containers import Horizontal, Vertical, VerticalScroll
 from textual.widgets import Input, RichLog, Static
 
-from .agent import call_agent
-from .context import collect_context
+from .agent import call_agent, call_agent_async, warm_up
+from .context import ContextPrefetch, collect_context, prefetch_enabled
 from .history import read_last, write_history
 from .session import new_session_id, save_session, load_session, list_sessions
 from .agents import load_agents_instructions
 from .patching import apply_patch
+from .streaming import streaming_enabled
+from .transport import async_available
+from .util import output_captures
 
 
 # Slash command definitions for /help
@@ -55,6 +59,64 @@ def _highlight_diff(diff_text: str) -> str:
     return "\n".join(lines)
 
 
+class _StreamRenderer:
+    """Writes streamed agent output to the log line by line from a worker."""
+
+    def __init__(self, app: "StackFixTUI", raw: bool = False) -> None:
+        self.app = app
+        self.raw = raw
+        self.streamed: Dict[str, str] = {}
+        self._field: Optional[str] = None
+        self._partial = ""
+
+    def __call__(self, event: str, field: Optional[str], text: str) -> None:
+        if self.raw:
+            if event == "text":
+                self.streamed["text"] = self.streamed.get("text", "") + text
+                self._write(text)
+            return
+        if event == "field_delta":
+            if field != self._field:
+                self._finish()
+                self._field = field
+                self.streamed[field] = ""
+                if field == "patch_unified_diff":
+                    self.app._ui(self.app._log_line, "\n[bold]Patch preview[/bold]\n")
+                else:
+                    self.app._ui(self.app._log_line, "")
+            self.streamed[field] += text
+            self._write(text)
+        elif event == "field_done":
+            self._finish()
+            self._field = None
+        elif event == "retry":
+            self._finish()
+            self._field = None
+            self.streamed = {}
+            self.app._ui(self.app._log_line, f"[dim]{text}[/dim]")
+
+    def was_streamed(self, field: str, value: str) -> bool:
+        return self.streamed.get(field) == value
+
+    def _render(self, line: str) -> str:
+        if self._field == "patch_unified_diff":
+            return _highlight_diff(line)
+        return line
+
+    def _write(self, text: str) -> None:
+        self._partial += text
+        *lines, self._partial = self._partial.split("\n")
+        for line in lines:
+            self.app._ui(self.app._log_line, self._render(line))
+        self.app._ui(self.app._set_stream_line, self._partial)
+
+    def _finish(self) -> None:
+        if self._partial:
+            self.app._ui(self.app._log_line, self._render(self._partial))
+            self._partial = ""
+        self.app._ui(self.app._set_stream_line, "")
+
+
 class StackFixTUI(App):
     CSS = """
     Screen {
@@ -87,6 +149,11 @@ class StackFixTUI(App):
         height: auto;
     }
 
+    #stream-line {
+        height: auto;
+        color: #e6e6e6;
+    }
+
     #prompt-row {
         height: 1;
         margin: 1 0 0 0;
@@ -134,6 +201,7 @@ class StackFixTUI(App):
     BINDINGS = [
         ("ctrl+c", "quit", "Quit"),
         ("ctrl+l", "clear", "Clear"),
+        ("escape", "cancel_agent", "Cancel agent call"),
     ]
 
     def __init__(self) -> None:
@@ -149,6 +217,7 @@ class StackFixTUI(App):
         self._approvals_mode = "suggest"
         self._last_prompt: Optional[str] = None
         self._current_phase: str = "Ready"
+        self._ui_thread = threading.get_ident()
 
     def compose(self) -> ComposeResult:
         with VerticalScroll():
@@ -158,6 +227,8 @@ class StackFixTUI(App):
             yield self._tip
             self._log = RichLog(highlight=False, wrap=True)
             yield self._log
+            self._stream_line = Static("", id="stream-line", markup=False)
+            yield self._stream_line
             with Horizontal(id="prompt-row"):
                 yield Static(">", id="prompt-label")
                 yield Input(placeholder="Type a prompt, !cmd, or /command", id="prompt-input")
@@ -165,8 +236,15 @@ class StackFixTUI(App):
             yield self._status_bar
 
     def on_mount(self) -> None:
+        self._ui_thread = threading.get_ident()
         self.query_one(Input).focus()
 
+    def _ui(self, callback, *args):
+        """Run callback on the UI thread; async workers are already there."""
+        if threading.get_ident() == self._ui_thread:
+            return callback(*args)
+        return self.call_from_thread(callback, *args)
+
     def _render_splash(self) -> str:
         cwd = os.getcwd()
         if cwd == os.path.expanduser("~"):
@@ -196,10 +274,20 @@ class StackFixTUI(App):
         if self._log:
             self._log.clear()
 
+    def action_cancel_agent(self) -> None:
+        if self.workers.cancel_group(self, "agent"):
+            self._set_stream_line("")
+            self._phase("Ready")
+            self._log_line("[dim]Agent call cancelled.[/dim]")
+
     def _log_line(self, text: str) -> None:
         if self._log:
             self._log.write(text)
 
+    def _set_stream_line(self, text: str) -> None:
+        if getattr(self, "_stream_line", None) is not None:
+            self._stream_line.update(text)
+
     def _phase(self, name: str) -> None:
         self._current_phase = name
         if hasattr(self, "_status_bar") and self._status_bar:
@@ -422,20 +510,21 @@ class StackFixTUI(App):
         self._phase("Planning")
         self._log_line(f"[bold cyan]> {prompt}[/bold cyan]")
         self._set_plan(["Answer prompt", "Summarize response"])
-        self.run_worker(lambda: self._prompt_flow(prompt), thread=True)
+        self.run_worker(self._prompt_flow(prompt), group="agent")
 
     def _command_flow(self, cmd: List[str]) -> None:
         cwd = os.getcwd()
-        stdout_chunks: List[str] = []
-        stderr_chunks: List[str] = []
+        stdout_capture, stderr_capture = output_captures(cwd)
 
         def _stream(pipe, sink, is_err: bool) -> None:
             for line in iter(pipe.readline, ""):
-                sink.append(line)
+                sink.write(line)
                 prefix = "stderr" if is_err else "stdout"
                 self.call_from_thread(self._log_line, f"[{prefix}] {line.rstrip()}" if line.strip() else "")
             pipe.close()
+            sink.close()
 
+        prefetch = ContextPrefetch(cwd, warm_up=lambda: warm_up(cwd)) if prefetch_enabled() else None
         proc = subprocess.Popen(
             cmd,
             cwd=cwd,
@@ -445,8 +534,8 @@ class StackFixTUI(App):
             bufsize=1,
             universal_newlines=True,
         )
-        t_out = threading.Thread(target=_stream, args=(proc.stdout, stdout_chunks, False))
-        t_err = threading.Thread(target=_stream, args=(proc.stderr, stderr_chunks, True))
+        t_out = threading.Thread(target=_stream, args=(proc.stdout, stdout_capture, False))
+        t_err = threading.Thread(target=_stream, args=(proc.stderr, stderr_capture, True))
         t_out.start()
         t_err.start()
         proc.wait()
@@ -454,8 +543,8 @@ class StackFixTUI(App):
         t_err.join()
 
         exit_code = proc.returncode
-        stdout = "".join(stdout_chunks)
-        stderr = "".join(stderr_chunks)
+        stdout = stdout_capture.text()
+        stderr = stderr_capture.text()
 
         if exit_code == 0:
             record = {
@@ -472,47 +561,71 @@ class StackFixTUI(App):
             return
 
         self.call_from_thread(self._phase, "Exploring")
-        context = collect_context(cwd, cmd, exit_code, stdout, stderr)
-        agents = load_agents_instructions(cwd)
-        if agents:
-            context["agent_instructions"] = agents
-
+        context = collect_context(cwd, cmd, exit_code, stdout, stderr, prefetch=prefetch)
+        self.call_from_thread(self._start_fix, cmd, context)
+
+    def _start_fix(self, cmd: List[str], context: Dict) -> None:
+        self.run_worker(self._fix_flow(cmd, context), group="agent")
+
+    async def _call_agent(self, context: Dict, on_stream: Optional[_StreamRenderer]) -> Dict:
+        # Async calls share the app's event loop; without httpx one thread per call.
+        if async_available():
+            return await call_agent_async(context, on_stream=on_stream)
+        return await asyncio.to_thread(call_agent, context, on_stream)
+
+    def _agent_failed(self, exc: Exception) -> None:
+        self._set_stream_line("")
+        self._phase("Ready")
+        self._log_line(f"Agent call failed: {exc}")
+        hint = self._agent_error_hint(exc)
+        if hint:
+            self._log_line(f"[dim]{hint}[/dim]")
+
+    async def _fix_flow(self, cmd: List[str], context: Dict) -> None:
+        renderer = _StreamRenderer(self) if streaming_enabled() else None
         try:
-            agent_result = call_agent(context)
+            agent_result = await self._call_agent(context, renderer)
         except Exception as exc:
-            self.call_from_thread(self._log_line, f"Agent call failed: {exc}")
-            hint = self._agent_error_hint(exc)
-            if hint:
-                self.call_from_thread(self._log_line, f"[dim]{hint}[/dim]")
+            self._agent_failed(exc)
             return
 
         warning = agent_result.get("_warning")
         if warning:
-            self.call_from_thread(self._log_line, f"Warning: {warning}")
+            self._log_line(f"Warning: {warning}")
+        if agent_result.get("_cached"):
+            self._log_line("[dim]Using cached response.[/dim]")
+        if agent_result.get("_rule"):
+            self._log_line(f"[dim]Matched local rule {agent_result['_rule']}.[/dim]")
 
         self._pending_cmd = cmd
         self._pending_agent = agent_result
 
         summary = agent_result.get("summary", "")
         patch = agent_result.get("patch_unified_diff", "")
+        fix_command = agent_result.get("_fix_command") or []
+
+        self._phase("Review")
+        if renderer is None or not renderer.was_streamed("summary", summary):
+            self._log_line(f"\n{summary}")
 
-        self.call_from_thread(self._phase, "Review")
-        self.call_from_thread(self._log_line, f"\n{summary}")
-        
         if patch:
-            self.call_from_thread(self._log_line, "\n[bold]Patch preview[/bold]\n")
-            highlighted = _highlight_diff(patch)
-            self.call_from_thread(self._log_line, highlighted)
+            if renderer is None or not renderer.was_streamed("patch_unified_diff", patch):
+                self._log_line("\n[bold]Patch preview[/bold]\n")
+                highlighted = _highlight_diff(patch)
+                self._log_line(highlighted)
+        elif fix_command:
+            self._log_line(f"\n[bold]Command[/bold]\n{shlex.join(fix_command)}")
         else:
-            self.call_from_thread(self._log_line, "\n[dim]No patch provided by agent.[/dim]")
+            self._log_line("\n[dim]No patch provided by agent.[/dim]")
             return
 
+        action = "Apply patch" if patch else "Run command"
         if self._approvals_mode == "full-auto":
             self._phase("Validation / Summary")
-            self._log_line("Auto-apply enabled; applying patch...")
+            self._log_line(f"Auto-apply enabled; {action.lower()}...")
             self.run_worker(self._apply_and_rerun, thread=True)
         else:
-            self.call_from_thread(self._log_line, "\nApply patch? [y/N]")
+            self._log_line(f"\n{action}? [y/N]")
             self._awaiting_confirm = True
 
     def _apply_and_rerun(self) -> None:
@@ -522,10 +635,18 @@ class StackFixTUI(App):
         patch = agent.get("patch_unified_diff", "")
         summary = agent.get("summary", "")
 
+        fix_command = [] if patch else agent.get("_fix_command") or []
         try:
-            apply_patch(patch, cwd)
+            if fix_command:
+                self.call_from_thread(self._log_line, f"Running {shlex.join(fix_command)}...")
+                fix = subprocess.run(fix_command, cwd=cwd, capture_output=True, text=True)
+                if fix.returncode != 0:
+                    raise RuntimeError(f"exited with {fix.returncode}: {fix.stderr.strip()[-500:]}")
+            else:
+                apply_patch(patch, cwd)
         except Exception as exc:
-            self.call_from_thread(self._log_line, f"Failed to apply patch: {exc}")
+            error = f"Fix command failed: {exc}" if fix_command else f"Failed to apply patch: {exc}"
+            self.call_from_thread(self._log_line, error)
             return
 
         rerun_cmd = agent.get("rerun_command") or cmd
@@ -551,6 +672,8 @@ class StackFixTUI(App):
             "rerun_stderr": err,
             "applied": True,
         }
+        if fix_command:
+            record["fix_commands"] = [fix_command]
         write_history(cwd, record)
         
         self.call_from_thread(self._phase, "Validation / Summary")
@@ -572,38 +695,40 @@ class StackFixTUI(App):
         }
         save_session(cwd, self._session_id, state)
 
-    def _prompt_flow(self, prompt: str) -> None:
+    async def _prompt_flow(self, prompt: str) -> None:
         cwd = os.getcwd()
         context = {
             "mode": "prompt",
             "prompt": prompt,
             "cwd": cwd,
         }
-        agents = load_agents_instructions(cwd)
+        # This flow runs on the app's event loop; file reads go to a thread so the UI keeps drawing.
+        agents = await asyncio.to_thread(load_agents_instructions, cwd)
         if agents:
             context["agent_instructions"] = agents
+        renderer = _StreamRenderer(self, raw=True) if streaming_enabled() else None
         try:
-            agent_result = call_agent(context)
+            agent_result = await self._call_agent(context, renderer)
         except Exception as exc:
-            self.call_from_thread(self._log_line, f"Agent call failed: {exc}")
-            hint = self._agent_error_hint(exc)
-            if hint:
-                self.call_from_thread(self._log_line, f"[dim]{hint}[/dim]")
+            self._agent_failed(exc)
             return
         warning = agent_result.get("_warning")
         if warning:
-            self.call_from_thread(self._log_line, f"Warning: {warning}")
+            self._log_line(f"Warning: {warning}")
         summary = agent_result.get("summary", "")
         if not summary:
             summary = agent_result.get("_raw_content", "")
-        self.call_from_thread(self._phase, "Ready")
-        self.call_from_thread(self._log_line, summary)
+        self._phase("Ready")
+        if renderer is not None and renderer.streamed.get("text"):
+            renderer._finish()
+        else:
+            self._log_line(summary)
         state = {
             "session_id": self._session_id,
             "last_prompt": prompt,
             "approvals_mode": self._approvals_mode,
         }
-        save_session(cwd, self._session_id, state)
+        await asyncio.to_thread(save_session, cwd, self._session_id, state)
 
 
 def run_tui() -> None:
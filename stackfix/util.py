@@ -1,15 +1,138 @@
+import gzip
 import os
 import subprocess
 import threading
 import sys
-from typing import Tuple, List
+import time
+from collections import deque
+from typing import Deque, IO, Optional, Tuple, List
+
+# What is kept of each output stream: the first CAPTURE_HEAD_CHARS and the last
+# CAPTURE_TAIL_CHARS. Together with the elision marker they fit in context.MAX_STDIO_CHARS.
+CAPTURE_HEAD_CHARS = 4000
+CAPTURE_TAIL_CHARS = 15000
+LOG_DIR = ".stackfix/logs"
+MAX_KEPT_LOGS = 20
 
 
 def is_git_repo(cwd: str) -> bool:
     return os.path.isdir(os.path.join(cwd, ".git"))
 
 
+def log_spill_enabled() -> bool:
+    return os.environ.get("STACKFIX_NO_LOG_SPILL") != "1"
+
+
+def _prune_logs(log_dir: str) -> None:
+    try:
+        names = sorted(name for name in os.listdir(log_dir) if name.endswith(".log.gz"))
+    except OSError:
+        return
+    for name in names[:-MAX_KEPT_LOGS]:
+        try:
+            os.remove(os.path.join(log_dir, name))
+        except OSError:
+            pass
+
+
+class OutputCapture:
+    """One output stream kept as a fixed head and a ring buffer of the tail.
+
+    Memory stays constant however much the command prints: once the head is
+    full, lines go to the tail and the oldest tail lines are dropped. The error
+    and traceback are usually at the end, so the tail is what matters most.
+    With spill_path, output too large to keep is also written in full to a gzip
+    file there.
+    """
+
+    def __init__(
+        self,
+        head_chars: int = CAPTURE_HEAD_CHARS,
+        tail_chars: int = CAPTURE_TAIL_CHARS,
+        spill_path: Optional[str] = None,
+    ) -> None:
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.spill_path = spill_path
+        self.spilled = False
+        self.elided_lines = 0
+        self._head: List[str] = []
+        self._head_size = 0
+        self._tail: Deque[str] = deque()
+        self._tail_size = 0
+        self._spill: Optional[IO[str]] = None
+
+    def write(self, line: str) -> None:
+        if not self._tail and self._head_size + len(line) <= self.head_chars:
+            self._head.append(line)
+            self._head_size += len(line)
+            return
+        if self._spill is not None:
+            self._spill_write([line])
+        kept = line[-self.tail_chars :]
+        self._tail.append(kept)
+        self._tail_size += len(kept)
+        if self._tail_size <= self.tail_chars:
+            return
+        if self.spill_path and not self.spilled:
+            # Nothing has been dropped yet, so the log starts out complete.
+            self._open_spill([*self._head, *list(self._tail)[:-1], line])
+        while self._tail_size > self.tail_chars:
+            self._tail_size -= len(self._tail.popleft())
+            self.elided_lines += 1
+
+    def _open_spill(self, lines: List[str]) -> None:
+        self.spilled = True
+        try:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            self._spill = gzip.open(self.spill_path, "wt", encoding="utf-8", errors="replace")
+        except OSError:
+            self.spilled = False
+            self.spill_path = None
+            return
+        self._spill_write(lines)
+        _prune_logs(os.path.dirname(self.spill_path))
+
+    def _spill_write(self, lines: List[str]) -> None:
+        try:
+            self._spill.writelines(lines)
+        except OSError:
+            # A full disk loses the log, not the command's output.
+            self._spill.close()
+            self._spill = None
+            self.spilled = False
+            self.spill_path = None
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def text(self) -> str:
+        """Head, a marker saying how many lines were left out and where the full log is, then tail."""
+        head = "".join(self._head)
+        if not self.elided_lines:
+            return head + "".join(self._tail)
+        where = f"; full log in {self.spill_path}" if self.spilled else ""
+        if head and not head.endswith("\n"):
+            head += "\n"
+        return f"{head}... [{self.elided_lines} lines elided{where}] ...\n" + "".join(self._tail)
+
+
+def output_captures(cwd: str) -> Tuple[OutputCapture, OutputCapture]:
+    """Captures for a command's stdout and stderr, spilling to .stackfix/logs/ unless disabled."""
+    if not log_spill_enabled():
+        return OutputCapture(), OutputCapture()
+    stamp = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+    log_dir = os.path.join(cwd, LOG_DIR)
+    return (
+        OutputCapture(spill_path=os.path.join(log_dir, f"{stamp}-stdout.log.gz")),
+        OutputCapture(spill_path=os.path.join(log_dir, f"{stamp}-stderr.log.gz")),
+    )
+
+
 def run_command_stream(cmd: List[str], cwd: str) -> Tuple[int, str, str]:
+    """Run cmd, echoing its output, and return the exit code and a bounded view of stdout and stderr."""
     proc = subprocess.Popen(
         cmd,
         cwd=cwd,
@@ -20,25 +143,25 @@ def run_command_stream(cmd: List[str], cwd: str) -> Tuple[int, str, str]:
         universal_newlines=True,
     )
 
-    stdout_chunks = []
-    stderr_chunks = []
+    stdout_capture, stderr_capture = output_captures(cwd)
 
     def _pump(stream, sink, out_stream):
         for line in iter(stream.readline, ""):
-            sink.append(line)
+            sink.write(line)
             out_stream.write(line)
             out_stream.flush()
         stream.close()
+        sink.close()
 
-    t_out = threading.Thread(target=_pump, args=(proc.stdout, stdout_chunks, sys.stdout))
-    t_err = threading.Thread(target=_pump, args=(proc.stderr, stderr_chunks, sys.stderr))
+    t_out = threading.Thread(target=_pump, args=(proc.stdout, stdout_capture, sys.stdout))
+    t_err = threading.Thread(target=_pump, args=(proc.stderr, stderr_capture, sys.stderr))
     t_out.start()
     t_err.start()
     proc.wait()
     t_out.join()
     t_err.join()
 
-    return proc.returncode, "".join(stdout_chunks), "".join(stderr_chunks)
+    return proc.returncode, stdout_capture.text(), stderr_capture.text()
 
 
 def truncate_text(text: str, max_chars: int) -> str:
@@ -47,6 +170,15 @@ def truncate_text(text: str, max_chars: int) -> str:
     return text[:max_chars] + f"\n... [truncated to {max_chars} chars]\n"
 
 
+def truncate_middle(text: str, max_chars: int) -> str:
+    """text cut to about max_chars by dropping the middle; the end of a log is where the error is."""
+    if len(text) <= max_chars:
+        return text
+    head = max_chars // 5
+    tail = max_chars - head
+    return text[:head] + f"\n... [{len(text) - max_chars} chars elided] ...\n" + text[-tail:]
+
+
 def env_required(name: str) -> str:
     value = os.environ.get(name)
     if not value:
@@ -58,3 +58,11 @@ def sample_diff():
 +    print("new")
 +    return True
 """
+
+
+@pytest.fixture(autouse=True)
+def isolated_user_config(tmp_path_factory, monkeypatch):
+    """Keep user-level relay state out of the real home directory."""
+    monkeypatch.setenv("STACKFIX_HOME", str(tmp_path_factory.mktemp("stackfix-home")))
+    # Capability probes would send extra requests to the endpoints tests fake.
+    monkeypatch.setenv("STACKFIX_NO_PROBE", "1")
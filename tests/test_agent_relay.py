@@ -1,9 +1,13 @@
 import json as jsonlib
+import subprocess
+import time
 from typing import Any
 
 import pytest
 
 import stackfix.agent as agent
+import stackfix.config as config
+import stackfix.transport as transport
 
 
 class _FakeResponse:
@@ -24,7 +28,7 @@ class _FakeRequests:
     def __init__(self) -> None:
         self.calls = []
 
-    def post(self, url: str, json: Any = None, headers: Any = None, timeout: int = 60):
+    def post(self, url: str, json: Any = None, headers: Any = None, timeout: Any = 60, stream: bool = False):
         self.calls.append((url, json, headers))
         if url.endswith("/anon-token"):
             return _FakeResponse({"body": {"token": "tok", "expires_at": 9999999999}})
@@ -54,7 +58,7 @@ class _FakeRequests:
 
 def test_relay_default_path(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
     fake = _FakeRequests()
-    monkeypatch.setattr(agent, "requests", fake)
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
     monkeypatch.delenv("MODEL_API_KEY", raising=False)
     monkeypatch.delenv("MODEL_BASE_URL", raising=False)
     monkeypatch.setenv("STACKFIX_PROVIDER", "stackfix")
@@ -65,3 +69,728 @@ def test_relay_default_path(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
     assert result.get("summary") == "ok"
     assert any(call[0].endswith("/anon-token") for call in fake.calls)
     assert any(call[0].endswith("/chat/completions") for call in fake.calls)
+
+
+def test_warm_up_fetches_token_and_connection(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    fake = _FakeRequests()
+    warmed = []
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
+    monkeypatch.setattr(transport, "warm", warmed.append)
+    monkeypatch.delenv("MODEL_API_KEY", raising=False)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "stackfix")
+    monkeypatch.setenv("STACKFIX_RELAY_URL", "https://api.stackfix.ai/v1")
+
+    agent.warm_up(str(temp_cwd))
+    assert [call[0] for call in fake.calls] == ["https://api.stackfix.ai/v1/anon-token"]
+    assert warmed == ["https://api.stackfix.ai/v1/chat/completions"]
+
+    # The model call that follows reuses the token.
+    agent.call_agent({"mode": "prompt", "prompt": "hello", "cwd": str(temp_cwd)})
+    assert [call[0] for call in fake.calls][1:] == ["https://api.stackfix.ai/v1/chat/completions"]
+
+
+def test_sessions_pooled_per_origin(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("STACKFIX_HTTP_POOL_SIZE", "7")
+    transport.close_sessions()
+    try:
+        token_session = transport.get_session("https://api.stackfix.ai/v1/anon-token")
+        chat_session = transport.get_session("https://API.stackfix.ai/v1/chat/completions")
+        other_session = transport.get_session("http://localhost:8000/v1/chat/completions")
+        assert token_session is chat_session
+        assert other_session is not token_session
+        adapter = token_session.get_adapter("https://api.stackfix.ai/v1")
+        assert adapter._pool_maxsize == 7
+        assert adapter.max_retries.read == 0
+    finally:
+        transport.close_sessions()
+
+
+class _FakeStreamResponse:
+    status_code = 200
+    headers = {"content-type": "text/event-stream"}
+
+    def __init__(self, content: str) -> None:
+        self._content = content
+        self.closed = False
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def iter_lines(self, decode_unicode: bool = False):
+        for i in range(0, len(self._content), 7):
+            chunk = {"choices": [{"delta": {"content": self._content[i:i + 7]}, "finish_reason": None}]}
+            yield "data: " + jsonlib.dumps(chunk)
+        yield "data: [DONE]"
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_streaming_stops_early_on_invalid_patch(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    bad = jsonlib.dumps({"summary": "first", "patch_unified_diff": "@@\n-a\n+b", "rerun_command": ["x"]})
+    good_patch = "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n"
+    good = jsonlib.dumps({"summary": "second", "patch_unified_diff": good_patch, "rerun_command": []})
+    responses = [_FakeStreamResponse(bad), _FakeStreamResponse(good)]
+    payloads = []
+
+    class _Session:
+        def post(self, url: str, json: Any = None, headers: Any = None, timeout: Any = 60, stream: bool = False):
+            payloads.append(json)
+            return responses[len(payloads) - 1]
+
+    monkeypatch.setattr(transport, "get_session", lambda url: _Session())
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "http://model.test/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+
+    events = []
+    result = agent.call_agent({"command": ["x"], "cwd": str(temp_cwd)}, on_stream=lambda *e: events.append(e))
+    assert result["summary"] == "second"
+    assert result["patch_unified_diff"] == good_patch
+    assert all(p["stream"] for p in payloads)
+    assert responses[0].closed
+    kinds = [e[0] for e in events]
+    assert kinds.index("patch_invalid") < kinds.index("retry") < kinds.index("patch_valid")
+    summaries = [t for e, f, t in events if e == "field_done" and f == "summary"]
+    assert summaries == ["first", "second"]
+
+
+def test_cached_response_skips_model(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    for args in (["init", "-q"], ["config", "user.email", "t@example.com"], ["config", "user.name", "t"]):
+        subprocess.run(["git", *args], cwd=temp_cwd, check=True)
+    (temp_cwd / "f").write_text("a\n")
+    subprocess.run(["git", "add", "f"], cwd=temp_cwd, check=True)
+    subprocess.run(["git", "commit", "-qm", "init"], cwd=temp_cwd, check=True)
+    (temp_cwd / "notes").mkdir()
+    (temp_cwd / "notes" / "todo.txt").write_text("one\n")
+    patch = "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n"
+    calls = []
+
+    def _call(context, system_prompt=agent.SYSTEM_PROMPT, **kwargs):
+        calls.append(system_prompt)
+        return agent._validate_agent_json({"summary": "fix", "patch_unified_diff": patch})
+
+    monkeypatch.setattr(agent, "_call_provider", _call)
+    context = {"command": ["pytest"], "cwd": str(temp_cwd), "exit_code": 1, "stdout": "", "stderr": "boom"}
+
+    # The first call writes stats and the cache entry under .stackfix/; that must not change the key.
+    first = agent.call_agent(context)
+    second = agent.call_agent(context)
+    assert len(calls) == 1
+    assert not first.get("_cached")
+    assert second["_cached"] is True
+    assert second["patch_unified_diff"] == patch
+
+    # An edit inside an untracked directory is a different tree.
+    (temp_cwd / "notes" / "todo.txt").write_text("one\ntwo\n")
+    assert not agent.call_agent(context).get("_cached")
+    assert len(calls) == 2
+
+    agent.call_agent(context, use_cache=False)
+    assert len(calls) == 3
+
+
+def test_local_repair_skips_strict_retry(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    (temp_cwd / "f.py").write_text("a = 1\nb = 2\n")
+    broken = "--- a/f.py\n+++ b/f.py\n@@\n-a = 1\n+a = 3\n"
+    calls = []
+
+    def _call(context, system_prompt=agent.SYSTEM_PROMPT, **kwargs):
+        calls.append(system_prompt)
+        return agent._validate_agent_json({"summary": "fix", "patch_unified_diff": broken})
+
+    monkeypatch.setattr(agent, "_call_provider", _call)
+    result = agent.call_agent({"command": ["x"], "cwd": str(temp_cwd), "stdout": "", "stderr": ""})
+    assert calls == [agent.SYSTEM_PROMPT]
+    assert result["_repaired"] is True
+    assert result["patch_unified_diff"].startswith("diff --git a/f.py b/f.py")
+    assert agent.stats.load_stats(str(temp_cwd))["diff_repair"] == {"attempts": 1, "repaired": 1}
+
+
+def test_search_replace_edit_format(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    (temp_cwd / "f.py").write_text("a = 1\nb = 2\n")
+    edits = [{"path": "f.py", "search": "b = 2", "replace": "b = 3"}]
+    prompts = []
+
+    def _call(context, system_prompt=agent.SYSTEM_PROMPT, **kwargs):
+        prompts.append(agent._model_request_payload(context, system_prompt)["messages"][0]["content"])
+        content = jsonlib.dumps({"summary": "fix", "edits": edits, "rerun_command": []})
+        return agent._parse_agent_response(content)
+
+    monkeypatch.setattr(agent, "_call_provider", _call)
+    monkeypatch.setenv("STACKFIX_EDIT_FORMAT", "search_replace")
+    result = agent.call_agent({"command": ["x"], "cwd": str(temp_cwd), "stdout": "", "stderr": ""})
+
+    assert prompts == [agent.SEARCH_REPLACE_PROMPT]
+    assert "edits" not in result
+    assert result["_edit_format"] == "search_replace"
+    assert "-b = 2\n+b = 3\n" in result["patch_unified_diff"]
+    counts = agent.stats.load_stats(str(temp_cwd))["edit_format"]
+    assert counts["search_replace_responses"] == 1
+    assert counts["search_replace_output_tokens"] > 0
+    assert counts["search_replace_diff_tokens"] > counts["search_replace_edit_tokens"]
+
+
+def test_json_extracted_from_noisy_reply() -> None:
+    answer = {"summary": "fix", "patch_unified_diff": "", "rerun_command": ["pytest"]}
+    noisy = "Here is the fix:\n```json\n" + jsonlib.dumps(answer, indent=2) + "\n```\nLet me know!"
+    result = agent._parse_agent_response(noisy)
+    assert (result["summary"], result["rerun_command"], result["_warning"]) == ("fix", ["pytest"], None)
+    assert result["_extracted"] is True
+
+    raw_newline = '{"summary": "two\nlines", "example": {"summary": "inner"}}'
+    assert agent._parse_agent_response("Sure. " + raw_newline)["summary"] == "two\nlines"
+
+    # A JSON example in a prose answer is not taken for the reply.
+    prose = 'Use a config like {"debug": true} in settings.json.'
+    assert agent._parse_agent_response(prose)["summary"] == prose
+
+
+def test_truncated_reply_is_continued(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    patch = "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n"
+    reply = jsonlib.dumps({"summary": "Replace a with b in f.", "patch_unified_diff": patch, "rerun_command": []})
+    cut = len(reply) // 2
+    # The continuation repeats the end of the first half, as models often do.
+    parts = [(reply[:cut], "length"), (reply[cut - 20:], "stop")]
+    payloads = []
+
+    def _post(url: str, json: Any = None, **kwargs):
+        payloads.append(json)
+        content, reason = parts[len(payloads) - 1]
+        choice = {"message": {"content": content}, "finish_reason": reason}
+        return _FakeResponse({"body": {"choices": [choice], "usage": {"completion_tokens": 50, "total_tokens": 900}}})
+
+    monkeypatch.setattr(agent.retry, "post", _post)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "https://models.example/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+    context = {"command": ["x"], "cwd": str(temp_cwd), "stdout": "", "stderr": "boom"}
+    result = agent.call_agent(context, use_cache=False)
+
+    assert len(payloads) == 2
+    assert payloads[1]["messages"][:-2] == payloads[0]["messages"]
+    assert payloads[1]["messages"][-2:] == [
+        {"role": "assistant", "content": reply[:cut]},
+        {"role": "user", "content": agent.CONTINUE_PROMPT},
+    ]
+    assert "response_format" not in payloads[1]
+    assert result["patch_unified_diff"] == patch
+    assert result["_usage"] == {"completion_tokens": 100, "total_tokens": 1800}
+    assert agent.stats.load_stats(str(temp_cwd))["responses"] == {"continued": 1, "continuation_requests": 1}
+
+
+def _mock_async_client(monkeypatch: pytest.MonkeyPatch, handler) -> None:
+    httpx = pytest.importorskip("httpx")
+    clients = {}
+
+    def _client():
+        loop = agent.asyncio.get_running_loop()
+        if loop not in clients:
+            clients[loop] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return clients[loop]
+
+    monkeypatch.setattr(transport, "get_async_client", _client)
+
+
+def test_call_agent_async_shares_one_loop(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    httpx = pytest.importorskip("httpx")
+    content = jsonlib.dumps({"summary": "ok", "patch_unified_diff": "", "rerun_command": []})
+    seen = []
+
+    def _handler(request):
+        seen.append(request.url.path)
+        chunks = [
+            "data: " + jsonlib.dumps({"choices": [{"delta": {"content": content[i:i + 9]}}]}) + "\n\n"
+            for i in range(0, len(content), 9)
+        ]
+        body = "".join(chunks) + "data: [DONE]\n\n"
+        return httpx.Response(200, text=body, headers={"content-type": "text/event-stream"})
+
+    _mock_async_client(monkeypatch, _handler)
+    token_session = _FakeRequests()
+    monkeypatch.setattr(transport, "get_session", lambda url: token_session)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "stackfix")
+    monkeypatch.setenv("STACKFIX_RELAY_URL", "https://relay.test/v1")
+    monkeypatch.delenv("MODEL_API_KEY", raising=False)
+
+    deltas = []
+
+    async def _run():
+        calls = [
+            agent.call_agent_async(
+                {"mode": "prompt", "prompt": f"q{i}", "cwd": str(temp_cwd)},
+                on_stream=lambda e, f, t: deltas.append(t) if e == "text" else None,
+            )
+            for i in range(3)
+        ]
+        return await agent.asyncio.gather(*calls)
+
+    results = agent.asyncio.run(_run())
+    assert [r["summary"] for r in results] == ["ok", "ok", "ok"]
+    assert "".join(deltas) == content * 3
+    assert seen.count("/v1/chat/completions") == 3
+    assert [call[0] for call in token_session.calls] == ["https://relay.test/v1/anon-token"]
+
+
+def test_call_agent_async_repairs_off_the_loop(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    httpx = pytest.importorskip("httpx")
+    broken = "--- a/f.py\n+++ b/f.py\n@@\n-a = 1\n+a = 3\n"
+    fixed = "diff --git a/f.py b/f.py\n--- a/f.py\n+++ b/f.py\n@@ -1 +1 @@\n-a = 1\n+a = 3\n"
+    content = jsonlib.dumps({"summary": "fix", "patch_unified_diff": broken, "rerun_command": []})
+
+    def _handler(request):
+        chunks = [
+            "data: " + jsonlib.dumps({"choices": [{"delta": {"content": content[i:i + 9]}}]}) + "\n\n"
+            for i in range(0, len(content), 9)
+        ]
+        return httpx.Response(200, text="".join(chunks), headers={"content-type": "text/event-stream"})
+
+    _mock_async_client(monkeypatch, _handler)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "http://model.test/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+    repair_threads = []
+
+    def _repair(patch, cwd):
+        repair_threads.append(agent.threading.get_ident())
+        return fixed
+
+    monkeypatch.setattr(agent, "repair_unified_diff", _repair)
+    events = []
+    context = {"command": ["x"], "cwd": str(temp_cwd), "stdout": "", "stderr": ""}
+
+    async def _run():
+        result = await agent.call_agent_async(context, on_stream=lambda e, f, t: events.append(e), use_cache=False)
+        return result, agent.threading.get_ident()
+
+    result, loop_thread = agent.asyncio.run(_run())
+    assert result["_repaired"] is True and result["patch_unified_diff"] == fixed
+    assert "patch_repaired" in events and "patch_invalid" not in events
+    # Repaired once while streaming, in a worker thread, and reused when the patch was accepted.
+    assert len(repair_threads) == 1 and repair_threads[0] != loop_thread
+
+
+def test_call_agent_async_deadline_and_cancel(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    pytest.importorskip("httpx")
+
+    async def _handler(request):
+        await agent.asyncio.sleep(30)
+
+    _mock_async_client(monkeypatch, _handler)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "http://model.test/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+    context = {"mode": "prompt", "prompt": "hi", "cwd": str(temp_cwd)}
+
+    async def _run():
+        with pytest.raises(RuntimeError, match="deadline"):
+            await agent.call_agent_async(context, deadline=0.1)
+        task = agent.asyncio.ensure_future(agent.call_agent_async(context))
+        await agent.asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(agent.asyncio.CancelledError):
+            await task
+
+    agent.asyncio.run(_run())
+
+
+def test_relay_discovery_routes_to_healthy_candidate(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    fake = _FakeRequests()
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
+    monkeypatch.setattr(agent.discovery, "_probe", lambda base, timeout: 0.01 if "localhost" in base else None)
+    monkeypatch.setattr(agent, "_DISCOVERED_RELAY", None)
+    monkeypatch.delenv("STACKFIX_RELAY_URL", raising=False)
+    monkeypatch.delenv("MODEL_API_KEY", raising=False)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "stackfix")
+
+    result = agent.call_agent({"mode": "prompt", "prompt": "hello", "cwd": str(temp_cwd)})
+    assert result["summary"] == "ok"
+    assert [call[0] for call in fake.calls] == [
+        "http://localhost:8000/v1/anon-token",
+        "http://localhost:8000/v1/chat/completions",
+    ]
+    assert "STACKFIX_RELAY_URL" not in agent.os.environ
+
+
+def test_relay_token_shared_across_projects(monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    fake = _FakeRequests()
+    original_post = fake.post
+
+    def _slow_post(url, **kwargs):
+        agent.threading.Event().wait(0.05)
+        return original_post(url, **kwargs)
+
+    fake.post = _slow_post
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
+    monkeypatch.setenv("STACKFIX_RELAY_URL", "https://relay.test/v1")
+    projects = [tmp_path / f"p{i}" for i in range(4)]
+    tokens = []
+    threads = [
+        agent.threading.Thread(target=lambda p=p: tokens.append(agent._get_relay_token(str(p))))
+        for p in projects
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert tokens == ["tok"] * 4
+    assert len(fake.calls) == 1
+    assert not any((p / ".stackfix").exists() for p in projects)
+
+
+
+def test_relay_token_request_leaves_user_lock_free(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    fake = _FakeRequests()
+    original_post = fake.post
+    posting = agent.threading.Event()
+    release = agent.threading.Event()
+
+    def _slow_post(url, **kwargs):
+        posting.set()
+        release.wait(10)
+        return original_post(url, **kwargs)
+
+    fake.post = _slow_post
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
+    monkeypatch.setenv("STACKFIX_RELAY_URL", "https://relay.test/v1")
+    tokens = []
+    requester = agent.threading.Thread(target=lambda: tokens.append(agent._request_relay_token(str(temp_cwd))))
+    requester.start()
+    assert posting.wait(5)
+
+    # Another process takes user_lock while the request is in flight, and stores a token of its own.
+    def _write_other() -> None:
+        with config.user_lock():
+            config.set_relay_token("https://relay.test/v1", "other", int(time.time()) + 3600)
+
+    writer = agent.threading.Thread(target=_write_other)
+    writer.start()
+    writer.join(2)
+    assert not writer.is_alive()
+    release.set()
+    requester.join(5)
+
+    assert tokens[0][0] == "other"
+    assert agent.get_relay_token("https://relay.test/v1")["token"] == "other"
+
+def test_relay_token_refreshed_before_expiry(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    fake = _FakeRequests()
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
+    monkeypatch.setenv("STACKFIX_RELAY_URL", "https://relay.test/v1")
+    now = int(time.time())
+    entry = {"token": "old", "expires_at": now + 120, "issued_at": now - 3600}
+    config._write_json(config._relay_path(), {"tokens": {"https://relay.test/v1": entry}})
+
+    assert agent._get_relay_token(str(temp_cwd)) == "old"
+    agent._TOKEN_REFRESHES["https://relay.test/v1"].join(timeout=5)
+    assert agent.get_relay_token("https://relay.test/v1")["token"] == "tok"
+    assert len(fake.calls) == 1
+
+
+
+class _FakeRelayServer:
+    """Answers fake WebSocket connections the way relay/app.py's /ws endpoint does."""
+
+    def __init__(self, handshake_tokens, request_tokens, batch: int = 1) -> None:
+        self.handshake_tokens = set(handshake_tokens)
+        self.request_tokens = set(request_tokens)
+        self.batch = batch
+        self.held = []
+        self.hold = False
+        self.connections = []
+        self.frames = []
+
+    def connect(self, url: str, header=(), timeout: Any = None) -> "_FakeRelaySocket":
+        token = header[0].split("Bearer ", 1)[1]
+        socket = _FakeRelaySocket(self, token)
+        self.connections.append(token)
+        if token in self.handshake_tokens:
+            socket.inbox.put(jsonlib.dumps({"type": "ready"}))
+        else:
+            socket.reject(None)
+        return socket
+
+    def receive(self, socket: "_FakeRelaySocket", frame: dict) -> None:
+        self.frames.append((socket.token, frame))
+        if frame["type"] == "cancel":
+            socket.inbox.put(jsonlib.dumps({"type": "cancelled", "id": frame["id"]}))
+            return
+        if socket.token not in self.request_tokens:
+            socket.reject(frame["id"])
+            return
+        if self.hold:
+            return
+        self.held.append((socket, frame))
+        if len(self.held) < self.batch:
+            return
+        # Answered in reverse, so each reply has to find its own request.
+        for waiting, request in reversed(self.held):
+            content = jsonlib.dumps({"summary": request["payload"].get("prompt", "ws"), "patch_unified_diff": ""})
+            waiting.inbox.put(jsonlib.dumps({"type": "delta", "id": request["id"], "content": content}))
+            response = {"choices": [{"message": {"content": content}, "finish_reason": "stop"}]}
+            waiting.inbox.put(jsonlib.dumps({"type": "done", "id": request["id"], "response": response}))
+        self.held = []
+
+
+class _FakeRelaySocket:
+    def __init__(self, server: _FakeRelayServer, token: str) -> None:
+        self.server = server
+        self.token = token
+        self.inbox: Any = agent.queue.Queue()
+
+    def reject(self, request_id) -> None:
+        error = {"type": "error", "status": 401, "detail": "Invalid or expired token"}
+        if request_id:
+            error["id"] = request_id
+        self.inbox.put(jsonlib.dumps(error))
+        self.inbox.put("")
+
+    def send(self, raw: str) -> None:
+        self.server.receive(self, jsonlib.loads(raw))
+
+    def recv(self) -> str:
+        return self.inbox.get()
+
+    def settimeout(self, timeout: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        self.inbox.put("")
+
+
+def _fake_relay_ws(monkeypatch: pytest.MonkeyPatch, server: _FakeRelayServer) -> None:
+    monkeypatch.setattr(agent.websocket, "create_connection", server.connect)
+    monkeypatch.setattr(agent, "_RELAY_CHANNEL", None)
+    monkeypatch.setattr(agent, "_RELAY_WS_UNAVAILABLE", False)
+    monkeypatch.setenv("STACKFIX_RELAY_WS", "1")
+    monkeypatch.setenv("STACKFIX_RELAY_URL", "https://relay.test/v1")
+
+
+def test_relay_channel_handshake_and_multiplexing(monkeypatch: pytest.MonkeyPatch) -> None:
+    server = _FakeRelayServer({"tok"}, {"tok"}, batch=2)
+    _fake_relay_ws(monkeypatch, server)
+
+    with pytest.raises(agent._RelayWsError) as rejected:
+        agent._RelayChannel("wss://relay.test/v1/ws", "bad")
+    assert rejected.value.status == 401
+
+    channel = agent._RelayChannel("wss://relay.test/v1/ws", "tok")
+    results = {}
+    threads = [
+        agent.threading.Thread(target=lambda n=n: results.update({n: channel.request({"prompt": n}, timeout=5)}))
+        for n in ("first", "second")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert {n: agent._extract_content(r) for n, r in results.items()} == {
+        n: jsonlib.dumps({"summary": n, "patch_unified_diff": ""}) for n in ("first", "second")
+    }
+    assert len(server.connections) == 2
+    channel.close()
+
+
+def test_relay_channel_cancels_abandoned_request(monkeypatch: pytest.MonkeyPatch) -> None:
+    server = _FakeRelayServer({"tok"}, {"tok"})
+    _fake_relay_ws(monkeypatch, server)
+    channel = agent._RelayChannel("wss://relay.test/v1/ws", "tok")
+
+    server.hold = True
+    with pytest.raises(RuntimeError, match="timed out"):
+        channel.request({"prompt": "slow"}, timeout=0.05)
+    server.hold = False
+
+    def _stop(text: str) -> None:
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        channel.request({"prompt": "stopped"}, on_delta=_stop, timeout=5)
+    kinds = [frame["type"] for _, frame in server.frames]
+    assert kinds == ["request", "cancel", "request", "cancel"]
+    assert server.frames[0][1]["id"] == server.frames[1][1]["id"]
+    assert server.frames[2][1]["id"] == server.frames[3][1]["id"]
+    assert channel._pending == {}
+    channel.close()
+
+
+def test_relay_ws_refreshes_rejected_token(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    fake = _FakeRequests()
+    monkeypatch.setattr(transport, "get_session", lambda url: fake)
+    monkeypatch.delenv("MODEL_API_KEY", raising=False)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "stackfix")
+    # "old" passes the handshake but has been revoked by the time the request arrives.
+    server = _FakeRelayServer({"old", "tok"}, {"tok"})
+    _fake_relay_ws(monkeypatch, server)
+    config.set_relay_token("https://relay.test/v1", "old", int(time.time()) + 3600)
+
+    result = agent.call_agent({"mode": "prompt", "prompt": "hello", "cwd": str(temp_cwd)})
+    assert result["summary"] == "ws"
+    assert server.connections == ["old", "tok"]
+    assert [call[0] for call in fake.calls] == ["https://relay.test/v1/anon-token"]
+    assert not agent._RELAY_WS_UNAVAILABLE
+    agent._RELAY_CHANNEL.close()
+
+def test_payload_keeps_stable_context_first() -> None:
+    base = {
+        "command": ["pytest"],
+        "cwd": "/repo",
+        "exit_code": 1,
+        "agent_instructions": "Use tabs.",
+        "manifests": {"pyproject.toml": "[project]", "package.json": "{}"},
+        "_temperature": 0.7,
+    }
+    first = agent._model_request_payload(dict(base, stdout="E assert 1 == 2", stderr=""))
+    reordered = dict(base, manifests={"package.json": "{}", "pyproject.toml": "[project]"})
+    second = agent._model_request_payload(dict(reordered, stdout="E assert 3 == 4", stderr="x"))
+
+    assert first["messages"][:-1] == second["messages"][:-1]
+    assert [m["role"] for m in first["messages"]] == ["system", "user", "user", "user"]
+    assert first["messages"][1]["content"] == "Project instructions (AGENTS.md):\nUse tabs."
+    failure = first["messages"][-1]["content"]
+    assert failure.startswith("Failure:\n")
+    assert jsonlib.loads(failure.split("\n", 1)[1]) == {
+        "command": ["pytest"],
+        "cwd": "/repo",
+        "exit_code": 1,
+        "stdout": "E assert 1 == 2",
+        "stderr": "",
+    }
+    assert first["temperature"] == 0.7
+
+
+def test_cache_hints_and_usage_recorded(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    content = jsonlib.dumps({"summary": "ok", "patch_unified_diff": "", "rerun_command": []})
+    payloads = []
+
+    class _Stream(_FakeStreamResponse):
+        def iter_lines(self, decode_unicode: bool = False):
+            yield from list(super().iter_lines())[:-1]
+            usage = {"prompt_tokens": 1200, "prompt_tokens_details": {"cached_tokens": 1024}}
+            yield "data: " + jsonlib.dumps({"choices": [], "usage": usage})
+            yield "data: [DONE]"
+
+    class _Session:
+        def post(self, url: str, json: Any = None, headers: Any = None, timeout: Any = 60, stream: bool = False):
+            payloads.append(json)
+            return _Stream(content)
+
+    monkeypatch.setattr(transport, "get_session", lambda url: _Session())
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "https://api.openai.com/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+
+    context = {"mode": "prompt", "prompt": "hi", "cwd": str(temp_cwd), "agent_instructions": "Be brief."}
+    agent.call_agent(context, on_stream=lambda *e: None)
+    agent.call_agent(dict(context, prompt="again"), on_stream=lambda *e: None)
+
+    assert payloads[0]["prompt_cache_key"] == payloads[1]["prompt_cache_key"]
+    assert payloads[0]["stream_options"] == {"include_usage": True}
+    recorded = agent.stats.load_stats(str(temp_cwd))
+    assert recorded["prompt_cache"] == {"requests": 2, "prompt_tokens": 2400, "cached_tokens": 2048}
+    assert recorded["first_token"]["streams"] == 2
+
+
+def test_race_leaves_out_relay_for_direct_key(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    monkeypatch.setenv("STACKFIX_RACE", "1")
+    monkeypatch.setenv("MODEL_BASE_URL", "http://model.test/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+    monkeypatch.delenv("STACKFIX_ENDPOINT", raising=False)
+    monkeypatch.delenv("STACKFIX_PROVIDER", raising=False)
+    started = []
+
+    def _call_kind(kind, endpoint, context, system_prompt, on_delta):
+        started.append(kind)
+        return agent._parse_agent_response("ok")
+
+    monkeypatch.setattr(agent, "_call_kind", _call_kind)
+    assert [name for name, _, _ in agent._available_providers()] == ["direct:model.test"]
+    assert not agent._race_providers_available()
+    agent.call_agent({"mode": "prompt", "prompt": "hi", "cwd": str(temp_cwd)})
+    assert started == ["direct"]
+
+
+def test_race_hedges_to_faster_provider(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    monkeypatch.setenv("STACKFIX_RACE", "1")
+    monkeypatch.setenv("STACKFIX_RACE_RELAY", "1")
+    monkeypatch.setenv("STACKFIX_HEDGE_DELAY", "0.05")
+    monkeypatch.setenv("MODEL_BASE_URL", "http://model.test/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+    started = []
+
+    def _call_kind(kind, endpoint, context, system_prompt, on_delta):
+        started.append(kind)
+        if kind == "direct":
+            for _ in range(200):
+                on_delta("slow ")
+                time.sleep(0.01)
+            return agent._parse_agent_response("slow")
+        on_delta("fast")
+        return agent._parse_agent_response("fast")
+
+    monkeypatch.setattr(agent, "_call_kind", _call_kind)
+    events = []
+    context = {"mode": "prompt", "prompt": "hi", "cwd": str(temp_cwd)}
+    result = agent.call_agent(context, on_stream=lambda e, f, t: events.append((e, t)))
+
+    assert result["summary"] == "fast"
+    assert started == ["direct", "relay"]
+    assert ("retry", "relay answered first; using its response") in events
+    latency = agent.hedging.load_latency()
+    assert latency["relay"]["won"] == 1
+    assert latency["direct:model.test"]["lost"] == 1
+    assert agent.stats.load_stats(str(temp_cwd))["race"] == {"relay_wins": 1}
+
+    started.clear()
+    agent.call_agent(context)
+    assert started == ["relay"]
+
+
+def test_race_async_cancels_loser(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    pytest.importorskip("httpx")
+    monkeypatch.setenv("STACKFIX_RACE", "1")
+    monkeypatch.setenv("STACKFIX_RACE_RELAY", "1")
+    monkeypatch.setenv("STACKFIX_HEDGE_DELAY", "0.05")
+    monkeypatch.setenv("STACKFIX_ENDPOINT", "http://modal.test/run")
+    cancelled = []
+
+    async def _acall_kind(kind, endpoint, context, system_prompt, on_delta, timeout):
+        try:
+            await agent.asyncio.sleep(30 if kind == "modal" else 0.01)
+        except agent.asyncio.CancelledError:
+            cancelled.append(kind)
+            raise
+        patch = "diff --git a/x b/x\n--- a/x\n+++ b/x\n@@ -1 +1 @@\n-a\n+b\n"
+        return agent._validate_agent_json({"summary": kind, "patch_unified_diff": patch})
+
+    monkeypatch.setattr(agent, "_acall_kind", _acall_kind)
+    monkeypatch.setattr(agent.hedging, "race_order", lambda names: ["modal:modal.test", "relay"])
+    context = {"command": "pytest", "cwd": str(temp_cwd)}
+
+    started = time.monotonic()
+    result = agent.asyncio.run(agent.call_agent_async(context, use_cache=False))
+    assert result["summary"] == "relay"
+    assert time.monotonic() - started < 1
+    assert cancelled == ["modal"]
+    assert agent.hedging.load_latency()["modal:modal.test"]["lost"] == 1
+
+
+def test_async_call_retries_rate_limited_response(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    httpx = pytest.importorskip("httpx")
+    content = jsonlib.dumps({"summary": "ok", "patch_unified_diff": "", "rerun_command": []})
+    statuses = []
+
+    def _handler(request):
+        statuses.append(503 if not statuses else 200)
+        if statuses[-1] == 503:
+            return httpx.Response(503, headers={"Retry-After": "0"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+
+    _mock_async_client(monkeypatch, _handler)
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "http://model.test/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+
+    result = agent.asyncio.run(agent.call_agent_async({"mode": "prompt", "prompt": "hi", "cwd": str(temp_cwd)}))
+    assert result["summary"] == "ok"
+    assert statuses == [503, 200]
@@ -0,0 +1,77 @@
+"""Tests for the on-disk agent response cache."""
+
+import os
+import subprocess
+import time
+
+import pytest
+
+from stackfix import cache
+
+
+def _git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture
+def repo(temp_cwd):
+    _git(temp_cwd, "init", "-q")
+    _git(temp_cwd, "config", "user.email", "t@example.com")
+    _git(temp_cwd, "config", "user.name", "t")
+    (temp_cwd / "app.py").write_text("x = 1\n")
+    (temp_cwd / "pyproject.toml").write_text("[project]\nname = 'x'\n")
+    _git(temp_cwd, "add", ".")
+    _git(temp_cwd, "commit", "-qm", "init")
+    return temp_cwd
+
+
+def _context(cwd, stderr="E assert 1 == 2 (0.12s) at 0x7f3a2b1c4d50"):
+    return {
+        "command": ["pytest"],
+        "cwd": str(cwd),
+        "exit_code": 1,
+        "stdout": "",
+        "stderr": stderr,
+        "manifests": {"pyproject.toml": "..."},
+    }
+
+
+def test_fingerprint_ignores_volatile_output(repo):
+    first = cache.fingerprint(_context(repo))
+    second = cache.fingerprint(_context(repo, "E assert 1 == 2 (3.40s) at 0x7f00000000aa"))
+    assert first and first == second
+    assert cache.fingerprint(_context(repo, "E assert 1 == 3")) != first
+
+
+def test_fingerprint_tracks_tree_and_manifests(repo):
+    base = cache.fingerprint(_context(repo))
+    (repo / "app.py").write_text("x = 2\n")
+    edited = cache.fingerprint(_context(repo))
+    assert edited != base
+    (repo / "pyproject.toml").write_text("[project]\nname = 'y'\n")
+    assert cache.fingerprint(_context(repo)) != edited
+
+
+def test_fingerprint_requires_git(temp_cwd):
+    assert cache.fingerprint(_context(temp_cwd)) is None
+
+
+def test_store_lookup_and_age_eviction(repo, monkeypatch):
+    cache.store(str(repo), "k1", {"summary": "s"})
+    assert cache.lookup(str(repo), "k1") == {"summary": "s"}
+    monkeypatch.setenv("STACKFIX_CACHE_TTL_SECONDS", "10")
+    path = os.path.join(str(repo), cache.CACHE_DIR, "k1.json")
+    old = time.time() - 60
+    os.utime(path, (old, old))
+    assert cache.lookup(str(repo), "k1") is None
+    assert not os.path.exists(path)
+
+
+def test_size_eviction_drops_oldest(repo, monkeypatch):
+    monkeypatch.setenv("STACKFIX_CACHE_MAX_BYTES", "150")
+    cache.store(str(repo), "old", {"summary": "a" * 60})
+    path = os.path.join(str(repo), cache.CACHE_DIR, "old.json")
+    os.utime(path, (time.time() - 5, time.time() - 5))
+    cache.store(str(repo), "new", {"summary": "b" * 60})
+    assert cache.lookup(str(repo), "old") is None
+    assert cache.lookup(str(repo), "new") == {"summary": "b" * 60}
@@ -0,0 +1,83 @@
+"""Tests for parallel candidate verification."""
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import stackfix
+from stackfix.candidates import run_candidates
+
+
+@pytest.fixture
+def repo(temp_cwd):
+    for args in (["init", "-q"], ["config", "user.email", "t@example.com"], ["config", "user.name", "t"]):
+        subprocess.run(["git", *args], cwd=temp_cwd, check=True)
+    (temp_cwd / "calc.py").write_text("def add(a, b):\n    return a - b\n")
+    subprocess.run(["git", "add", "."], cwd=temp_cwd, check=True)
+    subprocess.run(["git", "commit", "-qm", "init"], cwd=temp_cwd, check=True)
+    (temp_cwd / "check.py").write_text("from calc import add\nassert add(2, 2) == 4\n")
+    return temp_cwd
+
+
+def _patch(new_line):
+    return (
+        "diff --git a/calc.py b/calc.py\n--- a/calc.py\n+++ b/calc.py\n@@ -1,2 +1,2 @@\n"
+        f" def add(a, b):\n-    return a - b\n+{new_line}\n"
+    )
+
+
+def test_first_passing_candidate_wins_without_touching_tree(repo):
+    patches = {0: _patch("    return a * b + 1"), 1: _patch("    return a + b"), 2: ""}
+    seen = []
+
+    def _fake_agent(context, use_cache=True):
+        index = 0 if "candidate_hint" not in context else int(context["candidate_hint"].split()[1]) - 1
+        seen.append(context["_temperature"])
+        return {"summary": f"c{index}", "patch_unified_diff": patches[index], "rerun_command": ["rm", "-rf", "."]}
+
+    command = [sys.executable, "check.py"]
+    winner, outcomes = run_candidates({"cwd": str(repo)}, command, 3, str(repo), workers=2, agent_call=_fake_agent)
+
+    assert winner is not None
+    assert winner["agent_result"]["summary"] == "c1"
+    assert winner["verify_command"] == command
+    assert len(set(seen)) == 3
+    assert (repo / "calc.py").read_text() == "def add(a, b):\n    return a - b\n"
+    assert any(o["index"] == 1 and o["passed"] for o in outcomes)
+
+
+def test_fix_command_is_a_candidate(repo):
+    def _rule_agent(context, use_cache=True):
+        return {"summary": "install", "patch_unified_diff": "", "_fix_command": ["pip", "install", "pyyaml"]}
+
+    command = [sys.executable, "check.py"]
+    winner, outcomes = run_candidates({"cwd": str(repo)}, command, 2, str(repo), agent_call=_rule_agent)
+
+    assert winner["fix_command"] == ["pip", "install", "pyyaml"]
+    assert winner["verify_command"] == command
+    assert not winner.get("error")
+
+
+def test_process_exits_without_waiting_for_losing_calls(repo):
+    script = f"""
+import sys, time
+from stackfix.candidates import run_candidates
+
+def agent(context, use_cache=True):
+    if "candidate_hint" in context:
+        time.sleep(60)
+    diff = {_patch("    return a + b")!r}
+    return {{"summary": "fast", "patch_unified_diff": diff, "rerun_command": []}}
+
+winner, _ = run_candidates({{"cwd": "."}}, [sys.executable, "check.py"], 3, ".", agent_call=agent)
+print(winner["agent_result"]["summary"])
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(stackfix.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    started = time.monotonic()
+    done = subprocess.run([sys.executable, "-c", script], cwd=repo, env=env, capture_output=True, text=True, timeout=30)
+    assert done.stdout.strip() == "fast", done.stderr
+    assert time.monotonic() - started < 20
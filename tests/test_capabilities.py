@@ -0,0 +1,114 @@
+import json as jsonlib
+from typing import Any
+
+import stackfix.agent as agent
+import stackfix.capabilities as capabilities
+
+URL = "https://models.example/v1/chat/completions"
+
+
+class _Response:
+    def __init__(self, status_code: int, body: Any = None) -> None:
+        self.status_code = status_code
+        self.headers = {"content-type": "application/json"}
+        self._body = body or {}
+        self.text = jsonlib.dumps(self._body)
+
+    def json(self) -> Any:
+        return self._body
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def close(self) -> None:
+        pass
+
+
+def _no_json_mode_endpoint(calls: list):
+    """Rejects response_format, ignores stream and answers in reasoning_content."""
+
+    def _post(url: str, json: Any = None, **kwargs):
+        calls.append(json)
+        if "response_format" in json:
+            return _Response(400, {"error": "response_format is not supported"})
+        patch = "diff --git a/f b/f\n--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n"
+        content = jsonlib.dumps({"summary": "ok", "patch_unified_diff": patch, "rerun_command": []})
+        message = {"content": "", "reasoning_content": content}
+        return _Response(200, {"choices": [{"message": message, "finish_reason": "stop"}]})
+
+    return _post
+
+
+def test_probe_once_and_build_requests_for_endpoint(monkeypatch, temp_cwd) -> None:
+    probes, requests = [], []
+    monkeypatch.setattr(capabilities.transport, "post", _no_json_mode_endpoint(probes))
+    monkeypatch.setattr(agent.retry, "post", _no_json_mode_endpoint(requests))
+    monkeypatch.delenv("STACKFIX_NO_PROBE")
+    monkeypatch.setenv("STACKFIX_PROVIDER", "direct")
+    monkeypatch.setenv("MODEL_BASE_URL", "https://models.example/v1")
+    monkeypatch.setenv("MODEL_API_KEY", "key")
+    monkeypatch.setenv("MODEL_NAME", "m1")
+    context = {"command": ["x"], "cwd": str(temp_cwd), "stdout": "", "stderr": "boom"}
+
+    assert agent.call_agent(context, use_cache=False)["summary"] == "ok"
+    agent.call_agent(context, use_cache=False, on_stream=lambda *event: None)
+
+    # Rejected with response_format, then accepted without it; the stream flag was ignored.
+    assert [("response_format" in p, p.get("stream", False)) for p in probes] == [(True, True), (False, True)]
+    assert all("response_format" not in p and "stream" not in p for p in requests)
+    assert len(requests) == 2
+    saved = capabilities.saved(URL, "m1")
+    assert (saved["response_format"], saved["stream"]) == (False, False)
+    assert saved["content_shape"] == "message.reasoning_content"
+    assert capabilities.saved(URL, "other-model") is None
+
+
+def test_saved_capabilities_expire_and_reset_on_rejection(monkeypatch) -> None:
+    calls = []
+    monkeypatch.setattr(capabilities.transport, "post", _no_json_mode_endpoint(calls))
+    monkeypatch.delenv("STACKFIX_NO_PROBE")
+    endpoint = capabilities.for_endpoint(URL, {}, "m1")
+    assert not endpoint.response_format
+    capabilities.for_endpoint(URL, {}, "m1")
+    assert len(calls) == 2
+
+    monkeypatch.setenv("STACKFIX_CAPABILITY_TTL", "0")
+    assert capabilities.saved(URL, "m1") is None
+    monkeypatch.delenv("STACKFIX_CAPABILITY_TTL")
+
+    endpoint = capabilities.Endpoint(URL, "m1", capabilities.saved(URL, "m1"))
+    endpoint.rejected()
+    assert capabilities.saved(URL, "m1") is None
+    payload = {"response_format": {"type": "json_object"}, "stream": True}
+    capabilities.Endpoint(URL, "m1").fit(payload)
+    assert payload == {"response_format": {"type": "json_object"}, "stream": True}
+
+
+def test_extract_content_prefers_known_shape() -> None:
+    data = {"choices": [{"message": {"content": "answer", "reasoning_content": "thoughts"}}]}
+    assert capabilities.extract_content(data) == ("message.content", "answer")
+    assert capabilities.extract_content(data, "message.reasoning_content") == ("message.reasoning_content", "thoughts")
+    parts = {"choices": [{"message": {"content": [{"type": "text", "text": "a"}, {"text": "b"}]}}]}
+    assert capabilities.extract_content(parts, "message.content") == ("message.content list", "ab")
+    assert capabilities.extract_content({"choices": []}) == (None, None)
+
+
+def test_undetermined_probe_is_cached(monkeypatch) -> None:
+    calls = []
+
+    def _post(url: str, json: Any = None, **kwargs):
+        calls.append(json)
+        return _Response(500, {"error": "unavailable"})
+
+    monkeypatch.setattr(capabilities.transport, "post", _post)
+    monkeypatch.delenv("STACKFIX_NO_PROBE")
+    endpoint = capabilities.for_endpoint(URL, {}, "m1")
+    assert (endpoint.response_format, endpoint.stream, endpoint.content_shape) == (True, True, None)
+    capabilities.for_endpoint(URL, {}, "m1")
+    assert len(calls) == 1
+    assert capabilities.saved(URL, "m1")["undetermined"] is True
+
+    monkeypatch.setenv("STACKFIX_CAPABILITY_TTL", "0")
+    capabilities.for_endpoint(URL, {}, "m1")
+    assert len(calls) == 2
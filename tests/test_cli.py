@@ -1,10 +1,15 @@
 """Tests for StackFix CLI."""
 
+import json
 import os
 import subprocess
 import sys
 from pathlib import Path
 
+import pytest
+
+import stackfix.cli as cli
+
 
 def test_cli_help():
     """Test that --help flag works correctly."""
@@ -59,3 +64,46 @@ def test_npm_wrapper_help():
     )
     assert result.returncode == 0
     assert "StackFix" in result.stdout
+
+
+def test_cli_iterates_until_rerun_passes(temp_cwd, monkeypatch):
+    """--max-iterations sends follow-up context and records per-round timings."""
+    for args in (["init", "-q"], ["config", "user.email", "t@example.com"], ["config", "user.name", "t"]):
+        subprocess.run(["git", *args], cwd=temp_cwd, check=True)
+    (temp_cwd / "value.py").write_text("X = 1\n")
+    subprocess.run(["git", "add", "."], cwd=temp_cwd, check=True)
+    subprocess.run(["git", "commit", "-qm", "init"], cwd=temp_cwd, check=True)
+
+    def _patch(old, new):
+        return (
+            "diff --git a/value.py b/value.py\n--- a/value.py\n+++ b/value.py\n"
+            f"@@ -1 +1 @@\n-X = {old}\n+X = {new}\n"
+        )
+
+    contexts = []
+
+    def _call_agent(context, on_stream=None, use_cache=True):
+        contexts.append(context)
+        step = len(contexts)
+        return {"summary": f"step {step}", "patch_unified_diff": _patch(step, step + 1), "rerun_command": []}
+
+    monkeypatch.setattr(cli, "call_agent", _call_agent)
+    monkeypatch.setattr("builtins.input", lambda prompt="": "a")
+    monkeypatch.setenv("STACKFIX_NO_STREAM", "1")
+    check = "import value, sys; sys.exit(0 if value.X == 3 else 1)"
+    monkeypatch.setattr(sys, "argv", ["stackfix", "--max-iterations", "4", "--", sys.executable, "-c", check])
+
+    with pytest.raises(SystemExit) as exit_info:
+        cli.main()
+    assert exit_info.value.code == 0
+    assert len(contexts) == 2
+    follow_up = contexts[1]
+    assert follow_up["iteration"] == 2
+    assert follow_up["previous_patch"] == _patch(1, 2)
+    assert "+X = 2" in follow_up["diff_since_last_iteration"]
+    assert "git_status" not in follow_up
+
+    record = json.loads((temp_cwd / ".stackfix" / "history" / "last.json").read_text())
+    assert [r["rerun_exit_code"] for r in record["iterations"]] == [1, 0]
+    assert all("agent_seconds" in r and "rerun_seconds" in r for r in record["iterations"])
+    assert record["applied_patches"] == [_patch(1, 2), _patch(2, 3)]
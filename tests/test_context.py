@@ -0,0 +1,144 @@
+import os
+import subprocess
+import threading
+import time
+
+import stackfix.agent as agent
+import stackfix.context as context_mod
+from stackfix.context import ContextPrefetch, collect_context
+from stackfix.stats import load_stats
+
+
+def _git(cwd, *args) -> None:
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def _age(cwd, *names, seconds: int = 60) -> None:
+    for name in names:
+        os.utime(cwd / name, (time.time() - seconds, time.time() - seconds))
+
+
+def _repo(cwd) -> None:
+    _git(cwd, "init", "-q")
+    _git(cwd, "config", "user.email", "dev@example.com")
+    _git(cwd, "config", "user.name", "dev")
+    (cwd / "app.py").write_text("x = 1\n")
+    (cwd / "requirements.txt").write_text("requests\n")
+    # Index entries older than the index itself, so git never rewrites it to settle racy entries.
+    _age(cwd, "app.py", "requirements.txt", seconds=120)
+    _git(cwd, "add", ".")
+    _git(cwd, "commit", "-qm", "init")
+    (cwd / "app.py").write_text("x = 2\n")
+    (cwd / "AGENTS.md").write_text("Run pytest.\n")
+
+
+def test_prefetch_overlaps_command_and_reuses_git_state(temp_cwd) -> None:
+    _repo(temp_cwd)
+    warmed = threading.Event()
+    prefetch = ContextPrefetch(str(temp_cwd), warm_up=warmed.set)
+    ctx = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom", prefetch=prefetch)
+
+    assert warmed.wait(5)
+    assert ctx["agent_instructions"] == "Run pytest.\n"
+    assert "+x = 2" in ctx["git_diff"]
+    assert ctx["manifests"] == {"requirements.txt": "requests\n"}
+    timings = ctx["_context_timings"]
+    assert timings["git_reused"] is True
+    assert {"git_seconds", "manifests_seconds", "agent_instructions_seconds", "wait_seconds"} <= timings.keys()
+    counters = load_stats(str(temp_cwd))["context"]
+    assert (counters["collections"], counters["git_reused"]) == (1, 1)
+
+
+def test_prefetch_rereads_what_the_command_changed(temp_cwd) -> None:
+    _repo(temp_cwd)
+    prefetch = ContextPrefetch(str(temp_cwd))
+    prefetch.result("git")
+    prefetch.result("manifests")
+    # The wrapped command edits a source file and a manifest while it runs.
+    (temp_cwd / "app.py").write_text("x = 3\n")
+    (temp_cwd / "requirements.txt").write_text("requests\nrich\n")
+    ctx = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom", prefetch=prefetch)
+
+    assert "+x = 3" in ctx["git_diff"]
+    assert ctx["manifests"]["requirements.txt"] == "requests\nrich\n"
+    assert ctx["_context_timings"]["git_reused"] is False
+
+
+def test_status_paths_handles_renames_and_quoting() -> None:
+    assert context_mod._status_paths(" M a.py\nR  old.py -> new.py\n?? dir/\n") == ["a.py", "new.py", "dir/"]
+    assert context_mod._status_paths(' M "sp ace.py"\n') is None
+
+
+def test_context_cache_reuses_unchanged_reads(temp_cwd, monkeypatch) -> None:
+    _repo(temp_cwd)
+    _age(temp_cwd, "app.py", "AGENTS.md")
+    first = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom")
+    assert first["_context_timings"]["git_diff_cached"] is False
+
+    reads = []
+    monkeypatch.setattr(context_mod, "_read_file", lambda path: reads.append(path) or "")
+    second = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom")
+    assert second["_context_timings"]["git_diff_cached"] is True
+    assert reads == []
+    assert (second["git_diff"], second["manifests"]) == (first["git_diff"], first["manifests"])
+    assert second["agent_instructions"] == "Run pytest.\n"
+
+    # A same-size edit to a changed file and a new manifest entry are both noticed.
+    monkeypatch.undo()
+    (temp_cwd / "app.py").write_text("x = 5\n")
+    (temp_cwd / "requirements.txt").write_text("requests\nrich\n")
+    third = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom")
+    assert third["_context_timings"]["git_diff_cached"] is False
+    assert "+x = 5" in third["git_diff"]
+    assert third["manifests"]["requirements.txt"] == "requests\nrich\n"
+
+
+def test_git_diff_is_bounded_and_ranked_for_the_failure(temp_cwd, monkeypatch) -> None:
+    _git(temp_cwd, "init", "-q")
+    names = [f"mod{n}.py" for n in range(8)]
+    for name in names:
+        (temp_cwd / name).write_text("".join(f"v{i} = 0\n" for i in range(200)))
+    (temp_cwd / "package-lock.json").write_text("{}\n")
+    (temp_cwd / "logo.png").write_bytes(b"\x89PNG\0\0")
+    _git(temp_cwd, "add", ".")
+    _git(temp_cwd, "-c", "user.email=dev@example.com", "-c", "user.name=dev", "commit", "-qm", "init")
+    for name in names:
+        (temp_cwd / name).write_text("".join(f"v{i} = 1\n" for i in range(200)))
+    (temp_cwd / "package-lock.json").write_text('{"lockfileVersion": 3}\n')
+    (temp_cwd / "logo.png").write_bytes(b"\x89PNG\0\1")
+    monkeypatch.setattr(context_mod, "MAX_GIT_CHARS", 6000)
+    monkeypatch.setattr(context_mod, "MAX_GIT_READ_BYTES", 8000)
+
+    stderr = 'Traceback (most recent call last):\n  File "mod7.py", line 3, in <module>\nNameError: v\n'
+    diff = collect_context(str(temp_cwd), ["python", "mod7.py"], 1, "", stderr)["git_diff"]
+
+    assert diff.startswith(" logo.png")
+    assert "package-lock.json |" in diff
+    body = diff[diff.index("diff --git"):]
+    # mod7.py is past the bounded read, so it was fetched on its own and put first.
+    assert body.startswith("diff --git a/mod7.py b/mod7.py")
+    assert "lockfileVersion" not in diff and "Binary files" not in diff
+    assert diff.endswith("see the stat above]\n")
+    assert len(diff) < 6200
+
+    text, more = context_mod._git_stream(str(temp_cwd), ["diff"], 1000)
+    assert (len(text), more) == (1000, True)
+
+
+def test_repo_summary_is_identical_across_runs(temp_cwd) -> None:
+    _repo(temp_cwd)
+    (temp_cwd / "src").mkdir()
+    (temp_cwd / "src" / "lib.py").write_text("y = 1\n")
+    _git(temp_cwd, "add", "src")
+    _git(temp_cwd, "commit", "-qm", "src")
+    first = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom")
+
+    # Build output and caches written by the failing command do not change the summary.
+    (temp_cwd / "dist").mkdir()
+    (temp_cwd / "__pycache__").mkdir()
+    (temp_cwd / "scratch.txt").write_text("tmp\n")
+    second = collect_context(str(temp_cwd), ["pytest"], 1, "", "boom")
+
+    assert first["repo_summary"] == {"project_types": ["python"], "top_level": ["app.py", "requirements.txt", "src/"]}
+    assert agent._canonical_json(first["repo_summary"]) == agent._canonical_json(second["repo_summary"])
+    assert agent._stable_context_messages(first)[-1]["content"].startswith("Repository summary:\n")
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+import stackfix.discovery as discovery
+from stackfix.config import load_config
+
+
+def test_healthz_url_strips_api_prefix() -> None:
+    assert discovery.healthz_url("https://api.stackfix.ai/v1") == "https://api.stackfix.ai/healthz"
+    assert discovery.healthz_url("http://localhost:8000/v1/") == "http://localhost:8000/healthz"
+    assert discovery.healthz_url("http://relay.test") == "http://relay.test/healthz"
+
+
+def test_probe_picks_fastest_healthy(monkeypatch: pytest.MonkeyPatch) -> None:
+    delays = {"http://slow/v1": (0.3, True), "http://broken/v1": (0.01, False), "http://fast/v1": (0.05, True)}
+
+    def _probe(base, timeout):
+        delay, healthy = delays[base]
+        time.sleep(delay)
+        return delay if healthy else None
+
+    monkeypatch.setattr(discovery, "_probe", _probe)
+    started = time.monotonic()
+    choice = discovery.probe_fastest(list(delays), timeout=1)
+    assert choice["url"] == "http://fast/v1"
+    assert time.monotonic() - started < 0.25
+
+
+def test_discovered_relay_is_saved_and_reused(monkeypatch: pytest.MonkeyPatch, temp_cwd) -> None:
+    candidates = ["http://remote/v1", "http://local/v1"]
+    probes = []
+
+    def _probe(base, timeout):
+        probes.append(base)
+        return 0.01 if base == "http://local/v1" else None
+
+    monkeypatch.setattr(discovery, "_probe", _probe)
+    cwd = str(temp_cwd)
+    assert discovery.discover_relay(cwd, candidates) == "http://local/v1"
+    assert load_config(cwd)["relay"]["endpoint"]["url"] == "http://local/v1"
+    probes.clear()
+
+    assert discovery.discover_relay(cwd, candidates) == "http://local/v1"
+    assert probes == []
+
+    monkeypatch.setenv("STACKFIX_RELAY_DISCOVERY_TTL", "0")
+    discovery.discover_relay(cwd, candidates)
+    assert "http://local/v1" in probes
+
+    monkeypatch.setattr(discovery, "_probe", lambda base, timeout: None)
+    assert discovery.discover_relay(cwd, candidates, force=True) == "http://remote/v1"
+    assert "endpoint" not in load_config(cwd)["relay"]
@@ -0,0 +1,38 @@
+import stackfix.hedging as hedging
+
+
+def test_hedge_delay_follows_latency(monkeypatch) -> None:
+    monkeypatch.delenv("STACKFIX_HEDGE_DELAY", raising=False)
+    assert hedging.hedge_delay("relay") == hedging.DEFAULT_HEDGE_DELAY
+
+    for seconds in (4.0, 4.0, 4.0):
+        hedging.record_latency("relay", seconds, "won")
+    entry = hedging.load_latency()["relay"]
+    assert entry["won"] == 3
+    assert entry["avg_seconds"] == 4.0
+    assert 4.0 < hedging.hedge_delay("relay") < 8.0
+
+    monkeypatch.setenv("STACKFIX_HEDGE_DELAY", "0.5")
+    assert hedging.hedge_delay("relay") == 0.5
+
+
+def test_race_order_prefers_fastest_measured() -> None:
+    names = ["modal:m", "direct:d", "relay"]
+    assert hedging.race_order(names) == names
+
+    hedging.record_latency("relay", 2.0, "won")
+    hedging.record_latency("direct:d", 5.0, "won")
+    assert hedging.race_order(names) == ["relay", "direct:d", "modal:m"]
+
+    # Failures count double, so a flaky provider falls behind.
+    for _ in range(6):
+        hedging.record_latency("relay", 3.0, "failed")
+    assert hedging.race_order(names)[0] == "direct:d"
+
+
+def test_cancelled_request_only_raises_estimate() -> None:
+    hedging.record_latency("relay", 5.0, "won")
+    hedging.record_latency("relay", 1.0, "lost")
+    assert hedging.load_latency()["relay"]["avg_seconds"] == 5.0
+    hedging.record_latency("relay", 10.0, "lost")
+    assert hedging.load_latency()["relay"]["avg_seconds"] == 6.0
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+
+from stackfix import lockfiles
+from stackfix.context import collect_context
+
+YARN_LOCK = """# yarn lockfile v1
+
+
+"@babel/core@^7.0.0", "@babel/core@^7.1.0":
+  version "7.22.5"
+  resolved "https://registry.yarnpkg.com/@babel/core/-/core-7.22.5.tgz"
+
+left-pad@^1.3.0:
+  version "1.3.0"
+
+lodash@^3.0.0:
+  version "3.10.1"
+
+lodash@^4.17.0:
+  version "4.17.21"
+"""
+
+
+def test_lockfile_parsers() -> None:
+    assert lockfiles.parse_yarn(YARN_LOCK) == {
+        "@babel/core": ["7.22.5"],
+        "left-pad": ["1.3.0"],
+        "lodash": ["3.10.1", "4.17.21"],
+    }
+    berry = '__metadata:\n  version: 6\n\n"react@npm:^18.0.0, react@npm:^18.2.0":\n  version: 18.2.0\n'
+    assert lockfiles.parse_yarn(berry) == {"react": ["18.2.0"]}
+
+    pnpm6 = "lockfileVersion: '6.0'\npackages:\n  /@types/node@20.1.0:\n    dev: true\n"
+    pnpm6 += "  /react-dom@18.2.0(react@18.2.0):\n    dev: false\n  /left-pad/1.3.0:\n    dev: false\n"
+    assert lockfiles.parse_pnpm(pnpm6) == {"@types/node": ["20.1.0"], "react-dom": ["18.2.0"], "left-pad": ["1.3.0"]}
+    pnpm9 = "lockfileVersion: '9.0'\npackages:\n  '@babel/core@7.22.5':\n    resolution: {}\n  react@18.2.0:\n"
+    assert lockfiles.parse_pnpm(pnpm9) == {"@babel/core": ["7.22.5"], "react": ["18.2.0"]}
+
+    poetry = '[[package]]\nname = "PyYAML"\nversion = "6.0.1"\n\n[package.dependencies]\nname = "x"\n\n'
+    poetry += '[[package]]\nname = "requests"\nversion = "2.31.0"\n\n[metadata]\nlock-version = "2.0"\n'
+    assert lockfiles.parse_poetry(poetry) == {"pyyaml": ["6.0.1"], "requests": ["2.31.0"]}
+
+    tables = {"yarn.lock": lockfiles.parse_yarn(YARN_LOCK), "poetry.lock": lockfiles.parse_poetry(poetry)}
+    text = "Error: Cannot find module 'lodash/fp'\nImportError: PyYAML is required\n"
+    assert lockfiles.failure_entries(tables, text) == {
+        "yarn.lock": {"lodash": "3.10.1, 4.17.21"},
+        "poetry.lock": {"pyyaml": "6.0.1"},
+    }
+
+
+
+def test_failure_entries_rank_module_specifiers_first(monkeypatch) -> None:
+    table = {name: ["1.0.0"] for name in ("color", "debug", "error", "test", "left-pad")}
+    text = "> test\nerror in debug build (color output)\nError: Cannot find module 'left-pad'\n"
+    monkeypatch.setattr(lockfiles, "MAX_FAILURE_ENTRIES", 1)
+    assert lockfiles.failure_entries({"yarn.lock": table}, text) == {"yarn.lock": {"left-pad": "1.0.0"}}
+
+
+def test_pyproject_dependencies_without_toml_parser(monkeypatch) -> None:
+    content = """[project]
+name = "demo"
+dependencies = [
+    "Requests[socks]>=2.31",  # comment
+    'PyYAML',
+]
+
+[project.optional-dependencies]
+docs = ["Sphinx>=7"]
+
+[tool.poetry.dependencies]
+python = "^3.9"
+click = { version = "^8.0" }
+
+[tool.poetry.group.dev.dependencies]
+pytest = "^7"
+"""
+    expected = {"requests", "pyyaml", "sphinx", "click", "pytest"}
+    assert lockfiles.pyproject_dependencies(content) == expected
+    monkeypatch.setattr(lockfiles, "tomllib", None)
+    assert lockfiles.pyproject_dependencies(content) == expected
+
+def test_collect_context_summarizes_lockfiles_and_caches_by_hash(temp_cwd, monkeypatch) -> None:
+    (temp_cwd / "package.json").write_text(json.dumps({"dependencies": {"lodash": "^4.17.0"}}))
+    (temp_cwd / "yarn.lock").write_text(YARN_LOCK)
+    old = time.time() - 60
+    os.utime(temp_cwd / "yarn.lock", (old, old))
+    parsed = []
+    parse = lockfiles.parse
+    monkeypatch.setattr(lockfiles, "parse", lambda name, content: parsed.append(name) or parse(name, content))
+
+    stderr = "TypeError: left-pad is not a function\n"
+    ctx = collect_context(str(temp_cwd), ["yarn", "test"], 1, "", stderr)
+
+    assert ctx["manifests"]["yarn.lock"] == {"packages": 3, "direct": {"lodash": "3.10.1, 4.17.21"}}
+    assert ctx["lockfile_entries"] == {"yarn.lock": {"left-pad": "1.3.0"}}
+    assert ctx["manifests"]["package.json"].startswith("{")
+
+    # A new mtime with the same content is hashed again but not parsed again.
+    os.utime(temp_cwd / "yarn.lock", (old + 5, old + 5))
+    collect_context(str(temp_cwd), ["yarn", "test"], 1, "", stderr)
+    collect_context(str(temp_cwd), ["yarn", "test"], 1, "", stderr)
+    assert parsed == ["yarn.lock"]
@@ -0,0 +1,96 @@
+"""Tests for local unified-diff repair."""
+
+import subprocess
+
+import pytest
+
+from stackfix.patching import apply_patch, repair_unified_diff, search_replace_to_diff
+
+
+@pytest.fixture
+def repo(temp_cwd):
+    subprocess.run(["git", "init", "-q"], cwd=temp_cwd, check=True)
+    (temp_cwd / "calc.py").write_text(
+        "def add(a, b):\n    return a - b\n\n\ndef mul(a, b):\n    return a + b\n"
+    )
+    return temp_cwd
+
+
+def _apply(diff_text, cwd):
+    apply_patch(diff_text, str(cwd))
+    return (cwd / "calc.py").read_text()
+
+
+def test_repairs_bare_hunk_headers_and_missing_git_header(repo):
+    broken = (
+        "--- a/calc.py\n+++ b/calc.py\n@@\n def add(a, b):\n-    return a - b\n+    return a + b\n"
+        "@@\n def mul(a, b):\n-    return a + b\n+    return a * b\n"
+    )
+    repaired = repair_unified_diff(broken, str(repo))
+    assert repaired is not None
+    assert repaired.startswith("diff --git a/calc.py b/calc.py\n")
+    assert "@@ -1,4 +1,4 @@" in repaired
+    assert "@@ -5,2 +5,2 @@" in repaired
+    assert "return a + b\n\n\ndef mul" in _apply(repaired, repo)
+
+
+def test_recomputes_wrong_ranges_and_trailing_whitespace(repo):
+    broken = (
+        "diff --git a/calc.py b/calc.py\n--- a/calc.py\n+++ b/calc.py\n@@ -40,7 +40,9 @@\n"
+        " def mul(a, b):   \n-    return a + b\n+    return a * b\n+    # fixed\n"
+    )
+    repaired = repair_unified_diff(broken, str(repo))
+    assert "@@ -2,5 +2,6 @@\n     return a - b\n \n \n def mul(a, b):\n" in repaired
+    assert _apply(repaired, repo).endswith("return a * b\n    # fixed\n")
+
+
+def test_converts_begin_patch(repo):
+    begin = (
+        "*** Begin Patch\n*** Update File: calc.py\n@@ def add(a, b):\n-    return a - b\n+    return a + b\n"
+        "*** Add File: notes.txt\n+hello\n*** End Patch\n"
+    )
+    repaired = repair_unified_diff(begin, str(repo))
+    assert "new file mode 100644" in repaired
+    _apply(repaired, repo)
+    assert (repo / "notes.txt").read_text() == "hello\n"
+    assert "return a + b" in (repo / "calc.py").read_text().split("def mul")[0]
+
+
+def test_unrepairable_diffs_return_none(repo):
+    assert repair_unified_diff("", str(repo)) is None
+    missing = "--- a/calc.py\n+++ b/calc.py\n@@\n-    return 42\n+    return 0\n"
+    assert repair_unified_diff(missing, str(repo)) is None
+    forbidden = "--- a/.env\n+++ b/.env\n@@\n-A=1\n+A=2\n"
+    assert repair_unified_diff(forbidden, str(repo)) is None
+
+
+def test_search_replace_edits_become_a_diff(repo):
+    edits = [
+        {"path": "calc.py", "search": "    return a - b\n", "replace": "    return a + b\n"},
+        # Trailing spaces do not match verbatim, so the block is matched line by line.
+        {
+            "path": "calc.py",
+            "search": "def mul(a, b):  \n    return a + b",
+            "replace": "def mul(a, b):\n    return a * b",
+        },
+        {"path": "notes.txt", "search": "", "replace": "hello\n"},
+    ]
+    diff = search_replace_to_diff(edits, str(repo))
+    assert diff.startswith("diff --git a/calc.py b/calc.py\n--- a/calc.py\n+++ b/calc.py\n@@ -1,6 +1,6 @@")
+    assert "new file mode 100644\n--- /dev/null\n+++ b/notes.txt\n" in diff
+    assert _apply(diff, repo) == "def add(a, b):\n    return a + b\n\n\ndef mul(a, b):\n    return a * b\n"
+    assert (repo / "notes.txt").read_text() == "hello\n"
+
+
+def test_search_replace_rejects_ambiguous_or_missing_blocks(repo):
+    with pytest.raises(RuntimeError, match="matches 2 times"):
+        search_replace_to_diff([{"path": "calc.py", "search": "(a, b):", "replace": "(x, y):"}], str(repo))
+    with pytest.raises(RuntimeError, match="not found"):
+        search_replace_to_diff([{"path": "calc.py", "search": "return 42", "replace": "return 0"}], str(repo))
+    (repo / "pkg.py").write_text("class A:\n    def f(self):\n        return 1\n")
+    # Copied without the class indentation: the replacement is re-indented to match.
+    edit = {"path": "pkg.py", "search": "def f(self):\n    return 1", "replace": "def f(self):\n    return 2"}
+    diff = search_replace_to_diff([edit], str(repo))
+    assert "+        return 2\n" in diff
+    with pytest.raises(RuntimeError, match="forbidden"):
+        search_replace_to_diff([{"path": ".env", "search": "", "replace": "A=1\n"}], str(repo))
@@ -0,0 +1,114 @@
+from stackfix import reducers
+from stackfix.context import collect_context
+from stackfix.stats import format_stats, load_stats
+
+PYTEST_OUTPUT = """\x1b[1m============================= test session starts ==============================\x1b[0m
+platform linux -- Python 3.11.7, pytest-8.0.0
+collected 3 items
+
+tests/test_app.py .F.                                                    [100%]
+
+=================================== FAILURES ===================================
+__________________________________ test_add ____________________________________
+
+    def test_add():
+>       assert add(1, 2) == 4
+E       assert 3 == 4
+
+tests/test_app.py:7: AssertionError
+=============================== warnings summary ===============================
+tests/test_app.py::test_old
+  app.py:3: DeprecationWarning: old api
+=========================== short test summary info ============================
+FAILED tests/test_app.py::test_add - assert 3 == 4
+========================= 1 failed, 2 passed in 0.05s ==========================
+"""
+
+
+def test_generic_reducers() -> None:
+    text = "Downloading\r 10%\r 55%\r100% done\n" + "retrying\n" * 6 + "ok\n"
+    text += "WARN deprecated: x\nstep\nWARN deprecated: x\n"
+    text += "Fetching ███████████████▌      70% 1.2/1.7 MB\n\x1b[31mError: boom\x1b[0m\n"
+
+    stdout, stderr, report = reducers.reduce_output(["make"], text, "")
+
+    assert stdout.splitlines() == [
+        "100% done",
+        "retrying",
+        "... [previous line repeated 5 more times]",
+        "ok",
+        "WARN deprecated: x",
+        "step",
+        "Error: boom",
+        "",
+        "... [1 repeated warning lines removed]",
+    ]
+    assert (stderr, report["tool"]) == ("", None)
+    assert set(report["reducers"]) == {"ansi", "progress", "repeats"}
+    assert report["chars_out"] == len(stdout) < report["chars_in"]
+
+    # Only lines that start as warnings are deduplicated; frames naming deprecated code stay.
+    frames = '  File "app.py", line 3, in deprecated_helper\n    warnings.warn("old")\n'
+    text = frames + "app.py:3: DeprecationWarning: old\nmain\n" + frames + "app.py:3: DeprecationWarning: old\n"
+    assert reducers.collapse_repeats(text).splitlines() == [
+        '  File "app.py", line 3, in deprecated_helper',
+        '    warnings.warn("old")',
+        "app.py:3: DeprecationWarning: old",
+        "main",
+        '  File "app.py", line 3, in deprecated_helper',
+        '    warnings.warn("old")',
+        "",
+        "... [1 repeated warning lines removed]",
+    ]
+    compiler = "src/a.c:3:5: warning: unused\nx\nsrc/a.c:3:5: warning: unused\n"
+    assert reducers.collapse_repeats(compiler).count("unused") == 1
+
+
+def test_tool_reducers_keep_the_failure() -> None:
+    stdout, _, report = reducers.reduce_output(["python", "-m", "pytest"], PYTEST_OUTPUT, "")
+    assert report["tool"] == "pytest"
+    assert "collected 3 items" not in stdout and "DeprecationWarning" not in stdout
+    assert "E       assert 3 == 4" in stdout and "tests/test_app.py:7: AssertionError" in stdout
+    assert stdout.rstrip().endswith("1 failed, 2 passed in 0.05s ==========================")
+    assert report["reducers"]["pytest"]["chars_out"] < report["reducers"]["pytest"]["chars_in"]
+
+    jest = "PASS src/a.test.js\n  ✓ adds (3 ms)\nFAIL src/b.test.js\n  ✓ works\n  ● sums › negative\n\n"
+    jest += "    expect(received).toBe(expected)\n\nTests:       1 failed, 2 passed, 3 total\n"
+    _, stderr, report = reducers.reduce_output(["npm", "test"], "", jest)
+    assert report["tool"] == "jest"
+    assert stderr.splitlines() == [
+        "FAIL src/b.test.js",
+        "  ● sums › negative",
+        "",
+        "    expect(received).toBe(expected)",
+        "",
+        "Tests:       1 failed, 2 passed, 3 total",
+    ]
+
+    tsc = "src/a.ts(3,7): error TS2322: Type 'string' is not assignable to type 'number'.\n"
+    tsc += "npm ERR! code ELIFECYCLE\nsrc/b.ts(1,1): error TS2304: Cannot find name 'x'.\n"
+    stdout, _, report = reducers.reduce_output(["npx", "tsc", "--noEmit"], tsc, "")
+    assert report["tool"] == "tsc" and "ELIFECYCLE" not in stdout and stdout.count("error TS") == 2
+
+    cargo = "   Compiling app v0.1.0\nwarning: unused variable: `x`\n --> src/main.rs:2:9\n\n"
+    cargo += "error[E0308]: mismatched types\n --> src/main.rs:3:5\n"
+    _, stderr, report = reducers.reduce_output(["cargo", "build"], "", cargo)
+    assert stderr.splitlines() == [
+        "error[E0308]: mismatched types",
+        " --> src/main.rs:3:5",
+        "",
+        "... [1 warnings removed]",
+    ]
+
+
+def test_collect_context_reports_reduction_ratios(temp_cwd) -> None:
+    ctx = collect_context(str(temp_cwd), ["pytest"], 1, PYTEST_OUTPUT, "")
+
+    assert ctx["stdout"].startswith("=================================== FAILURES")
+    assert ctx["_output_reduction"]["tool"] == "pytest"
+    counters = load_stats(str(temp_cwd))["reducers"]
+    assert counters["runs"] == 1 and counters["pytest_chars_out"] < counters["pytest_chars_in"]
+    ratio = round(100.0 * counters["pytest_chars_out"] / counters["pytest_chars_in"])
+    assert f"pytest_chars_out: {counters['pytest_chars_out']} ({ratio}% of input)" in format_stats(
+        {"reducers": counters}
+    )
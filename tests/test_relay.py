@@ -26,7 +26,12 @@ class _FakeOpenAI:
         self.chat = self
         self.completions = self
 
-    def create(self, **payload: Any) -> _FakeResp:
+    def create(self, **payload: Any) -> Any:
+        if payload.get("stream"):
+            return [
+                _FakeResp({"choices": [{"delta": {"content": part}, "finish_reason": None}]})
+                for part in ('{"ok": ', "true}")
+            ] + [_FakeResp({"choices": [{"delta": {}, "finish_reason": "stop"}]})]
         return _FakeResp({"choices": [{"message": {"content": json.dumps({"ok": True})}}]})
 
 
@@ -85,3 +90,62 @@ def test_rate_limit(monkeypatch: pytest.MonkeyPatch) -> None:
         headers={"Authorization": f"Bearer {token}"},
     )
     assert blocked.status_code == 429
+    assert blocked.headers["X-RateLimit-Remaining"] == "0"
+    assert int(blocked.headers["Retry-After"]) > 0
+
+
+def test_ws_streams_and_authenticates_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = _client(monkeypatch)
+    token = client.post("/v1/anon-token", json={"device_fingerprint": "abc"}).json()["token"]
+
+    payload = {"model": "stackfix-test", "messages": [{"role": "user", "content": "hi"}]}
+    with client.websocket_connect("/v1/ws", headers={"Authorization": f"Bearer {token}"}) as ws:
+        assert ws.receive_json()["type"] == "ready"
+        for request_id in ("r1", "r2"):
+            ws.send_json({"type": "request", "id": request_id, "payload": payload})
+            deltas = []
+            while True:
+                message = ws.receive_json()
+                assert message["id"] == request_id
+                if message["type"] == "delta":
+                    deltas.append(message["content"])
+                    continue
+                break
+            assert message["type"] == "done"
+            assert "".join(deltas) == '{"ok": true}'
+            choice = message["response"]["choices"][0]
+            assert choice["message"]["content"] == '{"ok": true}'
+            assert choice["finish_reason"] == "stop"
+
+
+def test_ws_rejects_invalid_token(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = _client(monkeypatch)
+    with client.websocket_connect("/v1/ws") as ws:
+        ws.send_json({"type": "auth", "token": "nope"})
+        message = ws.receive_json()
+        assert message["type"] == "error"
+        assert message["status"] == 401
+
+
+def test_ws_ignores_payload_stream_and_rechecks_token(monkeypatch: pytest.MonkeyPatch) -> None:
+    client = _client(monkeypatch)
+    token = client.post("/v1/anon-token", json={"device_fingerprint": "abc"}).json()["token"]
+
+    payload = {"model": "stackfix-test", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    with client.websocket_connect("/v1/ws", headers={"Authorization": f"Bearer {token}"}) as ws:
+        assert ws.receive_json()["type"] == "ready"
+        ws.send_json({"type": "request", "id": "r1", "payload": payload})
+        message = ws.receive_json()
+        while message["type"] == "delta":
+            message = ws.receive_json()
+        assert message["type"] == "done"
+        assert message["response"]["choices"][0]["message"]["content"] == '{"ok": true}'
+
+        # Revoked while the connection is open: the next request is refused and the socket closed.
+        relay_app._get_token_store()._tokens.clear()
+        ws.send_json({"type": "request", "id": "r2", "payload": payload})
+        message = ws.receive_json()
+        assert (message["type"], message["id"], message["status"]) == ("error", "r2", 401)
+        with pytest.raises(relay_app.WebSocketDisconnect) as closed:
+            ws.receive_json()
+        assert closed.value.code == 4401
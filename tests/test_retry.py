@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+import stackfix.retry as retry
+import stackfix.transport as transport
+
+
+class _Response:
+    def __init__(self, status_code: int, headers: dict = None) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_retry_after_formats() -> None:
+    now = time.time()
+    assert retry.retry_after({"Retry-After": "3"}) == 3
+    assert retry._seconds_until("1m30s", now) == 90
+    assert retry._seconds_until("250ms", now) == 0.25
+    assert 9 <= retry._seconds_until(str(int(now) + 10), now) <= 10
+    assert retry._seconds_until("Wed, 21 Oct 2015 07:28:00 GMT", now) == 0
+    assert retry.retry_after({}) is None
+
+
+def test_post_retries_transient_statuses(monkeypatch: pytest.MonkeyPatch) -> None:
+    responses = [_Response(429, {"Retry-After": "2"}), _Response(503), _Response(200)]
+    sent = list(responses)
+    slept = []
+    monkeypatch.setattr(transport, "post", lambda url, **kwargs: sent.pop(0))
+    monkeypatch.setattr(retry, "_sleep", slept.append)
+
+    resp = retry.post("https://relay.test/v1/chat/completions", json={})
+    assert resp is responses[2]
+    assert responses[0].closed and responses[1].closed
+    assert 2 <= slept[0] <= 2 + retry.BACKOFF_BASE_SECONDS
+    assert 0 <= slept[1] <= 2 * retry.BACKOFF_BASE_SECONDS * 2
+
+    monkeypatch.setattr(transport, "post", lambda url, **kwargs: _Response(500))
+    assert retry.post("https://model.test/v1", json={}).status_code == 500
+    sent.extend(_Response(502) for _ in range(5))
+    monkeypatch.setattr(transport, "post", lambda url, **kwargs: sent.pop(0))
+    assert retry.post("https://model.test/v1", policy=retry.RetryPolicy(max_attempts=2)).status_code == 502
+    assert len(sent) == 3
+
+
+def test_pacer_spreads_requests_and_waits_out_quota(monkeypatch: pytest.MonkeyPatch) -> None:
+    url = "https://relay.test/v1/chat/completions"
+    assert retry.reserve(url) == 0
+    reset = str(int(time.time()) + 30)
+    retry.note_response(url, 200, {"X-RateLimit-Remaining": "50", "X-RateLimit-Reset": reset})
+    assert retry.reserve(url) == 0
+    assert retry.reserve(url) == 0
+
+    retry.note_response(url, 200, {"X-RateLimit-Remaining": "2", "X-RateLimit-Reset": reset})
+    assert retry.reserve(url) == 0
+    # The next caller, in this or another process, is pushed back by a share of the window.
+    assert 9 <= retry.reserve(url) <= retry.MAX_PACE_INTERVAL
+
+    retry.note_response(url, 429, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(int(time.time()) + 3600)})
+    with pytest.raises(RuntimeError, match="resets in"):
+        retry.RetryPolicy(deadline=60).wait_before(url)
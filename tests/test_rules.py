@@ -0,0 +1,117 @@
+import subprocess
+
+import pytest
+
+import stackfix.rules as rules
+from stackfix.patching import apply_patch
+from stackfix.stats import load_stats
+
+PYPROJECT = """[project]
+name = "demo"
+dependencies = [
+  "PyYAML>=6",
+  "requests",
+]
+
+[project.optional-dependencies]
+dev = ["pytest>=7"]
+
+[tool.black]
+line-length = 100
+"""
+
+
+def _context(cwd, stderr, **extra):
+    return dict({"cwd": str(cwd), "stderr": stderr, "manifests": {"pyproject.toml": PYPROJECT}}, **extra)
+
+
+def _script(path, shebang):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(f"#!{shebang}\nimport sys\n")
+    path.chmod(0o755)
+    return path
+
+
+def test_missing_declared_module_installs_it(temp_cwd, monkeypatch: pytest.MonkeyPatch) -> None:
+    stderr = "Traceback ...\nModuleNotFoundError: No module named 'yaml'\n"
+    result = rules.match(_context(temp_cwd, stderr, command=[".venv/bin/python3.11", "-m", "app"]))
+    assert result["_rule"] == "missing_module"
+    assert result["_fix_command"] == [".venv/bin/python3.11", "-m", "pip", "install", "PyYAML>=6"]
+    assert result["patch_unified_diff"] == ""
+
+    # A script such as pytest is installed into with the interpreter on its #! line.
+    _script(temp_cwd / "env" / "bin" / "pytest", "/opt/env/bin/python3")
+    result = rules.match(_context(temp_cwd, stderr, command=["env/bin/pytest", "-q"]))
+    assert result["_fix_command"] == ["/opt/env/bin/python3", "-m", "pip", "install", "PyYAML>=6"]
+    python = _script(temp_cwd / "tools" / "python3", "/bin/sh")
+    _script(temp_cwd / "tools" / "tox", "/usr/bin/env python3")
+    monkeypatch.setenv("PATH", str(temp_cwd / "tools"))
+    result = rules.match(_context(temp_cwd, stderr, command=["tox"]))
+    assert result["_fix_command"] == [str(python), "-m", "pip", "install", "PyYAML>=6"]
+
+    # Neither the command nor a project venv says where the project's packages go.
+    assert rules.match(_context(temp_cwd, stderr, command=["make", "test"])) is None
+
+    # Not declared anywhere, or the project itself: left to the model.
+    assert rules.match(_context(temp_cwd, "ModuleNotFoundError: No module named 'numpy'")) is None
+    assert rules.match(_context(temp_cwd, "ModuleNotFoundError: No module named 'demo'")) is None
+    assert rules.match(_context(temp_cwd, "ModuleNotFoundError: No module named 'black'")) is None
+    assert load_stats(str(temp_cwd))["rules"] == {"attempts": 7, "missing_module": 3}
+
+
+def test_declared_requirement_sources() -> None:
+    manifests = {
+        "requirements.txt": "# pinned\nDjango==4.2  # web\n-r other.txt\n",
+        "pyproject.toml": '[tool.poetry.dependencies]\npython = "^3.10"\nrich = "^13"\n',
+    }
+    assert rules.declared_requirement(manifests, "django") == "Django==4.2"
+    assert rules.declared_requirement(manifests, "rich") == "rich"
+    assert rules.declared_requirement(manifests, "python") is None
+    assert rules.declared_requirement(manifests, "other") is None
+    # Only dependency tables count, not every string in [project].
+    pyproject = '[project]\nname = "demo"\nkeywords = ["cli"]\ndependencies = ["click>=8"]\n'
+    assert rules.declared_requirement({"pyproject.toml": pyproject}, "cli") is None
+    assert rules.declared_requirement({"pyproject.toml": pyproject}, "click") == "click>=8"
+
+
+def test_command_not_found_and_lockfiles(temp_cwd) -> None:
+    assert rules.match(_context(temp_cwd, "sh: 1: pytest: not found\n")) is None
+    venv_python = _script(temp_cwd / ".venv" / "bin" / "python", "/bin/sh")
+    result = rules.match(_context(temp_cwd, "sh: 1: pytest: not found\n"))
+    assert result["_fix_command"] == [str(venv_python), "-m", "pip", "install", "pytest>=7"]
+    assert rules.match(_context(temp_cwd, "bash: python: command not found\n")) is None
+
+    (temp_cwd / "yarn.lock").write_text("")
+    package_json = '{"devDependencies": {"jest": "^29.0.0"}}'
+    context = dict(_context(temp_cwd, "/bin/sh: jest: command not found\n"), manifests={"package.json": package_json})
+    assert rules.match(context)["_fix_command"] == ["yarn", "install"]
+    assert rules.match(_context(temp_cwd, "bash: ruff: command not found\n")) is None
+
+    npm = "npm ERR! `npm ci` can only install packages when your package.json and package-lock.json are in sync."
+    result = rules.match(_context(temp_cwd, npm))
+    assert (result["_rule"], result["_fix_command"]) == ("lockfile_out_of_sync", ["npm", "install"])
+    assert rules.match(_context(temp_cwd, "ERR_PNPM_OUTDATED_LOCKFILE Cannot install"))["_fix_command"][0] == "pnpm"
+
+
+def test_missing_init_adds_package_markers(temp_cwd) -> None:
+    subprocess.run(["git", "init", "-q"], cwd=temp_cwd, check=True)
+    (temp_cwd / "tests" / "helpers").mkdir(parents=True)
+    (temp_cwd / "tests" / "helpers" / "factory.py").write_text("def make():\n    return 1\n")
+    stderr = "E   ModuleNotFoundError: No module named 'tests.helpers.factory'\n"
+
+    result = rules.match(_context(temp_cwd, stderr))
+    assert result["_rule"] == "missing_init"
+    apply_patch(result["patch_unified_diff"], str(temp_cwd))
+    assert (temp_cwd / "tests" / "__init__.py").read_text() == '"""tests package."""\n'
+    assert (temp_cwd / "tests" / "helpers" / "__init__.py").is_file()
+    assert rules.match(_context(temp_cwd, stderr)) is None
+    assert rules.match(_context(temp_cwd, "No module named 'tests.helpers.gone'")) is None
+
+
+def test_custom_rules_and_follow_up_rounds(temp_cwd, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(rules, "_RULES", [])
+    monkeypatch.setattr(rules, "_MATCHER", None)
+    rules.register(rules.Rule("port_in_use", r"EADDRINUSE.*:(?P<port>\d+)", lambda m, ctx: rules.fix_result(m["port"])))
+    result = rules.match(_context(temp_cwd, "Error: listen EADDRINUSE: address already in use :::3000"))
+    assert (result["_rule"], result["summary"]) == ("port_in_use", "3000")
+    assert rules.match(_context(temp_cwd, "listen EADDRINUSE :::3000", iteration=2)) is None
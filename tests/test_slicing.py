@@ -0,0 +1,61 @@
+from stackfix import slicing
+from stackfix.context import collect_context
+from stackfix.slicing import find_locations, source_snippets
+
+
+def test_find_locations_across_formats() -> None:
+    python = 'Traceback (most recent call last):\n  File "app/main.py", line 3, in <module>\n    run()\n'
+    python += '  File "app/util.py", line 9, in run\n    boom()\nValueError: bad\n'
+    node = "TypeError: x is undefined\n    at inner (/srv/src/lib.js:4:7)\n    at Object.<anonymous> (src/index.js:12:1)\n"
+    compilers = "src/app.ts(7,3): error TS2322: nope\ntests/test_x.py:21: AssertionError\nsrc/a.c:5:2: error: x\n"
+    compilers += "error[E0308]: mismatched types\n  --> src/main.rs:8:5\n"
+
+    found = find_locations(python + node + compilers)
+    paths = [(path, line) for path, line, _ in found]
+    ranks = {(path, line): rank for path, line, rank in found}
+
+    assert paths[:2] == [("app/main.py", 3), ("app/util.py", 9)]
+    assert ("src/app.ts", 7) in paths
+    assert ("tests/test_x.py", 21) in paths
+    assert ("src/a.c", 5) in paths
+    assert ("src/main.rs", 8) in paths
+    # Innermost frames rank highest: last in a Python traceback, first in a Node stack.
+    assert ranks[("app/util.py", 9)] > ranks[("app/main.py", 3)]
+    assert ranks[("/srv/src/lib.js", 4)] > ranks[("src/index.js", 12)]
+
+
+def test_source_snippets_rank_dedupe_and_skip_forbidden(temp_cwd) -> None:
+    (temp_cwd / "app").mkdir()
+    (temp_cwd / "app" / "main.py").write_text("".join(f"line {n}\n" for n in range(1, 41)))
+    (temp_cwd / "app" / "util.py").write_text("def run():\n    boom()\n")
+    (temp_cwd / "node_modules").mkdir()
+    (temp_cwd / "node_modules" / "dep.js").write_text("x\n")
+    stderr = (
+        'File "app/main.py", line 10, in a\nFile "app/main.py", line 12, in b\n'
+        'File "app/util.py", line 2, in run\nFile "app/util.py", line 2, in run\n'
+        'File "node_modules/dep.js", line 1\nFile "/etc/passwd", line 1\n'
+    )
+
+    snippets = source_snippets(str(temp_cwd), stderr)
+
+    assert [s["path"] for s in snippets] == ["app/util.py", "app/main.py"]
+    assert snippets[0]["lines"] == [2]
+    assert snippets[0]["source"].splitlines()[1] == "> 2 |     boom()"
+    assert snippets[1]["lines"] == [10, 12]
+    assert (snippets[1]["start"], snippets[1]["end"]) == (2, 18)
+    assert "> 12 | line 12" in snippets[1]["source"]
+    budget = len(snippets[0]["source"].encode("utf-8"))
+    assert [s["path"] for s in source_snippets(str(temp_cwd), stderr, budget=budget)] == ["app/util.py"]
+
+
+def test_collect_context_slices_without_indexing_whole_file(temp_cwd, monkeypatch) -> None:
+    monkeypatch.setenv("STACKFIX_NO_SYMBOLS", "1")
+    (temp_cwd / "big.py").write_text("".join(f"value_{n} = {n}\n" for n in range(1, 50001)))
+
+    ctx = collect_context(str(temp_cwd), ["python", "big.py"], 1, "", 'File "big.py", line 20\nNameError: x\n')
+
+    assert ctx["source_snippets"][0]["path"] == "big.py"
+    assert "> 20 | value_20 = 20" in ctx["source_snippets"][0]["source"]
+    assert "slicing_seconds" in ctx["_context_timings"]
+    index = slicing._line_index(str(temp_cwd / "big.py"))
+    assert len(index.offsets) < 100
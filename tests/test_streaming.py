@@ -0,0 +1,43 @@
+"""Tests for incremental agent response parsing."""
+
+import json
+
+from stackfix.streaming import JSONFieldStream, iter_sse_data
+
+
+def _collect(chunks):
+    events = []
+    parser = JSONFieldStream(["summary", "patch_unified_diff"], lambda *e: events.append(e))
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser, events
+
+
+def test_fields_stream_across_chunk_boundaries():
+    body = json.dumps(
+        {
+            "summary": 'Fix "add" é \U0001F600',
+            "confidence": 0.5,
+            "patch_unified_diff": "diff --git a/x b/x\n+y\\z\n",
+            "rerun_command": ["pytest"],
+        }
+    )
+    parser, events = _collect(body[i:i + 3] for i in range(0, len(body), 3))
+    summary = "".join(t for e, f, t in events if e == "field_delta" and f == "summary")
+    patch = "".join(t for e, f, t in events if e == "field_delta" and f == "patch_unified_diff")
+    assert summary == 'Fix "add" é \U0001F600'
+    assert patch == "diff --git a/x b/x\n+y\\z\n"
+    done = [(f, t) for e, f, t in events if e == "field_done"]
+    assert done == [("summary", summary), ("patch_unified_diff", patch)]
+    assert parser.values == {"summary": summary, "patch_unified_diff": patch}
+
+
+def test_nested_keys_and_fences_are_ignored():
+    body = '```json\n{"meta": {"summary": "nested"}, "summary": "top"}\n```'
+    _, events = _collect([body])
+    assert [(e, f, t) for e, f, t in events if e == "field_done"] == [("field_done", "summary", "top")]
+
+
+def test_iter_sse_data_stops_at_done():
+    lines = ["", ": keep-alive", 'data: {"a": 1}', b'data: {"a": 2}', "data: [DONE]", 'data: {"a": 3}']
+    assert [e["a"] for e in iter_sse_data(lines)] == [1, 2]
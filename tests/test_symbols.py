@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+from stackfix import context, symbols
+from stackfix.context import collect_context
+
+
+def test_parsers_and_error_symbols() -> None:
+    python = symbols._python_symbols(
+        "import os.path\nfrom x import y as z\n__all__ = ['run']\nLIMIT = 3\n"
+        "class Box:\n    def open(self):\n        pass\nasync def run():\n    pass\n"
+    )
+    assert ("os", "import", 1) in python and ("z", "import", 2) in python
+    assert ("run", "export", 3) in python and ("LIMIT", "variable", 4) in python
+    assert ("Box", "class", 5) in python and ("open", "function", 6) in python and ("run", "function", 8) in python
+
+    javascript = symbols._javascript_symbols(
+        "import React, { useState as use } from 'react'\nexport default function App() {}\n"
+        "export const api = 1\nexport interface Props {}\nexport { a, b as c }\n"
+    )
+    assert ("React", "import", 1) in javascript and ("use", "import", 1) in javascript
+    assert ("App", "function", 2) in javascript and ("api", "variable", 3) in javascript
+    assert ("Props", "type", 4) in javascript and ("c", "export", 5) in javascript
+    assert symbols._PARSERS["go"]("func (s *Server) Start() {}\ntype Config struct{}\n") == [
+        ("Start", "function", 1),
+        ("Config", "type", 2),
+    ]
+    assert symbols._PARSERS["rust"]("pub fn load() {}\npub(crate) struct Cache;\n") == [
+        ("load", "function", 1),
+        ("Cache", "type", 2),
+    ]
+
+    stderr = "NameError: name 'parse_config' is not defined\nsrc/a.ts(3,1): error TS2304: Cannot find name 'Widget'.\n"
+    assert symbols.error_symbols("", stderr) == ["Widget", "parse_config"]
+
+
+def test_index_updates_incrementally(temp_cwd, monkeypatch) -> None:
+    (temp_cwd / "pkg").mkdir()
+    for n in range(3):
+        (temp_cwd / "pkg" / f"m{n}.py").write_text(f"def f{n}():\n    pass\n")
+    (temp_cwd / "node_modules").mkdir()
+    (temp_cwd / "node_modules" / "dep.js").write_text("export function hidden() {}\n")
+    # The first build goes through the process pool.
+    monkeypatch.setattr(symbols, "POOL_THRESHOLD", 2)
+    assert symbols.update_index(str(temp_cwd)) == {"files": 3, "parsed": 3, "removed": 0}
+    assert symbols.lookup(str(temp_cwd), "hidden") == []
+
+    monkeypatch.setattr(symbols, "RACY_SECONDS", 0)
+    assert symbols.update_index(str(temp_cwd))["parsed"] == 0
+    # A new mtime with the same content is hashed but not parsed again.
+    later = time.time() + 5
+    os.utime(temp_cwd / "pkg" / "m0.py", (later, later))
+    assert symbols.update_index(str(temp_cwd))["parsed"] == 0
+    (temp_cwd / "pkg" / "m1.py").write_text("def renamed():\n    pass\n")
+    (temp_cwd / "pkg" / "m2.py").unlink()
+    assert symbols.update_index(str(temp_cwd)) == {"files": 2, "parsed": 1, "removed": 1}
+    assert symbols.lookup(str(temp_cwd), "f1") == []
+    assert symbols.lookup(str(temp_cwd), "RENAMED") == [
+        {"symbol": "renamed", "kind": "function", "path": os.path.join("pkg", "m1.py"), "line": 1}
+    ]
+
+
+def test_collect_context_attaches_definitions_of_missing_symbols(temp_cwd) -> None:
+    (temp_cwd / "config_utils.py").write_text("import json\n\n\ndef parse_config(path):\n    return json.load(path)\n")
+    (temp_cwd / "main.py").write_text("print(parse_config('x'))\n")
+    stderr = 'File "main.py", line 1, in <module>\nNameError: name \'parse_config\' is not defined\n'
+
+    ctx = collect_context(str(temp_cwd), ["python", "main.py"], 1, "", stderr)
+
+    [definition] = ctx["symbol_definitions"]
+    assert (definition["path"], definition["line"], definition["kind"]) == ("config_utils.py", 4, "function")
+    assert "> 4 | def parse_config(path):" in definition["source"]
+    assert "symbol_lookup_seconds" in ctx["_context_timings"]
+
+
+def test_collect_context_does_not_wait_for_a_slow_index_build(temp_cwd, monkeypatch) -> None:
+    (temp_cwd / "config_utils.py").write_text("def parse_config(path):\n    return path\n")
+    symbols.update_index(str(temp_cwd))
+    release = threading.Event()
+    monkeypatch.setattr(symbols, "update_index", lambda cwd: release.wait(30))
+    monkeypatch.setattr(context, "SYMBOL_WAIT_SECONDS", 0.1)
+    stderr = "NameError: name 'parse_config' is not defined\n"
+
+    started = time.monotonic()
+    ctx = collect_context(str(temp_cwd), ["python", "main.py"], 1, "", stderr)
+    # Without a missing name the build is not waited for at all.
+    plain = collect_context(str(temp_cwd), ["python", "main.py"], 1, "", "AssertionError\n")
+    release.set()
+
+    assert time.monotonic() - started < 5
+    assert ctx["_context_timings"]["symbols_ready"] is False
+    # The lookup reads what the earlier run indexed.
+    assert ctx["symbol_definitions"][0]["path"] == "config_utils.py"
+    assert "symbols_ready" not in plain["_context_timings"]
@@ -0,0 +1,47 @@
+import gzip
+import os
+import sys
+
+from stackfix.util import OutputCapture, run_command_stream, truncate_middle
+
+
+def test_capture_keeps_head_and_tail_and_spills_full_log(tmp_path) -> None:
+    spill = tmp_path / "logs" / "out.log.gz"
+    capture = OutputCapture(head_chars=20, tail_chars=30, spill_path=str(spill))
+    lines = [f"line {n:04d}\n" for n in range(1000)]
+    for line in lines:
+        capture.write(line)
+    capture.close()
+
+    text = capture.text()
+    assert text.startswith("line 0000\nline 0001\n... [995 lines elided; full log in ")
+    assert text.endswith("line 0997\nline 0998\nline 0999\n")
+    assert capture._tail_size <= 30 and len(capture._tail) == 3
+    with gzip.open(spill, "rt", encoding="utf-8") as f:
+        assert f.read() == "".join(lines)
+
+    small = OutputCapture(head_chars=20, tail_chars=30, spill_path=str(tmp_path / "small.log.gz"))
+    for line in lines[:4]:
+        small.write(line)
+    assert small.text() == "".join(lines[:4])
+    assert not os.path.exists(tmp_path / "small.log.gz")
+
+
+def test_run_command_stream_keeps_the_end_of_long_output(temp_cwd, capsys) -> None:
+    script = "import sys\nfor n in range(50000): print('progress', n)\nsys.exit('Traceback: boom at the end')\n"
+    exit_code, stdout, stderr = run_command_stream([sys.executable, "-c", script], str(temp_cwd))
+
+    assert exit_code == 1
+    assert stdout.startswith("progress 0\n") and stdout.endswith("progress 49999\n")
+    assert "lines elided; full log in " in stdout and len(stdout) < 20000
+    assert stderr == "Traceback: boom at the end\n"
+    [log] = os.listdir(temp_cwd / ".stackfix" / "logs")
+    assert log.endswith("-stdout.log.gz")
+    assert "progress 49999" in capsys.readouterr().out
+
+
+def test_truncate_middle_keeps_the_end() -> None:
+    text = "a" * 50 + "ERROR"
+    cut = truncate_middle(text, 20)
+    assert cut.startswith("aaaa\n... [35 chars elided] ...\n") and cut.endswith("ERROR")
+    assert truncate_middle("short", 20) == "short"